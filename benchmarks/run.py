@@ -0,0 +1,167 @@
+#!/usr/bin/env python
+# encoding: utf-8
+
+# Copyright (C) 2018 Stadt Karlsruhe (www.karlsruhe.de)
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published
+# by the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+'''
+End-to-end benchmarks for *ckanext.importer*.
+
+Runs the following scenarios against an in-memory CKAN stand-in (see
+``ckanext/importer/tests/fakeckan.py``) for each of the given numbers of
+packages:
+
+``initial-load``
+    Creates all packages (each with resources) in an empty CKAN.
+
+``noop-resync``
+    Syncs the same packages again without changes.
+
+``mass-deletion``
+    Syncs 10% of the packages and deletes the remaining ones.
+
+For each scenario the wall time, the throughput and the number of API
+calls (in total and per action) are reported.
+
+Usage::
+
+    python benchmarks/run.py --sizes 1000 10000 --latency 0.005 --workers 8
+'''
+
+from __future__ import (absolute_import, division, print_function,
+                        unicode_literals)
+
+import argparse
+import json
+from timeit import default_timer
+
+from ckanext.importer import Importer
+from ckanext.importer.tests.fakeckan import FakeCKAN
+
+
+SCENARIOS = ['initial-load', 'noop-resync', 'mass-deletion']
+
+
+def _items(num_packages, num_resources):
+    for i in range(num_packages):
+        yield 'pkg-{}'.format(i), {
+            'title': 'Package {}'.format(i),
+            'notes': 'Description of package {}'.format(i),
+            'resources': [
+                {'eid': 'res-{}'.format(j), 'name': 'Resource {}'.format(j),
+                 'url': 'https://example.com/{}/{}'.format(i, j)}
+                for j in range(num_resources)
+            ],
+        }
+
+
+def _sync(pkg, item):
+    pkg['title'] = item['title']
+    pkg['notes'] = item['notes']
+    for res_item in item['resources']:
+        with pkg.sync_resource(res_item['eid']) as res:
+            res['name'] = res_item['name']
+            res['url'] = res_item['url']
+
+
+def _fingerprint(item):
+    return json.dumps(item, sort_keys=True)
+
+
+def _new_importer(api, args):
+    return Importer('benchmark', api=api, hash_names=True,
+                    prefetch=args.prefetch,
+                    defer_resource_writes=args.defer_resource_writes,
+                    search_workers=args.workers)
+
+
+def _run_scenario(scenario, api, num_packages, args):
+    '''
+    Run a scenario and return the number of processed packages.
+    '''
+    imp = _new_importer(api, args)
+    fingerprint = _fingerprint if args.fingerprint else None
+    if scenario == 'mass-deletion':
+        num_kept = num_packages // 10
+        items = _items(num_kept, args.resources)
+        imp.sync_many(items, _sync, workers=args.workers,
+                      fingerprint=fingerprint)
+        report = imp.delete_unsynced_packages(workers=args.workers)
+        return num_kept + len(report.deleted)
+    items = _items(num_packages, args.resources)
+    imp.sync_many(items, _sync, workers=args.workers, fingerprint=fingerprint)
+    return num_packages
+
+
+def _format_calls(calls):
+    return ', '.join('{}={}'.format(action, count)
+                     for action, count in sorted(calls.items()))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.strip().split('\n')[0])
+    parser.add_argument('--sizes', type=int, nargs='+',
+                        default=[1000, 10000, 100000],
+                        help='Numbers of packages (default: 1000 10000 100000)')
+    parser.add_argument('--scenarios', nargs='+', choices=SCENARIOS,
+                        default=SCENARIOS, help='Scenarios to run')
+    parser.add_argument('--resources', type=int, default=2,
+                        help='Number of resources per package (default: 2)')
+    parser.add_argument('--latency', type=float, default=0,
+                        help='Simulated latency of read actions in seconds')
+    parser.add_argument('--write-latency', type=float,
+                        help='Simulated latency of write actions in seconds '
+                             '(default: same as --latency)')
+    parser.add_argument('--workers', type=int, default=1,
+                        help='Number of worker threads (default: 1)')
+    parser.add_argument('--prefetch', action='store_true',
+                        help='Use prefetching')
+    parser.add_argument('--fingerprint', action='store_true',
+                        help='Skip unchanged packages via fingerprints')
+    parser.add_argument('--defer-resource-writes', action='store_true',
+                        help='Defer resource writes to the package upload')
+    parser.add_argument('--json', action='store_true',
+                        help='Output results as JSON lines')
+    args = parser.parse_args(argv)
+
+    for num_packages in args.sizes:
+        api = FakeCKAN(latency=args.latency, write_latency=args.write_latency)
+        for scenario in args.scenarios:
+            if scenario != 'initial-load' and not api.count_packages():
+                # Later scenarios need existing packages
+                _run_scenario('initial-load', api, num_packages, args)
+            api.reset_calls()
+            start = default_timer()
+            processed = _run_scenario(scenario, api, num_packages, args)
+            seconds = default_timer() - start
+            result = {
+                'scenario': scenario,
+                'packages': num_packages,
+                'seconds': seconds,
+                'packages_per_second': processed / seconds if seconds else None,
+                'api_calls': sum(api.calls.values()),
+                'api_calls_per_action': dict(api.calls),
+            }
+            if args.json:
+                print(json.dumps(result, sort_keys=True))
+            else:
+                print('{scenario} ({packages} packages): {seconds:.2f}s, '
+                      '{packages_per_second:.0f} packages/s, '
+                      '{api_calls} API calls'.format(**result))
+                print('    ' + _format_calls(api.calls))
+
+
+if __name__ == '__main__':
+    main()
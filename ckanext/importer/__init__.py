@@ -20,21 +20,31 @@
 from __future__ import (absolute_import, division, print_function,
                         unicode_literals)
 
-from copy import deepcopy
+from concurrent.futures import (FIRST_COMPLETED, ThreadPoolExecutor,
+                                as_completed, wait)
 import collections
+from copy import deepcopy
 from enum import Enum
+import functools
+import hashlib
 from itertools import islice
 import json
 import logging
+import re
+import threading
 
 import ckanapi
 from ckan.logic import NotFound
 
-from .utils import (DictWrapper, context_manager_method, replace_dict,
-                    solr_escape)
+from .metrics import InstrumentedAPI, Metrics
+from .shard import get_shard
+from .throttle import ThrottledAPI
+from .transport import _is_transient_error
+from .utils import (DictWrapper, _run_steps, _unwrap_api,
+                    context_manager_method, replace_dict, solr_escape)
 
 
-__all__ = ['Importer', 'OnError']
+__all__ = ['Importer', 'OnError', 'UploadMode']
 
 
 __version__ = '0.2.0'
@@ -46,6 +56,9 @@ class Entity(DictWrapper):
 
     Not to be instantiated directly.
     '''
+    #: Name of the entity type, used for metrics. Set by subclasses.
+    _entity_type = None
+
     def __init__(self, eid, data_dict, parent):
         '''
         Constructor.
@@ -60,6 +73,7 @@ class Entity(DictWrapper):
         super(Entity, self).__init__(data_dict)
         self._eid = eid
         self._parent = parent
+        self._imp = getattr(parent, '_imp', parent)
         self._api = parent._api
         self._log = parent._log
         self._mark_as_unmodified()
@@ -70,13 +84,37 @@ class Entity(DictWrapper):
         '''
         Mark this entity as unmodified.
         '''
-        self._original_dict = deepcopy(self._dict)
+        self._reset_changes()
 
     def _is_modified(self):
         '''
         Check if this entity has been modified.
         '''
-        return self._original_dict != self._dict
+        return bool(self._changed_keys())
+
+    def _discard_changes(self):
+        '''
+        Undo the changes that have been made to this entity.
+        '''
+        replace_dict(self._dict, self._get_original())
+        self._mark_as_unmodified()
+
+    def _get_changes(self):
+        '''
+        Get the changes that have been made to this entity.
+
+        Returns a tuple ``(updated, removed)``, where ``updated`` is a
+        dict containing the new values of all added or modified fields
+        and ``removed`` is a list of the keys of all removed fields.
+        '''
+        updated = {}
+        removed = []
+        for key in self._changed_keys():
+            if key in self._dict:
+                updated[key] = self._dict[key]
+            else:
+                removed.append(key)
+        return updated, removed
 
     def delete(self):
         '''
@@ -136,10 +174,34 @@ class OnError(Enum):
     #: entity is not kept.
     keep = 2
 
-    #: Swallow the exception and delete the entity.
+    #: Swallow the exception and delete the entity. Existing entities
+    #: are kept if the exception is a transient transport error (see
+    #: :py:mod:`ckanext.importer.transport`), since such errors say
+    #: nothing about the entity itself.
     delete = 3
 
 
+class UploadMode(Enum):
+    '''
+    Upload mode constants.
+
+    Used for the ``upload_mode`` argument of :py:class:`Importer`.
+    '''
+    #: Upload the complete entity using ``package_update`` and
+    #: ``resource_update``.
+    update = 1
+
+    #: Upload only the modified fields using ``package_patch`` and
+    #: ``resource_patch``. If fields have been removed from an entity
+    #: then the complete entity is uploaded instead.
+    patch = 2
+
+    #: Upload only the modified fields of packages using
+    #: ``package_revise``, which is available in CKAN 2.9 and later.
+    #: Resources are uploaded as for :py:attr:`patch`.
+    revise = 3
+
+
 class EntitySyncManager(object):
     '''
     Context manager for synchronizing an ``Entity``.
@@ -173,14 +235,32 @@ class EntitySyncManager(object):
         '''
         raise NotImplementedError
 
-    def __enter__(self):
+    def _record(self, result):
+        '''
+        Record the result of the sync in the importer's metrics.
+
+        Only the first result that is recorded for a sync counts.
+        '''
+        if self._result is None:
+            self._result = result
+            imp = getattr(self._outer, '_imp', self._outer)
+            imp.metrics.record_entity(self._entity._entity_type, result)
+
+    def _enter_steps(self):
+        '''
+        Find or create the entity.
+
+        Generator for :py:func:`~ckanext.importer.utils._run_steps`, so
+        that the logic is shared with the asynchronous front-end.
+        '''
+        self._result = None
         try:
             try:
-                self._entity = self._find_entity()
+                self._entity = yield self._find_entity
                 self._just_created = False
                 self._outer._log.debug('Using {}'.format(self._entity))
             except NotFound:
-                self._entity = self._create_entity()
+                self._entity = yield self._create_entity
                 self._just_created = True
                 self._outer._log.debug('Created {}'.format(self._entity))
             assert self._entity is not None
@@ -197,29 +277,43 @@ class EntitySyncManager(object):
             # is to reraise.
             raise
 
-    def __exit__(self, exc_type, exc_val, exc_tb):
+    def _delete_entity_steps(self):
+        '''
+        Delete the entity.
+
+        Generator for :py:func:`~ckanext.importer.utils._run_steps`.
+        '''
         entity = self._entity
+        try:
+            yield entity._delete
+        except Exception as e:
+            self._outer._log.exception('Error while deleting {}: {}'.format(entity, e))
+            self._record('failed')
+            if self._on_error == OnError.reraise:
+                raise
 
-        def delete():
-            try:
-                entity._delete()
-            except Exception as e:
-                self._outer._log.exception('Error while deleting {}: {}'.format(entity, e))
-                if self._on_error == OnError.reraise:
-                    raise
+    def _exit_steps(self, exc_type, exc_val, exc_tb):
+        '''
+        Upload or delete the entity, or handle an error.
 
+        Generator for :py:func:`~ckanext.importer.utils._run_steps`.
+        Returns whether an exception should be swallowed.
+        '''
+        entity = self._entity
         if exc_type is not None:
+            self._record('failed')
             if self._just_created:
                 # If the entity was created at the beginning of the context
                 # manager then it is deleted regardless of the on_error
                 # setting
                 self._outer._log.error('Newly created {} will not be kept due to an error: {}'.format(entity, exc_val),
                                        exc_info=(exc_type, exc_val, exc_tb))
-                delete()
-            elif self._on_error == OnError.delete:
+                yield from self._delete_entity_steps()
+            elif (self._on_error == OnError.delete
+                    and not _is_transient_error(exc_val)):
                 self._outer._log.error('Deleting existing {} due to an error: {}'.format(entity, exc_val),
                                        exc_info=(exc_type, exc_val, exc_tb))
-                delete()
+                yield from self._delete_entity_steps()
             else:
                 # OnError.keep and OnError.reraise
                 self._outer._log.error('Changes to {} will not be uploaded due to an error: {}'.format(entity, exc_val),
@@ -227,29 +321,173 @@ class EntitySyncManager(object):
             return self._on_error != OnError.reraise  # Swallow/reraise
         if entity._to_be_deleted:
             self._outer._log.debug('Deleting {}'.format(entity))
-            delete()
+            yield from self._delete_entity_steps()
+            self._record('deleted')
         elif entity._is_modified():
             self._outer._log.debug('Uploading {}'.format(entity))
             try:
-                entity._upload()
+                yield entity._upload
+                entity._mark_as_unmodified()
+                self._record('created' if self._just_created else 'updated')
             except Exception as e:
                 self._outer._log.exception('Error while uploading {}: {}'.format(entity, e))
+                self._record('failed')
                 if self._just_created:
                     self._outer._log.error('Newly created {} will not be kept after failed upload'.format(entity))
-                    delete()
-                elif self._on_error == OnError.delete:
+                    yield from self._delete_entity_steps()
+                elif (self._on_error == OnError.delete
+                        and not _is_transient_error(e)):
                     self._outer._log.error('Deleting {} after failed upload'.format(entity))
-                    delete()
+                    yield from self._delete_entity_steps()
                 if self._on_error == OnError.reraise:
                     raise
         else:
             self._outer._log.debug('{} has not been modified'.format(entity))
+            self._record('created' if self._just_created else 'unchanged')
+
+    def __enter__(self):
+        return _run_steps(self._enter_steps())
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        return _run_steps(self._exit_steps(exc_type, exc_val, exc_tb))
+
+
+class _ResourceSyncSteps(object):
+    '''
+    Logic of ``sync_resource`` that does not depend on how I/O is done.
+
+    Mixin for :py:class:`EntitySyncManager` and its asynchronous
+    counterpart.
+    '''
+    def _find_entity(self):
+        res_dict = self._outer._find_resource_dict(self._eid)
+        return self._outer._new_resource(self._eid, res_dict)
+
+    def _create_entity_steps(self):
+        if self._outer._imp.defer_resource_writes:
+            # The resource is created when the package is uploaded
+            res_dict = {'ckanext_importer_resource_eid': self._eid}
+        else:
+            res_dict = yield functools.partial(
+                self._outer._api.action.resource_create,
+                package_id=self._outer['id'],
+                ckanext_importer_resource_eid=self._eid,
+            )
+            self._outer._metadata_modified_is_outdated = True
+        self._outer._add_resource_dict(res_dict)
+        return self._outer._new_resource(self._eid, res_dict)
+
+    def _enter_steps(self):
+        self._defer = self._outer._imp.defer_resource_writes
+        if self._defer:
+            # Changes to the resource become changes of the package
+            self._outer._snapshot('resources')
+        else:
+            self._pkg_is_modified = self._outer._is_modified()
+        # Note: This call should use super(), but see https://stackoverflow.com/q/51860397/857390
+        return (yield from EntitySyncManager._enter_steps(self))
+
+    def _exit_steps(self, exc_type, exc_val, exc_tb):
+        # Note: This call should use super(), but see https://stackoverflow.com/q/51860397/857390
+        result = yield from EntitySyncManager._exit_steps(self, exc_type,
+                                                          exc_val, exc_tb)
+        if self._defer:
+            if (exc_type is not None
+                    and self._outer._has_resource_dict(self._entity._dict)):
+                # The resource has been kept, but its changes must not
+                # be uploaded with the package
+                self._entity._discard_changes()
+        elif not self._pkg_is_modified:
+            # If the package was previously unmodified then its
+            # resources are marked as unmodified again, since changes
+            # in the resource have already been uploaded (but their
+            # propagation to the package dict has marked the package
+            # as modified). Only the resources are reset, so that
+            # the other fields of the package are not copied again.
+            self._outer._forget('resources')
+        return result
+
+
+class _ViewSyncSteps(object):
+    '''
+    Logic of ``sync_view`` that does not depend on how I/O is done.
+
+    Mixin for :py:class:`EntitySyncManager` and its asynchronous
+    counterpart.
+    '''
+    def _find_entity_steps(self):
+        id = self._outer._find_view_id(self._eid)
+        yield from self._outer._get_view_dicts_steps()
+        view_dict = self._outer._get_cached_view_dict(id)
+        return self._outer._new_view(self._eid, view_dict)
+
+    def _create_entity(self):
+        return self._outer._new_view(self._eid, {})
 
 
 _PACKAGE_NAME_PREFIX = 'ckanext_importer_'
 
+_NUMBERED_PACKAGE_NAME_RE = re.compile(
+    '^' + re.escape(_PACKAGE_NAME_PREFIX) + r'(\d+)$')
+
+
+class _PackageNameAllocator(object):
+    '''
+    Allocates names for new packages.
+
+    By default, names are of the form ``ckanext_importer_<N>``. The
+    highest ``N`` in use has to be determined once (using
+    :py:meth:`needs_existing_names` and :py:meth:`add_existing_names`),
+    afterwards names are handed out from a thread-safe counter.
+
+    If ``hash_names`` is true then names are instead derived from a hash
+    of the importer ID and the package EID. These names are
+    deterministic and do not require knowledge about existing names.
+    '''
+    def __init__(self, hash_names=False):
+        self.hash_names = hash_names
+        self._next_number = None
+        self._lock = threading.Lock()
+
+    def needs_existing_names(self):
+        '''
+        Check if the existing package names need to be provided.
+        '''
+        return not self.hash_names and self._next_number is None
+
+    def add_existing_names(self, names):
+        '''
+        Make sure that no name from ``names`` is allocated.
+        '''
+        numbers = [int(m.group(1)) for m in
+                   (_NUMBERED_PACKAGE_NAME_RE.match(name) for name in names)
+                   if m]
+        with self._lock:
+            self._next_number = max([self._next_number or 0]
+                                    + [n + 1 for n in numbers])
+
+    def allocate(self, importer_id, eid, attempt=0):
+        '''
+        Allocate a name for a new package.
 
-def _search_packages(api, **kwargs):
+        ``attempt`` is the number of previous attempts to create the
+        package which have failed due to the name already being taken.
+        This can happen if another process created a package in the
+        meantime.
+        '''
+        if self.hash_names:
+            key = '{}\0{}'.format(importer_id, eid).encode('utf-8')
+            name = _PACKAGE_NAME_PREFIX + hashlib.sha1(key).hexdigest()
+            if attempt:
+                name += '_{}'.format(attempt)
+            return name
+        with self._lock:
+            number = self._next_number or 0
+            self._next_number = number + 1
+        return '{}{}'.format(_PACKAGE_NAME_PREFIX, number)
+
+
+def _search_packages(api, keyset=False, workers=1, **kwargs):
     '''
     Wrapper around CKAN's ``package_search`` to handle pagination.
 
@@ -260,17 +498,331 @@ def _search_packages(api, **kwargs):
     to control how many results are returned per call of
     ``package_search``. Note, however, that the ``start`` argument of
     ``package_search`` is automatically set by this function.
+
+    If ``keyset`` is true then the results are sorted by ID and each
+    page is requested by filtering for IDs after the last ID of the
+    previous page instead of using an offset. This keeps deep pages
+    cheap for Solr, and packages that are created or deleted during the
+    search do not shift the pages. The ``sort`` argument is ignored in
+    that case.
+
+    If ``workers`` is larger than 1 then pages are requested
+    concurrently using a pool of threads. With keyset pagination the ID
+    space is split into ranges that are searched concurrently.
+    Otherwise all pages after the first are requested concurrently once
+    the total number of results is known.
+
+    If ``fl`` is given then it must be a list of field names and only
+    these fields are returned. Requested ``extras_<key>`` fields are
+    converted back into an ``extras`` list, so that the results can be
+    used like (incomplete) package dicts.
+    '''
+    if keyset:
+        if workers > 1:
+            bounds = [None] + list(_KEYSET_PARTITION_BOUNDS) + [None]
+            pages = _run_concurrently(
+                [functools.partial(_search_id_range, api, lower, upper, kwargs)
+                 for lower, upper in zip(bounds[:-1], bounds[1:])],
+                workers)
+        else:
+            pages = _search_id_range(api, None, None, kwargs)
+    else:
+        pages = _search_offsets(api, workers, kwargs)
+    for page in pages:
+        for pkg_dict in page:
+            if kwargs.get('fl'):
+                _unflatten_extras(pkg_dict)
+            yield pkg_dict
+
+
+#: The ID space is split at these values for concurrent searches with
+#: keyset pagination. CKAN uses UUIDs as package IDs, so this splits the
+#: space into ranges of roughly equal size.
+_KEYSET_PARTITION_BOUNDS = '123456789abcdef'
+
+
+def _search_offsets(api, workers, kwargs):
     '''
-    kwargs['start'] = 0
+    Search for packages using offset pagination.
+
+    Yields pages of results, see :py:func:`_search_packages`.
+    '''
+    kwargs = dict(kwargs, start=0)
+    result = api.action.package_search(**kwargs)
+    yield result['results']
+    page_size = len(result['results'])
+    if not page_size or page_size == result['count']:
+        return
+    starts = range(page_size, result['count'], page_size)
+    if workers > 1:
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            futures = [executor.submit(api.action.package_search,
+                                       **dict(kwargs, start=start))
+                       for start in starts]
+            for future in futures:
+                yield future.result()['results']
+        return
+    for start in starts:
+        kwargs['start'] = start
+        result = api.action.package_search(**kwargs)
+        if not result['results']:
+            break
+        yield result['results']
+
+
+def _search_id_range(api, lower, upper, kwargs):
+    '''
+    Search for packages in an ID range using keyset pagination.
+
+    ``lower`` is the inclusive lower bound and ``upper`` the exclusive
+    upper bound of the ID range. ``None`` means unbounded.
+
+    Yields pages of results, see :py:func:`_search_packages`.
+    '''
+    kwargs = _keyset_kwargs(kwargs)
+    fq = kwargs.get('fq')
+    include_lower = True
     while True:
+        kwargs['fq'] = _id_range_fq(fq, lower, upper, include_lower)
         result = api.action.package_search(**kwargs)
-        for pkg_dict in result['results']:
-            yield pkg_dict
-        num_retrieved = len(result['results'])
-        if kwargs['start'] + num_retrieved == result['count']:
-            # All results have been retrieved
+        results = result['results']
+        if results:
+            yield results
+        if len(results) == result['count']:
+            # This was the last page
             break
-        kwargs['start'] += num_retrieved
+        lower = results[-1]['id']
+        include_lower = False
+
+
+def _keyset_kwargs(kwargs):
+    '''
+    Prepare the arguments of ``package_search`` for keyset pagination.
+
+    Returns a modified copy of ``kwargs``.
+    '''
+    kwargs = dict(kwargs, sort='id asc')
+    kwargs.pop('start', None)
+    if kwargs.get('fl') and 'id' not in kwargs['fl']:
+        kwargs['fl'] = list(kwargs['fl']) + ['id']
+    return kwargs
+
+
+def _id_range_fq(fq, lower, upper, include_lower=True):
+    '''
+    Restrict a Solr filter query to an ID range.
+
+    ``lower`` is the lower bound and ``upper`` the exclusive upper bound
+    of the ID range. ``None`` means unbounded. ``fq`` may be ``None``.
+    '''
+    if lower is None:
+        lower = '[*'
+    else:
+        lower = '{}"{}"'.format('[' if include_lower else '{',
+                                solr_escape(lower))
+    if upper is None:
+        upper = '*]'
+    else:
+        upper = '"{}"}}'.format(solr_escape(upper))
+    id_fq = 'id:{} TO {}'.format(lower, upper)
+    return '({}) AND {}'.format(fq, id_fq) if fq else id_fq
+
+
+def _run_concurrently(generator_funcs, workers):
+    '''
+    Run generator functions concurrently.
+
+    Each of the callables in ``generator_funcs`` is called without
+    arguments in a pool of ``workers`` threads and must return an
+    iterable. The items of these iterables are yielded in the order in
+    which the callables finish.
+    '''
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        futures = [executor.submit(lambda f=f: list(f()))
+                   for f in generator_funcs]
+        for future in as_completed(futures):
+            for item in future.result():
+                yield item
+
+
+def _unflatten_extras(pkg_dict):
+    '''
+    Convert ``extras_<key>`` fields of a search result into an extras list.
+
+    Modifies ``pkg_dict`` in-place.
+    '''
+    extras = pkg_dict.setdefault('extras', [])
+    for field in [f for f in pkg_dict if f.startswith('extras_')]:
+        extras.append({'key': field[len('extras_'):],
+                       'value': pkg_dict.pop(field)})
+
+
+#: Name of the CKAN plugin provided by ``ckanext.importer.plugin``.
+_PLUGIN_NAME = 'importer'
+
+#: Maps the keys of the importer's package extras to the names of the
+#: exact-match search fields that are added by the CKAN plugin.
+_EXACT_FIELDS = {
+    'ckanext_importer_importer_id': 'ckanext_importer_exact_importer_id',
+    'ckanext_importer_package_eid': 'ckanext_importer_exact_package_eid',
+}
+
+
+def _packages_fq(importer_id, eid=None, exact=False):
+    '''
+    Create a Solr filter query for the packages of an importer.
+
+    If ``eid`` is given then the query is restricted to packages with
+    that EID.
+
+    If ``exact`` is true then the exact-match fields added by the CKAN
+    plugin are used. Otherwise the query may match too many packages
+    and the results need to be filtered using
+    :py:func:`_is_matching_package`.
+    '''
+    extras = {
+        'ckanext_importer_importer_id': solr_escape(importer_id),
+    }
+    if eid is not None:
+        extras['ckanext_importer_package_eid'] = solr_escape(eid)
+    if exact:
+        fields = [(_EXACT_FIELDS[key], value) for key, value in extras.items()]
+    else:
+        fields = [('extras_' + key, value) for key, value in extras.items()]
+    return ' AND '.join('{}:"{}"'.format(*item) for item in fields)
+
+
+def _is_plugin_enabled(status):
+    '''
+    Check if the CKAN plugin is enabled.
+
+    ``status`` is the result of CKAN's ``status_show`` action.
+    '''
+    return _PLUGIN_NAME in status.get('extensions', [])
+
+
+def _exact_search_steps(api, importer_id):
+    '''
+    Check if an importer can use the exact-match search fields.
+
+    The fields can be used if the CKAN plugin is enabled and none of the
+    importer's packages has been indexed without them. The latter
+    happens if the search index has not been rebuilt after enabling the
+    plugin.
+
+    Yields the API calls, see ``ckanext.importer.utils._run_steps``.
+    '''
+    status = yield api.action.status_show
+    if not _is_plugin_enabled(status):
+        return False
+    result = yield functools.partial(
+        api.action.package_search,
+        fq='{} AND -{}:[* TO *]'.format(
+            _packages_fq(importer_id),
+            _EXACT_FIELDS['ckanext_importer_importer_id']),
+        rows=0, include_private=True)
+    return result['count'] == 0
+
+
+def _is_matching_package(pkg_dict, importer_id, eid=None):
+    '''
+    Check if a package dict belongs to an importer.
+
+    If ``eid`` is given then the package must also have that EID.
+    '''
+    # CKAN's search is based on Solr, which by default doesn't support
+    # searching for exact matches. Hence searching for importer ID "x"
+    # can also return packages with importer ID "x-y". Hence we filter
+    # the results again.
+    pkg_importer_id, pkg_eid = _get_extras(
+        pkg_dict, 'ckanext_importer_importer_id', 'ckanext_importer_package_eid')
+    if pkg_importer_id != importer_id:
+        return False
+    if eid is not None and pkg_eid != eid:
+        return False
+    return True
+
+
+def _get_extras(pkg_dict, *keys):
+    '''
+    Get the values of some package extras.
+
+    Unlike :py:class:`ExtrasDictView` this does not build an index and
+    stops as soon as all keys have been found, which makes it cheaper
+    for reading a few extras of many packages.
+
+    Returns a list containing the value of the first extra for each
+    key, or ``None`` if no extra with that key exists.
+    '''
+    remaining = set(keys)
+    values = {}
+    for extra in pkg_dict.get('extras', ()):
+        key = extra['key']
+        if key in remaining:
+            values[key] = extra['value']
+            remaining.remove(key)
+            if not remaining:
+                break
+    return [values.get(key) for key in keys]
+
+
+def _get_package_eid(pkg_dict):
+    '''
+    Get the EID of a package from its package dict.
+    '''
+    return _get_extras(pkg_dict, 'ckanext_importer_package_eid')[0]
+
+
+#: Maximum number of packages that are deleted using a single call of
+#: ``bulk_update_delete``.
+_BULK_DELETE_BATCH_SIZE = 100
+
+
+def _bulk_delete_batches(pkgs):
+    '''
+    Split packages into batches for ``bulk_update_delete``.
+
+    All packages in a batch belong to the same organization. Packages
+    without organization are put into batches of size 1.
+    '''
+    by_org = collections.OrderedDict()
+    batches = []
+    for pkg in pkgs:
+        org_id = pkg._dict.get('owner_org')
+        if org_id:
+            by_org.setdefault(org_id, []).append(pkg)
+        else:
+            batches.append([pkg])
+    for org_pkgs in by_org.values():
+        for i in range(0, len(org_pkgs), _BULK_DELETE_BATCH_SIZE):
+            batches.append(org_pkgs[i:i + _BULK_DELETE_BATCH_SIZE])
+    return batches
+
+
+#: Fields that are needed for deleting packages.
+_DELETION_FIELDS = ['id', 'name', 'owner_org']
+
+
+#: Result of :py:meth:`Importer.delete_unsynced_packages`.
+#:
+#: ``deleted`` is a list of the EIDs of the deleted packages and
+#: ``failed`` is a dict that maps the EIDs of the packages that could not
+#: be deleted to the corresponding exceptions.
+DeletionReport = collections.namedtuple('DeletionReport',
+                                        ['deleted', 'failed'])
+
+
+def _first_exception(futures):
+    '''
+    Return the first exception raised by a set of finished futures.
+
+    Returns ``None`` if none of the futures raised an exception.
+    '''
+    for future in futures:
+        exception = future.exception()
+        if exception is not None:
+            return exception
+    return None
 
 
 class Importer(object):
@@ -293,7 +845,95 @@ class Importer(object):
     field of packages created via :py:meth:`.sync_package` and can be
     either the name or the ID of an existing CKAN organization.
 
-    .. automethod:: sync_package(eid, on_error=OnError.reraise)
+    If ``prefetch`` is true then all packages belonging to this importer
+    are retrieved using a single (paginated) search the first time a
+    package is looked up. Subsequent lookups in :py:meth:`.sync_package`
+    and :py:meth:`.delete_unsynced_packages` are answered from that
+    in-memory index instead of issuing a separate search per EID.
+    Packages created during the run are added to the index, so lookups
+    do not depend on CKAN's search index being up-to-date. Prefetching
+    is recommended if most of the importer's packages are synced during
+    a run and assumes that the importer's packages are not modified by
+    other means while the :py:class:`Importer` instance is in use.
+
+    By default, new packages are named ``ckanext_importer_<N>``, where
+    ``N`` is a running number. The highest number in use is determined
+    using a single search when the first package is created. If
+    ``hash_names`` is true then names are instead derived from a hash of
+    the importer ID and the package EID, which doesn't require that
+    search.
+
+    ``upload_mode`` is an instance of :py:class:`UploadMode` and controls
+    whether modified packages and resources are uploaded completely or
+    whether only the modified fields are sent to CKAN.
+
+    ``state`` is an optional :py:class:`~ckanext.importer.state.StateStore`
+    in which the IDs and fingerprints of synced packages are persisted.
+    Packages with a stored ID are retrieved directly instead of being
+    searched for, and :py:meth:`skip_if_unchanged` uses the stored
+    fingerprints without contacting CKAN at all. Stored entries are
+    invalidated automatically when they turn out to be outdated.
+    Packages that are modified in CKAN by other means are detected when
+    they are synced again or when :py:meth:`verify_state` is called.
+
+    ``exact_search`` controls whether packages are searched using the
+    exact-match fields provided by the CKAN plugin ``importer`` (see
+    :ref:`plugin`). If it is ``None`` (the default) then the fields are
+    used if the plugin is enabled on the CKAN instance and all of the
+    importer's packages have been indexed with them. This is checked
+    when the first search is made.
+
+    Searches that retrieve all of the importer's packages (for example
+    when prefetching or in :py:meth:`delete_unsynced_packages`) are
+    split into ID ranges that are searched concurrently using up to
+    ``search_workers`` threads.
+
+    The importer records the number and the duration of its CKAN API
+    calls as well as the results of its entity syncs in ``metrics``, an
+    instance of :py:class:`~ckanext.importer.metrics.Metrics`. See
+    :py:meth:`stats`.
+
+    If ``defer_resource_writes`` is true then changes to resources
+    (including the creation and deletion of resources) are not uploaded
+    individually. Instead, they are uploaded together with the changes
+    of their package in a single request once
+    :py:meth:`sync_package` exits. This avoids that CKAN validates and
+    reindexes the package once for each changed resource. New resources
+    only receive their ID when the package is uploaded. If a view is
+    created for such a resource then the package is uploaded early.
+
+    ``plan`` is an optional :py:class:`~ckanext.importer.plan.Plan`. If
+    it is given then the importer runs in plan mode: CKAN is read as
+    usual, but creations, updates, and deletions of packages and views
+    are recorded in the plan instead of being performed (see
+    :ref:`plan-mode`). Resource writes are always deferred in plan mode.
+
+    ``throttle`` is an optional
+    :py:class:`~ckanext.importer.throttle.Throttle` that limits the rate
+    and the concurrency of all API calls made by the importer and its
+    entities. The recorded metrics contain the time spent in CKAN, not
+    the time spent waiting for the throttle.
+
+    ``journal`` is an optional
+    :py:class:`~ckanext.importer.journal.Journal` in which the EIDs of
+    created, synced, and deleted packages are recorded. If the journal
+    contains events of an interrupted run then that run is resumed, see
+    :py:meth:`skip_if_done`.
+
+    ``shard`` is an optional tuple ``(index, num_shards)``. If it is given
+    then the importer only handles the EIDs that belong to the shard with
+    the given index (see :py:meth:`owns`), so that the packages of one
+    importer ID can be synced by ``num_shards`` processes or machines.
+    Sharded importers cannot delete unsynced packages themselves, use a
+    :py:class:`~ckanext.importer.shard.ShardCoordinator` instead.
+
+    If ``database_reads`` is true then the importer's packages are looked
+    up directly in CKAN's database instead of using ``package_search``,
+    see :py:class:`~ckanext.importer.db.DatabaseReader`. Lookups then do
+    not depend on Solr and always see the latest changes. This requires
+    that ``api`` is a ``ckanapi.LocalCKAN`` instance.
+
+    .. automethod:: sync_package(eid, on_error=OnError.reraise, fingerprint=None)
 
        Sync a package.
 
@@ -310,6 +950,33 @@ class Importer(object):
 
        `on_error` is an instance of :py:class:`OnError` and controls how
        exceptions inside the context manager are handled.
+
+       `fingerprint` is an optional fingerprint of the package's source
+       record (for example a hash or a version string). If it is given
+       then it is stored along with the package when the context manager
+       exits without an error, see :py:meth:`skip_if_unchanged`.
+
+    .. automethod:: bulk_session(batch_size=100)
+
+       Defer CKAN's search indexing until the end of a bulk import.
+
+       This is a context manager. While it is active, CKAN does not
+       reindex packages when they are modified. Instead, the packages
+       that are created, modified, or deleted by this importer are
+       reindexed once the context manager exits, in batches of
+       ``batch_size`` packages.
+
+       Since CKAN's search index is outdated during the session, the
+       importer's packages are looked up in the prefetched in-memory
+       index (see ``prefetch``), which is built when the session starts.
+       If ``database_reads`` is enabled then lookups use the database
+       instead.
+
+       Automatic indexing is disabled for the whole CKAN process, so
+       packages that are modified by other means during the session are
+       not reindexed. Bulk sessions therefore require
+       ``ckanapi.LocalCKAN`` and should not be used in a process that
+       serves web requests.
     '''
 
     class _PrefixLoggerAdapter(logging.LoggerAdapter):
@@ -323,15 +990,60 @@ class Importer(object):
         def process(self, msg, kwargs):
             return self.extra['prefix'] + msg, kwargs
 
-    def __init__(self, id, api=None, default_owner_org=None):
+    def __init__(self, id, api=None, default_owner_org=None,
+                 prefetch=False, hash_names=False,
+                 upload_mode=UploadMode.update, state=None,
+                 defer_resource_writes=False, exact_search=None,
+                 search_workers=1, plan=None, throttle=None, journal=None,
+                 shard=None, database_reads=False):
         self.id = str(id)
-        self._api = api or ckanapi.LocalCKAN()
+        if not isinstance(upload_mode, UploadMode):
+            raise TypeError('upload_mode must be of type UploadMode')
+        self.upload_mode = upload_mode
+        self.metrics = Metrics(labels={'importer': self.id})
+        self._api = InstrumentedAPI(api or ckanapi.LocalCKAN(), self.metrics)
+        self.throttle = throttle
+        if throttle is not None:
+            self._api = ThrottledAPI(self._api, throttle)
+        if database_reads:
+            # Imported here since it requires CKAN's model, which is only
+            # available inside of CKAN
+            from .db import DatabaseReader
+            self._db = DatabaseReader(self._api, self.metrics)
+        else:
+            self._db = None
         self.default_owner_org = default_owner_org
+        self.prefetch = prefetch
+        self.state = state
+        self.plan = plan
+        # In plan mode, resource changes are recorded as part of their
+        # package's changes
+        self.defer_resource_writes = defer_resource_writes or plan is not None
+        self.exact_search = exact_search
+        self.search_workers = search_workers
+        self.journal = journal
+        if shard is not None:
+            index, num_shards = shard
+            if not 0 <= index < num_shards:
+                raise ValueError('Invalid shard {!r}'.format(shard))
+            shard = (index, num_shards)
+        self.shard = shard
+        self._delta = False
+        self._index = None
+        # IDs of the packages touched during a bulk session
+        self._bulk_ids = None
         self._synced_child_eids = set()
+        if journal is not None:
+            # Packages that were synced before the run was interrupted
+            # must not be deleted as unsynced
+            self._synced_child_eids.update(journal.done_eids(self.id))
+        self._lock = threading.RLock()
+        self._names = _PackageNameAllocator(hash_names)
         self._log = Importer._PrefixLoggerAdapter(
             logging.getLogger(__name__), 'Importer {!r}: '.format(self.id))
 
-    def delete_unsynced_packages(self):
+    def delete_unsynced_packages(self, workers=1, max_deletions=None,
+                                 purge=True):
         '''
         Delete packages that have not been synced.
 
@@ -343,26 +1055,491 @@ class Importer(object):
         synced to delete those CKAN packages corresponding to objects
         that have been removed from the data source since the last
         import.
+
+        The unsynced packages are determined first and then deleted
+        using a pool of up to ``workers`` threads.
+
+        ``max_deletions`` is an optional safety limit: if more packages
+        would be deleted then a ``RuntimeError`` is raised and no package
+        is deleted. This protects against accidentally deleting large
+        parts of the catalog, for example after an outage of the data
+        source.
+
+        If ``purge`` is true (the default) then the packages are purged.
+        Otherwise they are only marked as deleted, using CKAN's
+        ``bulk_update_delete`` action for the packages of each
+        organization. Note that the names of deleted packages remain in
+        use until the packages are purged.
+
+        Errors while deleting individual packages are logged, but do not
+        stop the deletion of the remaining packages.
+
+        Returns a :py:class:`DeletionReport`.
+
+        Raises a ``RuntimeError`` if :py:meth:`sync_delta` has been used
+        or if the importer is a shard, since the importer then hasn't
+        seen all records of the data source.
         '''
-        for pkg_dict in self._find_packages():
-            extras = ExtrasDictView(pkg_dict['extras'])
-            eid = extras['ckanext_importer_package_eid']
-            if eid not in self._synced_child_eids:
-                pkg = Package(eid, pkg_dict, self)
-                self._log.debug('Deleting unsynced {}'.format(pkg))
+        if self._delta:
+            raise RuntimeError('delete_unsynced_packages cannot be used after sync_delta, '
+                               'use the tombstones of sync_delta instead')
+        if self.shard is not None:
+            raise RuntimeError('delete_unsynced_packages cannot be used by a shard, '
+                               'use a ShardCoordinator instead')
+        if self.prefetch:
+            with self._lock:
+                pkg_dicts = [pkg_dict
+                             for pkg_dicts in self._get_index().values()
+                             for pkg_dict in pkg_dicts]
+        else:
+            # Collect all packages before deleting any of them. Only
+            # the fields that are needed for deleting them are retrieved.
+            pkg_dicts = list(self._find_packages(fl=_DELETION_FIELDS))
+        with self._lock:
+            synced_eids = set(self._synced_child_eids)
+        pkgs = []
+        for pkg_dict in pkg_dicts:
+            eid = _get_package_eid(pkg_dict)
+            if eid not in synced_eids:
+                pkgs.append(Package(eid, pkg_dict, self))
+        if max_deletions is not None and len(pkgs) > max_deletions:
+            raise RuntimeError('Refusing to delete {} unsynced packages of {} (max_deletions is {})'.format(
+                               len(pkgs), self, max_deletions))
+        report = self._delete_package_list(pkgs, workers, purge)
+        self._log.info('Deleted {} unsynced packages ({} failures)'.format(
+                       len(report.deleted), len(report.failed)))
+        return report
+
+    def delete_packages(self, eids, workers=1, purge=True):
+        '''
+        Delete the packages with the given EIDs.
+
+        Unlike :py:meth:`delete_unsynced_packages`, this method does not
+        search for all of the importer's packages. Instead, the package
+        for each EID is looked up separately, using up to ``workers``
+        threads. This is intended for data sources that report deleted
+        records explicitly (as "tombstones"), see :py:meth:`sync_delta`.
+
+        EIDs for which no package exists are ignored. ``purge`` is as for
+        :py:meth:`delete_unsynced_packages`.
+
+        Returns a :py:class:`DeletionReport`.
+        '''
+        def find(eid):
+            try:
+                return Package(eid, self._find_package(eid), self)
+            except NotFound:
+                return None
+
+        eids = [str(eid) for eid in eids]
+        report = DeletionReport([], {})
+        pkgs = []
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            futures = [(executor.submit(find, eid), eid) for eid in eids]
+            for future, eid in futures:
+                exception = future.exception()
+                if exception is not None:
+                    self._log.error('Error while looking up package with EID {!r}: {}'.format(eid, exception))
+                    report.failed[eid] = exception
+                    self.metrics.record_entity('package', 'failed')
+                elif future.result() is not None:
+                    pkgs.append(future.result())
+        deleted = self._delete_package_list(pkgs, workers, purge)
+        report.deleted.extend(deleted.deleted)
+        report.failed.update(deleted.failed)
+        self._log.info('Deleted {} of {} packages ({} failures)'.format(
+                       len(report.deleted), len(eids), len(report.failed)))
+        return report
+
+    def sync_delta(self, items, tombstones, sync_fn, workers=1,
+                   on_error=OnError.reraise, fingerprint=None, purge=True):
+        '''
+        Sync the changes of a data source since the last run.
+
+        ``items`` are the ``(eid, item)`` pairs of the records that have
+        been created or modified since the last run. They are synced
+        using :py:meth:`sync_many`, see there for ``sync_fn``,
+        ``workers``, ``on_error``, and ``fingerprint``.
+
+        ``tombstones`` are the EIDs of the records that have been deleted
+        since the last run. The corresponding packages are deleted using
+        :py:meth:`delete_packages`, see there for ``purge``. Tombstones
+        for EIDs that have been synced during this run are ignored.
+
+        The cost of a delta sync is proportional to the number of
+        changes, not to the number of packages. Afterwards,
+        :py:meth:`delete_unsynced_packages` cannot be used anymore.
+        Prefetching should be disabled, since it retrieves all of the
+        importer's packages.
+
+        Returns the :py:class:`DeletionReport` for the tombstones.
+        '''
+        self._delta = True
+        self.sync_many(items, sync_fn, workers=workers, on_error=on_error,
+                       fingerprint=fingerprint)
+        with self._lock:
+            synced_eids = set(self._synced_child_eids)
+        eids = []
+        for eid in tombstones:
+            eid = str(eid)
+            if eid in synced_eids:
+                self._log.warning('Ignoring tombstone for synced package with EID {!r}'.format(eid))
+            else:
+                eids.append(eid)
+        return self.delete_packages(eids, workers=workers, purge=purge)
+
+    def _delete_package_list(self, pkgs, workers, purge):
+        '''
+        Delete packages using a pool of up to ``workers`` threads.
+
+        Errors are logged and recorded in the returned
+        :py:class:`DeletionReport`.
+        '''
+        if purge:
+            batches = [[pkg] for pkg in pkgs]
+        else:
+            batches = _bulk_delete_batches(pkgs)
+
+        report = DeletionReport([], {})
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            futures = [(executor.submit(self._delete_packages, batch, purge),
+                        batch) for batch in batches]
+            for future, batch in futures:
+                exception = future.exception()
+                for pkg in batch:
+                    if exception is None:
+                        report.deleted.append(pkg._eid)
+                        self.metrics.record_entity('package', 'deleted')
+                        self._journal('deleted', pkg._eid)
+                    else:
+                        self._log.error('Error while deleting {}: {}'.format(pkg, exception))
+                        report.failed[pkg._eid] = exception
+                        self.metrics.record_entity('package', 'failed')
+        return report
+
+    def _delete_packages(self, pkgs, purge):
+        '''
+        Delete a batch of packages.
+
+        If ``purge`` is true then each package is purged separately.
+        Otherwise all packages are marked as deleted using a single call
+        of ``bulk_update_delete`` and must therefore belong to the same
+        organization. Packages that do not belong to an organization are
+        deleted separately.
+
+        In plan mode, the deletions are only recorded.
+        '''
+        if self.plan is not None:
+            for pkg in pkgs:
+                self.plan._record_package_deletion(pkg, purge)
+                pkg._mark_as_deleted()
+            return
+        for pkg in pkgs:
+            self._touch(pkg)
+        if purge:
+            for pkg in pkgs:
+                self._log.debug('Deleting {}'.format(pkg))
                 pkg._delete()
+            return
+        org_id = pkgs[0]._dict.get('owner_org')
+        if org_id:
+            self._log.debug('Deleting {} packages of organization {!r}'.format(len(pkgs), org_id))
+            self._api.action.bulk_update_delete(
+                datasets=[pkg._dict['id'] for pkg in pkgs], org_id=org_id)
+        else:
+            for pkg in pkgs:
+                self._log.debug('Deleting {}'.format(pkg))
+                self._api.action.package_delete(id=pkg._dict['id'])
+        for pkg in pkgs:
+            pkg._mark_as_deleted()
+
+    def skip_if_unchanged(self, eid, fingerprint):
+        '''
+        Skip a package if its source record has not changed.
+
+        ``eid`` is the EID of the package and ``fingerprint`` is the
+        current fingerprint of its source record, see
+        :py:meth:`.sync_package`.
+
+        If a package with the given EID exists and the fingerprint stored
+        for it is equal to ``fingerprint`` then the package is marked as
+        synced (so that it is not removed by
+        :py:meth:`.delete_unsynced_packages`) and ``True`` is returned.
+        Otherwise ``False`` is returned and the package should be synced
+        as usual::
+
+            for record in source:
+                if imp.skip_if_unchanged(record.id, record.version):
+                    continue
+                with imp.sync_package(record.id,
+                                      fingerprint=record.version) as pkg:
+                    pkg['title'] = record.title
+
+        Finding the package requires a search unless ``prefetch`` is
+        enabled or ``state`` is used.
+        '''
+        eid = str(eid)
+        if self.skip_if_done(eid):
+            return True
+        entry = None
+        if self.state is not None and not self.prefetch:
+            entry = self.state.get(self.id, eid)
+        if entry is not None:
+            stored = entry.fingerprint
+        else:
+            try:
+                pkg_dict = self._find_package(eid)
+            except NotFound:
+                return False
+            stored = _get_extras(pkg_dict,
+                                 'ckanext_importer_package_fingerprint')[0]
+        if stored is None or stored != str(fingerprint):
+            return False
+        self._log.debug('Skipping unchanged package with EID {!r}'.format(eid))
+        with self._lock:
+            self._synced_child_eids.add(eid)
+        self.metrics.record_entity('package', 'unchanged')
+        self._journal('synced', eid)
+        return True
+
+    def skip_if_done(self, eid):
+        '''
+        Skip a package that has already been synced in a resumed run.
+
+        Returns ``True`` if the ``journal`` records that the package with
+        the given EID has already been synced or deleted during the
+        current run, and ``False`` otherwise (in particular, if no
+        journal is used). Packages for which ``True`` is returned are not
+        removed by :py:meth:`.delete_unsynced_packages`::
+
+            for record in source:
+                if imp.skip_if_done(record.id):
+                    continue
+                with imp.sync_package(record.id) as pkg:
+                    pkg['title'] = record.title
+
+        :py:meth:`sync_many` and :py:meth:`skip_if_unchanged` call this
+        method automatically.
+        '''
+        if self.journal is None:
+            return False
+        return self.journal.is_done(self.id, str(eid))
+
+    def owns(self, eid):
+        '''
+        Check if an EID belongs to this importer's shard.
+
+        Always returns ``True`` if the importer is not sharded.
+        '''
+        if self.shard is None:
+            return True
+        index, num_shards = self.shard
+        return get_shard(eid, num_shards) == index
+
+    @context_manager_method
+    class bulk_session(object):
+        # Documentation is in the class docstring
+        def __init__(self, batch_size=100):
+            self._batch_size = batch_size
+
+        def __enter__(self):
+            imp = self._outer
+            if not isinstance(_unwrap_api(imp._api), ckanapi.LocalCKAN):
+                raise ValueError('Bulk sessions require ckanapi.LocalCKAN')
+            with imp._lock:
+                if imp._bulk_ids is not None:
+                    raise RuntimeError('{} is already in a bulk session'.format(imp))
+                imp._bulk_ids = set()
+                self._prefetch = imp.prefetch
+                try:
+                    if imp._db is None:
+                        # The search index is up-to-date now, but not
+                        # during the session
+                        imp.prefetch = True
+                        imp._get_index()
+                    # Imported here since it requires CKAN, see
+                    # Importer.__init__
+                    from .indexing import suppress_indexing
+                    suppress_indexing()
+                except Exception:
+                    # Leave the importer as it was before the session
+                    imp._bulk_ids = None
+                    if not self._prefetch and imp.prefetch:
+                        imp.prefetch = False
+                        imp._index = None
+                    raise
+            imp._log.info('Started bulk session')
+            return imp
+
+        def __exit__(self, exc_type, exc_val, exc_tb):
+            from .indexing import reindex_packages, restore_indexing
+            imp = self._outer
+            restore_indexing()
+            with imp._lock:
+                package_ids = sorted(imp._bulk_ids)
+                imp._bulk_ids = None
+                if not self._prefetch and imp.prefetch:
+                    imp.prefetch = False
+                    imp._index = None
+            # The packages are reindexed even if an error occurred,
+            # since the changes before the error have been made
+            try:
+                reindex_packages(package_ids, self._batch_size)
+            except Exception as e:
+                if exc_type is None:
+                    raise
+                imp._log.error('Error while reindexing {} packages: {}'.format(
+                               len(package_ids), e))
+            else:
+                imp._log.info('Reindexed {} packages at the end of the bulk session'.format(
+                              len(package_ids)))
+
+    def _touch(self, pkg):
+        '''
+        Remember that a package has been modified during a bulk session.
+
+        Does nothing if no bulk session is active.
+        '''
+        package_id = pkg._dict.get('id')
+        if self._bulk_ids is None or package_id is None:
+            return
+        with self._lock:
+            if self._bulk_ids is not None:
+                self._bulk_ids.add(package_id)
+
+    def _journal(self, event, eid):
+        '''
+        Record an event in the journal.
+
+        Does nothing if no journal is used.
+        '''
+        if self.journal is not None:
+            self.journal.record(self.id, event, eid)
+
+    def stats(self):
+        '''
+        Get the metrics of this importer.
+
+        Returns a dict with the number and the duration of this
+        importer's CKAN API calls (per action and outcome) and the
+        results of its entity syncs (per entity type), see
+        :py:meth:`ckanext.importer.metrics.Metrics.stats`.
+        '''
+        return self.metrics.stats()
+
+    def verify_state(self):
+        '''
+        Verify the stored state of this importer's packages.
+
+        Compares the entries in ``state`` (see :py:class:`Importer`) with
+        the current packages in CKAN using a single search. Entries for
+        packages that no longer exist are removed, and the stored
+        fingerprints of packages that have been modified since they were
+        last synced are invalidated.
+        '''
+        if self.state is None:
+            raise ValueError('{} has no state store'.format(self))
+        pkg_dicts = {}
+        for pkg_dict in self._find_packages():
+            pkg_dicts[_get_package_eid(pkg_dict)] = pkg_dict
+        for eid, entry in self.state.entries(self.id).items():
+            pkg_dict = pkg_dicts.get(eid)
+            if pkg_dict is None or pkg_dict['id'] != entry.package_id:
+                self._log.debug('Removing outdated state for EID {!r}'.format(eid))
+                self.state.remove(self.id, eid)
+            elif pkg_dict['metadata_modified'] != entry.metadata_modified:
+                self._log.debug('Invalidating stored fingerprint for EID {!r}'.format(eid))
+                self.state.put(self.id, eid, entry.package_id)
+        self.state.commit()
+
+    def sync_many(self, items, sync_fn, workers=1, on_error=OnError.reraise,
+                  fingerprint=None):
+        '''
+        Sync many packages, optionally in parallel.
+
+        ``items`` is an iterable of ``(eid, item)`` pairs. For each pair,
+        ``sync_fn(pkg, item)`` is called inside
+        :py:meth:`.sync_package` for the given EID, where ``pkg`` is the
+        corresponding :py:class:`Package`. The EIDs must be unique. If
+        the importer is sharded then items that belong to other shards
+        are skipped.
+
+        ``workers`` is the maximum number of packages that are synced
+        concurrently using a pool of threads. ``sync_fn`` is called from
+        these threads, and the importer's ``api`` must therefore be safe
+        to use from several threads at once (as is, for example, the
+        case for ``ckanapi.RemoteCKAN``) if ``workers`` is larger than 1.
+
+        ``on_error`` is passed on to :py:meth:`.sync_package`. If it is
+        :py:attr:`OnError.reraise` then no new packages are synced after
+        the first error, and that error is reraised once the packages
+        that are already in progress have been synced. Errors that occur
+        while preparing a package are always reraised, see
+        :py:meth:`.sync_package`.
+
+        ``fingerprint`` is an optional callable that returns the
+        fingerprint of an item. If it is given then ``sync_fn`` is only
+        called for items whose fingerprint has changed, see
+        :py:meth:`.skip_if_unchanged`.
+
+        Afterwards, :py:meth:`.delete_unsynced_packages` can be used as
+        usual.
+        '''
+        def sync(eid, item):
+            if not self.owns(eid) or self.skip_if_done(eid):
+                return
+            fp = None
+            if fingerprint is not None:
+                fp = fingerprint(item)
+                if self.skip_if_unchanged(eid, fp):
+                    return
+            with self.sync_package(eid, on_error=on_error,
+                                   fingerprint=fp) as pkg:
+                sync_fn(pkg, item)
+
+        if self.prefetch:
+            # Build the index before the threads start competing for it
+            self._get_index()
+        error = None
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            pending = set()
+            for eid, item in items:
+                if len(pending) >= 2 * workers:
+                    # Limit the number of queued items to keep memory
+                    # usage bounded for large inputs
+                    done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                    error = error or _first_exception(done)
+                    if error is not None:
+                        break
+                pending.add(executor.submit(sync, eid, item))
+            done, _ = wait(pending)
+            error = error or _first_exception(done)
+        if error is not None:
+            raise error
 
     @context_manager_method
     class sync_package(EntitySyncManager):
         # Documentation is in the class docstring
+        def __init__(self, eid, on_error=OnError.reraise, fingerprint=None):
+            # Note: This call should use super(), but see https://stackoverflow.com/q/51860397/857390
+            EntitySyncManager.__init__(self, eid, on_error)
+            if not self._outer.owns(self._eid):
+                raise ValueError('EID {!r} does not belong to shard {} of {}'.format(
+                                 self._eid, self._outer.shard, self._outer))
+            if fingerprint is not None:
+                fingerprint = str(fingerprint)
+            self._fingerprint = fingerprint
+
         def _find_entity(self):
             pkg_dict = self._outer._find_package(self._eid)
             return Package(self._eid, pkg_dict, self._outer)
 
         def _create_entity(self):
-            i = 0
+            if self._outer.plan is not None:
+                return self._plan_entity()
+            attempt = 0
             while True:
-                name = '{}{}'.format(_PACKAGE_NAME_PREFIX, i)
+                name = self._outer._new_package_name(self._eid, attempt)
                 try:
                     pkg_dict = self._outer._api.action.package_create(
                         name=name,
@@ -376,41 +1553,228 @@ class Importer(object):
                     )
                 except ckanapi.ValidationError as e:
                     if 'name' in e.error_dict:
-                        # Duplicate name
-                        i += 1
+                        # The name has been taken in the meantime
+                        self._outer._log.debug('Package name {!r} is already taken'.format(name))
+                        attempt += 1
                         continue
                     raise
+                self._outer._add_to_index(self._eid, pkg_dict)
+                self._outer._journal('created', self._eid)
                 return Package(self._eid, pkg_dict, self._outer)
 
-    def _find_packages(self, eid=None):
+        def _plan_entity(self):
+            '''
+            Create a new package in plan mode.
+
+            The package is only created locally. Its fields are set via
+            the package so that they are part of its changes.
+            '''
+            pkg = Package(self._eid, {'extras': [], 'resources': []},
+                          self._outer)
+            pkg['name'] = self._outer._new_package_name(self._eid, 0)
+            pkg['owner_org'] = self._outer.default_owner_org
+            pkg.extras['ckanext_importer_importer_id'] = self._outer.id
+            pkg.extras['ckanext_importer_package_eid'] = self._eid
+            self._outer._add_to_index(self._eid, pkg._dict)
+            return pkg
+
+        def __exit__(self, exc_type, exc_val, exc_tb):
+            if exc_type is None and self._fingerprint is not None:
+                extras = self._entity.extras
+                key = 'ckanext_importer_package_fingerprint'
+                if extras.get(key) != self._fingerprint:
+                    extras[key] = self._fingerprint
+            try:
+                # Note: This call should use super(), but see https://stackoverflow.com/q/51860397/857390
+                result = EntitySyncManager.__exit__(self, exc_type, exc_val,
+                                                    exc_tb)
+            finally:
+                self._outer._update_index(self._entity)
+                self._outer._update_state(self._entity)
+                # The package's resources may have been modified even if
+                # the package itself is unchanged
+                if (self._result != 'unchanged'
+                        or self._entity._metadata_modified_is_outdated):
+                    self._outer._touch(self._entity)
+            if self._result == 'deleted':
+                self._outer._journal('deleted', self._eid)
+            elif self._result != 'failed':
+                self._outer._journal('synced', self._eid)
+            return result
+
+    def _new_package_name(self, eid, attempt):
+        '''
+        Allocate a name for a new package.
+
+        See ``_PackageNameAllocator.allocate``.
+        '''
+        if self._names.needs_existing_names():
+            with self._lock:
+                if self._names.needs_existing_names():
+                    if self._db is not None:
+                        names = self._db.find_names(_PACKAGE_NAME_PREFIX)
+                    else:
+                        names = (pkg_dict['name'] for pkg_dict in _search_packages(
+                                 self._api, keyset=True, workers=self.search_workers,
+                                 fq='name:{}*'.format(_PACKAGE_NAME_PREFIX),
+                                 fl=['name'], rows=1000, include_private=True))
+                    self._names.add_existing_names(names)
+        return self._names.allocate(self.id, eid, attempt)
+
+    def _get_index(self):
+        '''
+        Get the index of this importer's packages.
+
+        The index maps EIDs to lists of package dicts. It is built using
+        a single search for all of the importer's packages the first
+        time this method is called.
+        '''
+        with self._lock:
+            if self._index is None:
+                index = {}
+                for pkg_dict in self._find_packages():
+                    eid = _get_package_eid(pkg_dict)
+                    if self.owns(eid):
+                        index.setdefault(eid, []).append(pkg_dict)
+                self._log.debug('Prefetched {} packages'.format(
+                                sum(len(pkg_dicts) for pkg_dicts in index.values())))
+                self._index = index
+            return self._index
+
+    def _add_to_index(self, eid, pkg_dict):
+        '''
+        Add a package dict to the index.
+
+        Does nothing if prefetching is disabled.
+        '''
+        if self.prefetch:
+            with self._lock:
+                self._get_index().setdefault(eid, []).append(pkg_dict)
+
+    def _remove_from_index(self, eid, pkg_dict):
+        '''
+        Remove a package dict from the index.
+
+        Does nothing if prefetching is disabled or if the package dict
+        is not indexed.
+        '''
+        if self._index is None:
+            return
+        with self._lock:
+            pkg_dicts = [d for d in self._index.get(eid, [])
+                         if d is not pkg_dict]
+            if pkg_dicts:
+                self._index[eid] = pkg_dicts
+            else:
+                self._index.pop(eid, None)
+
+    def _update_index(self, pkg):
+        '''
+        Update the index after a package has been synced.
+
+        If the package still contains modifications that have not been
+        uploaded (for example due to an error) then the index entry is
+        reset to the package's last known state in CKAN.
+        '''
+        if self._index is None or not pkg._is_modified():
+            return
+        with self._lock:
+            pkg_dicts = self._index.get(pkg._eid, [])
+            for i, pkg_dict in enumerate(pkg_dicts):
+                if pkg_dict is pkg._dict:
+                    pkg_dicts[i] = pkg._get_original()
+
+    def _update_state(self, pkg):
+        '''
+        Update the state store after a package has been synced.
+
+        Does nothing if no state store is used or in plan mode.
+        '''
+        if self.state is None or self.plan is not None:
+            return
+        if pkg._deleted:
+            self.state.remove(self.id, pkg._eid)
+        elif not pkg._is_modified():
+            # Changes to the package's resources also update its
+            # metadata_modified timestamp in CKAN, but not in our copy
+            if pkg._metadata_modified_is_outdated:
+                metadata_modified = None
+            else:
+                metadata_modified = pkg._dict.get('metadata_modified')
+            fingerprint = pkg.extras.get('ckanext_importer_package_fingerprint')
+            self.state.put(self.id, pkg._eid, pkg._dict['id'],
+                           metadata_modified, fingerprint)
+
+    def _find_stored_package(self, eid):
+        '''
+        Find an existing package using the state store.
+
+        Returns the package dict or ``None`` if the state store does not
+        contain a valid entry for the EID.
+        '''
+        entry = self.state.get(self.id, eid)
+        if entry is None:
+            return None
+        try:
+            pkg_dict = self._api.action.package_show(id=entry.package_id)
+        except NotFound:
+            pkg_dict = None
+        if (pkg_dict is None or pkg_dict.get('state') == 'deleted'
+                or not _is_matching_package(pkg_dict, self.id, eid)):
+            self._log.debug('Removing outdated state for EID {!r}'.format(eid))
+            self.state.remove(self.id, eid)
+            return None
+        if (entry.metadata_modified is not None
+                and entry.metadata_modified != pkg_dict['metadata_modified']):
+            self._log.debug('Package with EID {!r} has been modified since it was last synced'.format(eid))
+            self.state.put(self.id, eid, entry.package_id)
+        return pkg_dict
+
+    def _find_packages(self, eid=None, fl=None):
         '''
         Find existing packages for this importer.
 
         Yields package dicts.
 
         If ``eid`` is given, then only packages with that EID are returned.
+
+        If ``fl`` is given then only the listed fields are retrieved, see
+        :py:func:`_search_packages`. The importer's own extras are always
+        included.
+
+        If database reads are enabled then the packages are retrieved
+        from CKAN's database instead of being searched for.
         '''
-        extras = {
-            'ckanext_importer_importer_id': solr_escape(self.id),
-        }
-        if eid is not None:
-            extras['ckanext_importer_package_eid'] = solr_escape(eid)
-        fq = ' AND '.join('extras_{}:"{}"'.format(*item)
-                          for item in list(extras.items()))
-        pkg_dicts = _search_packages(self._api, fq=fq, rows=1000,
-                                     include_private=True)
-
-        # CKAN's search is based on Solr, which by default doesn't support
-        # searching for exact matches. Hence searching for importer ID "x"
-        # can also return packages with importer ID "x-y". Hence we filter
-        # the results again.
-        for pkg_dict in pkg_dicts:
-            extras = ExtrasDictView(pkg_dict['extras'])
-            if extras['ckanext_importer_importer_id'] != self.id:
-                continue
-            if eid is not None and extras['ckanext_importer_package_eid'] != eid:
-                continue
-            yield pkg_dict
+        if self._db is not None:
+            return self._db.find_packages(self.id, eid, fl)
+        kwargs = {}
+        if fl is not None:
+            kwargs['fl'] = list(fl) + ['extras_ckanext_importer_importer_id',
+                                       'extras_ckanext_importer_package_eid']
+        fq = _packages_fq(self.id, eid, exact=self._uses_exact_search())
+        workers = self.search_workers if eid is None else 1
+        pkg_dicts = _search_packages(self._api, keyset=True, workers=workers,
+                                     fq=fq, rows=1000, include_private=True,
+                                     **kwargs)
+        # The results are filtered even if the exact-match fields are
+        # used, in case a package has been modified but not reindexed
+        return (pkg_dict for pkg_dict in pkg_dicts
+                if _is_matching_package(pkg_dict, self.id, eid))
+
+    def _uses_exact_search(self):
+        '''
+        Check if the exact-match search fields should be used.
+
+        See the ``exact_search`` argument of :py:class:`Importer`.
+        '''
+        if self.exact_search is None:
+            with self._lock:
+                if self.exact_search is None:
+                    self.exact_search = _run_steps(
+                        _exact_search_steps(self._api, self.id))
+                    self._log.debug('Exact-match search fields are {}available'.format(
+                                    '' if self.exact_search else 'not '))
+        return self.exact_search
 
     def _find_package(self, eid):
         '''
@@ -426,7 +1790,15 @@ class Importer(object):
         Raises ``RuntimeError`` if more than one package with the given
         EID are found. This only happens with a corrupted database.
         '''
-        pkg_dicts = list(islice(self._find_packages(eid), 2))
+        if self.prefetch:
+            with self._lock:
+                pkg_dicts = list(self._get_index().get(eid, []))
+        else:
+            if self.state is not None:
+                pkg_dict = self._find_stored_package(eid)
+                if pkg_dict is not None:
+                    return pkg_dict
+            pkg_dicts = list(islice(self._find_packages(eid), 2))
         if not pkg_dicts:
             raise NotFound('No package with EID {!r} exists for {}'.format(eid, self))
         if len(pkg_dicts) > 1:
@@ -467,6 +1839,8 @@ class Package(Entity):
        `on_error` is an instance of :py:class:`OnError` and controls how
        exceptions inside the context manager are handled.
     '''
+    _entity_type = 'package'
+
     def __init__(self, eid, pkg_dict, parent):
         super(Package, self).__init__(eid, pkg_dict, parent)
 
@@ -493,17 +1867,202 @@ class Package(Entity):
         #: If you need more control regarding extras with duplicate keys
         #: and the order of extras then you need to manage extras
         #: manually (using `pkg['extras']` instead of `pkg.extras`).
-        self.extras = ExtrasDictView(pkg_dict['extras'])
+        #: Call `pkg.extras.reset()` before using `pkg.extras` again.
+        self.extras = None
+        self._wrap_extras()
+        self._deleted = False
+        self._metadata_modified_is_outdated = False
+        self._resource_index = None
+        self._duplicate_resource_eids = set()
+
+    def _wrap_extras(self):
+        '''
+        Create the ``extras`` view for the current extras list.
+        '''
+        self.extras = ExtrasDictView(self._dict['extras'],
+                                     on_write=lambda: self._snapshot('extras'))
+
+    def _get_upload_action(self):
+        '''
+        Get the CKAN action for uploading this package.
+
+        Returns the name of the action and its data dict, depending on
+        the importer's upload mode.
+        '''
+        mode = self._imp.upload_mode
+        if mode != UploadMode.update:
+            updated, removed = self._get_changes()
+            if mode == UploadMode.revise:
+                # package_revise merges lists and dicts item by item, so
+                # removed items would be kept. Modified containers are
+                # therefore removed first and then replaced as a whole.
+                replaced = [key for key, value in updated.items()
+                            if isinstance(value, (list, dict))]
+                return 'package_revise', {
+                    'match': {'id': self._dict['id']},
+                    'update': updated,
+                    'filter': ['-' + key for key in list(removed) + replaced],
+                }
+            if not removed:
+                return 'package_patch', dict(updated, id=self._dict['id'])
+        return 'package_update', self._dict
+
+    def _upload_steps(self):
+        '''
+        Upload the modified package.
+
+        Generator for :py:func:`~ckanext.importer.utils._run_steps`.
+        '''
+        if self._imp.plan is not None:
+            self._imp.plan._record_package_upload(self)
+            return
+        action, data_dict = self._get_upload_action()
+        result = yield functools.partial(getattr(self._api.action, action),
+                                         **data_dict)
+        if action == 'package_revise':
+            result = result['package']
+        self._replace_package_dict(result)
 
     def _upload(self):
-        replace_dict(self,
-                     self._api.action.package_update(**self))
+        _run_steps(self._upload_steps())
+
+    def _replace_package_dict(self, pkg_dict):
+        '''
+        Replace the package dict with its new version from CKAN.
+
+        The dicts of resources that still exist are updated in-place so
+        that existing :py:class:`Resource` instances remain valid.
+        '''
+        if 'resources' in pkg_dict:
+            old_res_dicts = self._get_resource_index()
+            resources = []
+            for res_dict in pkg_dict['resources']:
+                eid = res_dict.get('ckanext_importer_resource_eid')
+                old_res_dict = old_res_dicts.get(eid)
+                if old_res_dict is not None:
+                    replace_dict(old_res_dict, res_dict)
+                    res_dict = old_res_dict
+                resources.append(res_dict)
+            pkg_dict['resources'] = resources
+        replace_dict(self._dict, pkg_dict)
+        self._wrap_extras()
+        self._metadata_modified_is_outdated = False
+        self._resource_index = None
+
+    def _flush_steps(self):
+        '''
+        Upload the package's changes before its sync is finished.
+
+        Used with deferred resource writes when a new resource needs an
+        ID. Generator for :py:func:`~ckanext.importer.utils._run_steps`.
+        '''
+        self._log.debug('Uploading {} early'.format(self))
+        yield from self._upload_steps()
+        self._mark_as_unmodified()
+
+    def _new_resource(self, eid, res_dict):
+        '''
+        Create the wrapper for a resource of this package.
+        '''
+        return Resource(eid, res_dict, self)
+
+    def _get_resource_index(self):
+        '''
+        Get the index of this package's resources.
+
+        The index maps resource EIDs to resource dicts. It is built when
+        this method is called for the first time and then kept up to
+        date when resources are created or deleted. Resources without an
+        EID are not indexed.
+
+        EIDs that are used by more than one resource are not indexed
+        either, but stored in ``_duplicate_resource_eids`` instead.
+        '''
+        if self._resource_index is None:
+            index = {}
+            duplicates = set()
+            for res_dict in self._dict['resources']:
+                eid = res_dict.get('ckanext_importer_resource_eid')
+                if eid is None:
+                    continue
+                if eid in index:
+                    duplicates.add(eid)
+                index[eid] = res_dict
+            for eid in duplicates:
+                self._log.warning('Multiple resources for EID {} in {}'.format(eid, self))
+                del index[eid]
+            self._resource_index = index
+            self._duplicate_resource_eids = duplicates
+        return self._resource_index
+
+    def _find_resource_dict(self, eid):
+        '''
+        Find the resource dict for a resource EID.
+
+        Raises ``ckan.logic.NotFound`` if no resource with that EID
+        exists and ``ValueError`` if multiple resources with that EID
+        exist.
+        '''
+        index = self._get_resource_index()
+        if eid in self._duplicate_resource_eids:
+            raise ValueError('Multiple resources for EID {} in {}'.format(eid, self))
+        try:
+            return index[eid]
+        except KeyError:
+            raise NotFound('No resource with EID {!r} in {}'.format(eid, self))
+
+    def _add_resource_dict(self, res_dict):
+        '''
+        Add a newly created resource dict to this package.
+        '''
+        self._dict['resources'].append(res_dict)
+        eid = res_dict.get('ckanext_importer_resource_eid')
+        if self._resource_index is not None and eid is not None:
+            self._resource_index[eid] = res_dict
+
+    def _has_resource_dict(self, res_dict):
+        '''
+        Check if a resource dict is part of this package.
+        '''
+        return any(r is res_dict for r in self._dict['resources'])
+
+    def _remove_resource_dicts(self, res_dicts):
+        '''
+        Remove deleted resource dicts from this package.
+        '''
+        ids = set(id(res_dict) for res_dict in res_dicts)
+        resources = self._dict['resources']
+        resources[:] = [r for r in resources if id(r) not in ids]
+        if self._resource_index is not None:
+            for res_dict in res_dicts:
+                eid = res_dict.get('ckanext_importer_resource_eid')
+                if self._resource_index.get(eid) is res_dict:
+                    del self._resource_index[eid]
 
     def _delete(self):
         '''
         Purge this package.
         '''
-        self._api.action.dataset_purge(id=self['id'])
+        if self._imp.plan is None:
+            self._api.action.dataset_purge(id=self['id'])
+        elif 'id' in self._dict:
+            self._imp.plan._record_package_deletion(self)
+        self._mark_as_deleted()
+
+    def _mark_as_deleted(self):
+        '''
+        Update the importer's bookkeeping after the package was deleted.
+        '''
+        self._deleted = True
+        self._parent._remove_from_index(self._eid, self._dict)
+        if self._parent.state is not None and self._parent.plan is None:
+            self._parent.state.remove(self._parent.id, self._eid)
+
+    def _mark_as_synced(self):
+        # Packages may be synced from several threads, see
+        # Importer.sync_many
+        with self._parent._lock:
+            super(Package, self)._mark_as_synced()
 
     def delete_unsynced_resources(self):
         '''
@@ -518,48 +2077,36 @@ class Package(Entity):
         corresponding to objects that have been removed from the data
         source since the last import.
         '''
-        for res_dict in list(self['resources']):
-            eid = res_dict.get('ckanext_importer_resource_eid')
-            if eid not in self._synced_child_eids:
-                res = Resource(eid, res_dict, self)
-                self._log.debug('Deleting unsynced {}'.format(res))
-                res._delete()
+        _run_steps(self._delete_unsynced_resources_steps())
+
+    def _delete_unsynced_resources_steps(self):
+        '''
+        Delete resources that have not been synced.
+
+        Generator for :py:func:`~ckanext.importer.utils._run_steps`.
+        '''
+        defer = self._imp.defer_resource_writes
+        if defer:
+            self._snapshot('resources')
+        deleted = []
+        try:
+            for res_dict in list(self._dict['resources']):
+                eid = res_dict.get('ckanext_importer_resource_eid')
+                if eid not in self._synced_child_eids:
+                    res = self._new_resource(eid, res_dict)
+                    self._log.debug('Deleting unsynced {}'.format(res))
+                    if not defer:
+                        yield from res._delete_remote_steps()
+                    deleted.append(res_dict)
+                    self._imp.metrics.record_entity('resource', 'deleted')
+        finally:
+            self._remove_resource_dicts(deleted)
 
     @context_manager_method
-    class sync_resource(EntitySyncManager):
+    class sync_resource(_ResourceSyncSteps, EntitySyncManager):
         # Documentation is in the class docstring
-        def _find_entity(self):
-            res_dicts = [r for r in self._outer['resources']
-                         if r.get('ckanext_importer_resource_eid') == self._eid]
-            if not res_dicts:
-                raise NotFound('No resource with EID {!r} in {}'.format(self._eid, self._outer))
-            if len(res_dicts) > 1:
-                raise ValueError('Multiple resources for EID {} in {}'.format(self._eid, self._outer))
-            return Resource(self._eid, res_dicts[0], self._outer)
-
         def _create_entity(self):
-            res_dict = self._outer._api.action.resource_create(
-                package_id=self._outer['id'],
-                ckanext_importer_resource_eid=self._eid,
-            )
-            self._outer['resources'].append(res_dict)
-            return Resource(self._eid, res_dict, self._outer)
-
-        def __enter__(self):
-            self._pkg_is_modified = self._outer._is_modified()
-            # Note: This call should use super(), but see https://stackoverflow.com/q/51860397/857390
-            return EntitySyncManager.__enter__(self)
-
-        def __exit__(self, exc_type, exc_val, exc_tb):
-            # Note: This call should use super(), but see https://stackoverflow.com/q/51860397/857390
-            result = EntitySyncManager.__exit__(self, exc_type, exc_val, exc_tb)
-            if not self._pkg_is_modified:
-                # If the package was previously unmodified we mark it
-                # as unmodified again, since changes in the resource
-                # have already been uploaded (but their propagation to
-                # the package dict has marked the package as modified).
-                self._outer._mark_as_unmodified()
-            return result
+            return _run_steps(self._create_entity_steps())
 
 class Resource(Entity):
     '''
@@ -591,31 +2138,154 @@ class Resource(Entity):
        `on_error` is an instance of :py:class:`OnError` and controls how
        exceptions inside the context manager are handled.
     '''
+    _entity_type = 'resource'
+
+    def __init__(self, eid, res_dict, parent):
+        super(Resource, self).__init__(eid, res_dict, parent)
+        self._views_json = None
+        self._views_map = None
+        self._view_dicts = None
+
+    def _delete_steps(self):
+        '''
+        Delete this resource.
+
+        Generator for :py:func:`~ckanext.importer.utils._run_steps`.
+        '''
+        if not self._imp.defer_resource_writes:
+            yield from self._delete_remote_steps()
+        self._parent._remove_resource_dicts([self._dict])
+
     def _delete(self):
-        id = self['id']
-        self._api.action.resource_delete(id=id)
-        self._parent['resources'][:] = [r for r in self._parent['resources']
-                                        if r['id'] != id]
+        _run_steps(self._delete_steps())
 
-    def _upload(self):
+    def _delete_remote_steps(self):
+        '''
+        Delete this resource in CKAN.
+
+        Does not remove the resource dict from the package dict.
+        Generator for :py:func:`~ckanext.importer.utils._run_steps`.
+        '''
+        yield functools.partial(self._api.action.resource_delete,
+                                id=self['id'])
+        self._parent._metadata_modified_is_outdated = True
+
+    def _new_view(self, eid, view_dict):
+        '''
+        Create the wrapper for a view of this resource.
+        '''
+        return View(eid, view_dict, self)
+
+    def _get_upload_action(self):
+        '''
+        Get the CKAN action for uploading this resource.
+
+        Returns the name of the action and its data dict, depending on
+        the importer's upload mode.
+        '''
+        if self._imp.upload_mode != UploadMode.update:
+            updated, removed = self._get_changes()
+            if not removed:
+                return 'resource_patch', dict(updated, id=self._dict['id'])
+        return 'resource_update', self._dict
+
+    def _upload_steps(self):
         '''
         Upload the modified resource dict and propagate the changes.
+
+        Generator for :py:func:`~ckanext.importer.utils._run_steps`.
         '''
-        replace_dict(self, self._api.action.resource_update(**self))
+        if self._imp.defer_resource_writes:
+            # The changes are uploaded together with the package
+            return
+        action, data_dict = self._get_upload_action()
+        replace_dict(self._dict, (yield functools.partial(
+            getattr(self._api.action, action), **data_dict)))
+        self._parent._metadata_modified_is_outdated = True
+
+    def _upload(self):
+        _run_steps(self._upload_steps())
 
     def _get_views_map(self):
         '''
         Get the map of views for this resource.
 
-        The views map maps view EIDs to view IDs.
+        The views map maps view EIDs to view IDs. The parsed map is
+        cached until the underlying resource field changes.
+
+        Returns a copy of the map.
         '''
-        return json.loads(self.get('ckanext_importer_views', '{}'))
+        value = self._dict.get('ckanext_importer_views', '{}')
+        if value != self._views_json:
+            self._views_map = json.loads(value)
+            self._views_json = value
+        return dict(self._views_map)
 
     def _set_views_map(self, views):
         '''
         Set the map of views for this resource.
+
+        The resource is only modified if the map has changed.
+        '''
+        value = json.dumps(views, separators=(',', ':'))
+        if value != self._dict.get('ckanext_importer_views', '{}'):
+            self['ckanext_importer_views'] = value
+
+    def _get_view_dicts_steps(self):
+        '''
+        Get the views of this resource.
+
+        Returns a dict that maps view IDs to view dicts. The views are
+        retrieved using a single ``resource_view_list`` call when this
+        method is called for the first time. Generator for
+        :py:func:`~ckanext.importer.utils._run_steps`.
         '''
-        self['ckanext_importer_views'] = json.dumps(views, separators=(',', ':'))
+        if self._view_dicts is None:
+            view_dicts = yield functools.partial(
+                self._api.action.resource_view_list, id=self['id'])
+            self._view_dicts = {v['id']: v for v in view_dicts}
+        return self._view_dicts
+
+    def _find_view_id(self, eid):
+        '''
+        Find the ID of the view for a view EID.
+
+        Raises ``ckan.logic.NotFound`` if the views map does not contain
+        the EID.
+        '''
+        try:
+            return self._get_views_map()[eid]
+        except KeyError:
+            raise NotFound('No view with EID {!r} in {}'.format(eid, self))
+
+    def _get_cached_view_dict(self, id):
+        '''
+        Get a copy of a view dict from the retrieved views.
+
+        Raises ``ckan.logic.NotFound`` if the view does not exist.
+        '''
+        try:
+            return deepcopy(self._view_dicts[id])
+        except KeyError:
+            raise NotFound('View {!r} of {} does not exist'.format(id, self))
+
+    def _update_cached_view_dict(self, view_dict):
+        '''
+        Update the retrieved views after a view has been uploaded.
+
+        Does nothing if the views have not been retrieved.
+        '''
+        if self._view_dicts is not None:
+            self._view_dicts[view_dict['id']] = view_dict
+
+    def _remove_cached_view_dict(self, id):
+        '''
+        Update the retrieved views after a view has been deleted.
+
+        Does nothing if the views have not been retrieved.
+        '''
+        if self._view_dicts is not None:
+            self._view_dicts.pop(id, None)
 
     def delete_unsynced_views(self):
         '''
@@ -629,26 +2299,26 @@ class Resource(Entity):
         resource have been synced to delete those CKAN views that are no
         longer desired.
         '''
+        _run_steps(self._delete_unsynced_views_steps())
+
+    def _delete_unsynced_views_steps(self):
+        '''
+        Delete views that have not been synced.
+
+        Generator for :py:func:`~ckanext.importer.utils._run_steps`.
+        '''
         for eid, id in list(self._get_views_map().items()):
             if eid not in self._synced_child_eids:
-                view = View(eid, {'id': id}, self)
+                view = self._new_view(eid, {'id': id})
                 self._log.debug('Deleting unsynced {}'.format(view))
-                view._delete()
+                yield from view._delete_steps()
+                self._imp.metrics.record_entity('view', 'deleted')
 
     @context_manager_method
-    class sync_view(EntitySyncManager):
+    class sync_view(_ViewSyncSteps, EntitySyncManager):
         # Documentation is in the class docstring
         def _find_entity(self):
-            views = self._outer._get_views_map()
-            try:
-                id = views[self._eid]
-            except KeyError:
-                raise NotFound('No view with EID {!r} in {}'.format(self._eid, self._outer))
-            view_dict = self._outer._api.action.resource_view_show(id=id)
-            return View(self._eid, view_dict, self._outer)
-
-        def _create_entity(self):
-            return View(self._eid, {}, self._outer)
+            return _run_steps(self._find_entity_steps())
 
 
 class View(Entity):
@@ -664,6 +2334,8 @@ class View(Entity):
             view['title'] = 'A new title'
     '''
 
+    _entity_type = 'view'
+
     # FIXME: When we update the resource's ckanext_importer_views field
     #        then the upstream res dict is only updated once the
     #        sync_resource CM exits. If this doesn't happen (due
@@ -673,56 +2345,142 @@ class View(Entity):
     #        should automatically discover such issues, better would be
     #        to prevent them in the first place.
 
-    def _upload(self):
+    def _upload_steps(self):
+        '''
+        Upload the modified view.
+
+        Generator for :py:func:`~ckanext.importer.utils._run_steps`.
+        '''
+        if self._imp.plan is not None:
+            # New views are registered in their resource once the plan
+            # is applied
+            self._imp.plan._record_view_upload(self)
+            return
         try:
             id = self['id']
         except KeyError:
-            self._create()
+            yield from self._create_steps()
         else:
-            replace_dict(self, self._api.action.resource_view_update(**self))
+            replace_dict(self._dict, (yield functools.partial(
+                self._api.action.resource_view_update, **self._dict)))
+            self._parent._update_cached_view_dict(self._dict)
+
+    def _upload(self):
+        _run_steps(self._upload_steps())
 
-    def _create(self):
+    def _create_steps(self):
         '''
         Create a view.
+
+        Generator for :py:func:`~ckanext.importer.utils._run_steps`.
         '''
+        if 'id' not in self._parent._dict:
+            # The resource has not been created in CKAN yet, see
+            # Importer.defer_resource_writes
+            yield from self._parent._parent._flush_steps()
         self['resource_id'] = self._parent['id']
-        replace_dict(self, self._api.action.resource_view_create(**self))
+        replace_dict(self._dict, (yield functools.partial(
+            self._api.action.resource_view_create, **self._dict)))
+        self._parent._update_cached_view_dict(self._dict)
         # Register the view in the resource
         views = self._parent._get_views_map()
         views[self._eid] = self['id']
         self._parent._set_views_map(views)
 
-    def _delete(self):
+    def _delete_steps(self):
+        '''
+        Delete a view.
+
+        Generator for :py:func:`~ckanext.importer.utils._run_steps`.
+        '''
         try:
             id = self['id']
         except KeyError:
             # View has not been created yet
             return
-        self._api.action.resource_view_delete(id=id)
+        if self._imp.plan is None:
+            yield functools.partial(self._api.action.resource_view_delete,
+                                    id=id)
+        else:
+            self._imp.plan._record_view_deletion(self)
+        self._parent._remove_cached_view_dict(id)
         # Unregister the view in the resource
         views = self._parent._get_views_map()
         del views[self._eid]
         self._parent._set_views_map(views)
 
+    def _delete(self):
+        _run_steps(self._delete_steps())
+
 
 class ExtrasDictView(collections.abc.MutableMapping):
     '''
     Wrapper around a CKAN package's "extras".
     '''
-    def __init__(self, extras):
+    def __init__(self, extras, on_write=None):
         '''
         Constructor.
 
         ``extras`` is a list of package extras. That list is managed
         in-place by the created ``ExtrasDictView`` instance.
+
+        ``on_write`` is an optional callback that is called without
+        arguments before the extras list is modified.
+
+        Keys are looked up using an index that maps each key to the
+        position of its first extra. The index is built on first access
+        and rebuilt if the length of the list changes or if an indexed
+        position turns out to be outdated, since the list may have been
+        modified directly. A key that is not in the index is assumed to
+        be missing, so after modifying the list directly without
+        changing its length (for example by replacing an extra) call
+        :py:meth:`reset`.
         '''
         self._extras = extras
+        self._on_write = on_write
+        self._positions = None
+        self._indexed_len = None
+
+    def _before_write(self):
+        if self._on_write is not None:
+            self._on_write()
+
+    def _build_index(self):
+        positions = {}
+        for i, extra in enumerate(self._extras):
+            positions.setdefault(extra['key'], i)
+        self._positions = positions
+        self._indexed_len = len(self._extras)
+
+    def _get_position(self, key):
+        '''
+        Get the position of the first extra with the given key.
+
+        Returns ``None`` if no extra with that key exists.
+        '''
+        if self._positions is None or self._indexed_len != len(self._extras):
+            self._build_index()
+            return self._positions.get(key)
+        i = self._positions.get(key)
+        if i is not None and self._extras[i]['key'] != key:
+            # The list has been modified directly
+            self._build_index()
+            i = self._positions.get(key)
+        return i
+
+    def reset(self):
+        '''
+        Discard the index of the keys.
+
+        Call this after modifying the extras list directly.
+        '''
+        self._positions = None
 
     def __getitem__(self, key):
-        for extra in self._extras:
-            if extra['key'] == key:
-                return extra['value']
-        raise KeyError(key)
+        i = self._get_position(key)
+        if i is None:
+            raise KeyError(key)
+        return self._extras[i]['value']
 
     def __setitem__(self, key, value):
         '''
@@ -732,18 +2490,23 @@ class ExtrasDictView(collections.abc.MutableMapping):
         replaced. Otherwise, a new extra is appended at the end of the
         extras list.
         '''
-        for extra in self._extras:
-            if extra['key'] == key:
-                extra['value'] = value
-                return
+        self._before_write()
+        i = self._get_position(key)
+        if i is not None:
+            self._extras[i]['value'] = value
+            return
+        self._positions[key] = len(self._extras)
         self._extras.append({'key': key, 'value': value})
+        self._indexed_len += 1
 
     def __delitem__(self, key):
-        for i, extra in enumerate(self._extras):
-            if extra['key'] == key:
-                self._extras.pop(i)
-                return
-        raise KeyError(key)
+        i = self._get_position(key)
+        if i is None:
+            raise KeyError(key)
+        self._before_write()
+        self._extras.pop(i)
+        # The positions of the following extras have changed
+        self.reset()
 
     def __len__(self):
         return len(self._extras)
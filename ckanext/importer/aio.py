@@ -0,0 +1,567 @@
+#!/usr/bin/env python
+# encoding: utf-8
+
+# Copyright (C) 2018 Stadt Karlsruhe (www.karlsruhe.de)
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published
+# by the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+'''
+asyncio front-end for ckanext.importer.
+
+The classes in this module mirror :py:class:`~ckanext.importer.Importer`
+and its context managers, but work against an asynchronous CKAN action
+client and are used via ``async with``::
+
+    imp = AsyncImporter('my-importer-id', api=my_async_api)
+
+    async with imp.sync_package('my-package-eid') as pkg:
+        pkg['title'] = 'My Package Title'
+
+        async with pkg.sync_resource('my-resource-eid') as res:
+            res['name'] = 'My Resource Name'
+
+The entities returned by the context managers are subclasses of
+:py:class:`~ckanext.importer.Package`,
+:py:class:`~ckanext.importer.Resource`, and
+:py:class:`~ckanext.importer.View` and provide the same ``dict``
+interface, so code that fills in entities can be shared between the
+synchronous and the asynchronous front-end.
+'''
+
+from __future__ import (absolute_import, division, print_function,
+                        unicode_literals)
+
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+import functools
+import inspect
+import logging
+from timeit import default_timer
+
+import ckanapi
+from ckan.logic import NotFound
+
+from . import (_DELETION_FIELDS, _PACKAGE_NAME_PREFIX, Entity,
+               EntitySyncManager, Importer, OnError, Package, Resource,
+               UploadMode, View, _exact_search_steps, _get_extras,
+               _get_package_eid, _id_range_fq, _is_matching_package,
+               _keyset_kwargs, _packages_fq, _PackageNameAllocator,
+               _ResourceSyncSteps, _unflatten_extras, _ViewSyncSteps)
+from .metrics import Metrics, _get_outcome
+from .utils import context_manager_method
+
+
+__all__ = ['AsyncImporter', 'InstrumentedAsyncAPI', 'ThreadedAPI']
+
+
+class ThreadedAPI(object):
+    '''
+    Asynchronous adapter for a synchronous CKAN API client.
+
+    Wraps an instance of ``ckanapi.LocalCKAN`` or ``ckanapi.RemoteCKAN``
+    such that its actions can be awaited. The actions are executed in a
+    pool of at most ``max_workers`` threads, so ``api`` must be safe to
+    use from several threads at once if ``max_workers`` is larger than 1.
+
+    Use this if no natively asynchronous CKAN client is available.
+
+    The thread pool is shut down by :py:meth:`close`. Alternatively,
+    use the adapter as an asynchronous context manager::
+
+        async with ThreadedAPI(ckanapi.RemoteCKAN(url)) as api:
+            imp = AsyncImporter('my-importer-id', api=api)
+    '''
+    class _Action(object):
+        def __init__(self, threaded_api):
+            self._threaded_api = threaded_api
+
+        def __getattr__(self, name):
+            threaded_api = self._threaded_api
+            action = getattr(threaded_api._api.action, name)
+
+            async def call(**kwargs):
+                loop = asyncio.get_running_loop()
+                return await loop.run_in_executor(
+                    threaded_api._executor, functools.partial(action, **kwargs))
+
+            return call
+
+    def __init__(self, api, max_workers=10):
+        self._api = api
+        self._executor = ThreadPoolExecutor(max_workers=max_workers)
+        self.action = ThreadedAPI._Action(self)
+
+    def close(self):
+        '''
+        Shut down the thread pool.
+
+        Waits for running actions to finish.
+        '''
+        self._executor.shutdown(wait=True)
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+
+class InstrumentedAsyncAPI(object):
+    '''
+    Wrapper around an asynchronous CKAN API client that records metrics.
+
+    Asynchronous counterpart of
+    :py:class:`~ckanext.importer.metrics.InstrumentedAPI`.
+    '''
+    class _Action(object):
+        def __init__(self, instrumented):
+            self._instrumented = instrumented
+
+        def __getattr__(self, name):
+            func = getattr(self._instrumented.api.action, name)
+            metrics = self._instrumented.metrics
+
+            async def call(**kwargs):
+                start = default_timer()
+                exception = None
+                try:
+                    return await func(**kwargs)
+                except Exception as e:
+                    exception = e
+                    raise
+                finally:
+                    metrics.record_call(name, _get_outcome(exception),
+                                        default_timer() - start)
+
+            return call
+
+    def __init__(self, api, metrics):
+        #: The wrapped API client
+        self.api = api
+        self.metrics = metrics
+        self.action = InstrumentedAsyncAPI._Action(self)
+
+
+async def _run_steps_async(steps):
+    '''
+    Run a generator that describes an operation in steps.
+
+    Asynchronous version of
+    :py:func:`~ckanext.importer.utils._run_steps`: results of the yielded
+    calls that can be awaited are awaited, so the same steps can be used
+    with synchronous and asynchronous API clients.
+    '''
+    try:
+        call = next(steps)
+        while True:
+            try:
+                result = call()
+                if inspect.isawaitable(result):
+                    result = await result
+            except Exception as e:
+                call = steps.throw(e)
+            else:
+                call = steps.send(result)
+    except StopIteration as e:
+        return e.value
+
+
+class AsyncEntitySyncManager(object):
+    '''
+    Asynchronous context manager for synchronizing an ``Entity``.
+
+    Counterpart of :py:class:`~ckanext.importer.EntitySyncManager`,
+    whose logic it shares.
+
+    Do not instantiate directly.
+    '''
+    def __init__(self, eid, on_error=OnError.reraise):
+        self._eid = str(eid)
+        if not isinstance(on_error, OnError):
+            raise TypeError('on_error must be of type OnError')
+        self._on_error = on_error
+
+    async def _find_entity(self):
+        '''
+        Find an existing entity.
+
+        Like ``EntitySyncManager._find_entity`` but asynchronous.
+        '''
+        raise NotImplementedError()
+
+    async def _create_entity(self):
+        '''
+        Create a new entity.
+
+        Like ``EntitySyncManager._create_entity`` but asynchronous.
+        '''
+        raise NotImplementedError()
+
+    _record = EntitySyncManager._record
+    _enter_steps = EntitySyncManager._enter_steps
+    _delete_entity_steps = EntitySyncManager._delete_entity_steps
+    _exit_steps = EntitySyncManager._exit_steps
+
+    async def __aenter__(self):
+        return await _run_steps_async(self._enter_steps())
+
+    async def __aexit__(self, exc_type, exc_val, exc_tb):
+        return await _run_steps_async(
+            self._exit_steps(exc_type, exc_val, exc_tb))
+
+
+async def _search_packages(api, keyset=False, **kwargs):
+    '''
+    Asynchronous version of ``ckanext.importer._search_packages``.
+
+    Pages are always requested one after the other.
+    '''
+    if keyset:
+        kwargs = _keyset_kwargs(kwargs)
+        fq = kwargs.get('fq')
+        lower = None
+    else:
+        kwargs['start'] = 0
+    while True:
+        if keyset:
+            kwargs['fq'] = _id_range_fq(fq, lower, None, include_lower=False)
+        result = await api.action.package_search(**kwargs)
+        results = result['results']
+        for pkg_dict in results:
+            if kwargs.get('fl'):
+                _unflatten_extras(pkg_dict)
+            yield pkg_dict
+        if keyset:
+            if len(results) == result['count']:
+                # This was the last page
+                break
+            lower = results[-1]['id']
+        else:
+            if kwargs['start'] + len(results) == result['count']:
+                # All results have been retrieved
+                break
+            kwargs['start'] += len(results)
+
+
+class AsyncImporter(object):
+    '''
+    An importer for use with ``asyncio``.
+
+    Works like :py:class:`~ckanext.importer.Importer`, but all methods
+    that communicate with CKAN are coroutines and the context managers
+    for syncing entities have to be used via ``async with``.
+
+    ``api`` is an asynchronous CKAN action client: its ``action``
+    attribute must provide the CKAN actions as coroutine functions that
+    are called with keyword arguments (like the ``action`` attribute of
+    ``ckanapi``'s clients). Use :py:class:`ThreadedAPI` to adapt a
+    synchronous client.
+
+    ``id``, ``default_owner_org``, ``hash_names``, ``upload_mode``,
+    ``defer_resource_writes``, and ``exact_search`` are as for
+    :py:class:`~ckanext.importer.Importer`. API calls and entity syncs
+    are recorded in ``metrics`` like for
+    :py:class:`~ckanext.importer.Importer`.
+    '''
+    def __init__(self, id, api, default_owner_org=None, hash_names=False,
+                 upload_mode=UploadMode.update, defer_resource_writes=False,
+                 exact_search=None):
+        self.id = str(id)
+        if not isinstance(upload_mode, UploadMode):
+            raise TypeError('upload_mode must be of type UploadMode')
+        self.upload_mode = upload_mode
+        self.defer_resource_writes = defer_resource_writes
+        self.exact_search = exact_search
+        self.metrics = Metrics(labels={'importer': self.id})
+        self._api = InstrumentedAsyncAPI(api, self.metrics)
+        self.default_owner_org = default_owner_org
+        # Plans are not supported, see Importer.plan
+        self.plan = None
+        self._synced_child_eids = set()
+        self._names = _PackageNameAllocator(hash_names)
+        # Locks are created on first use so that they belong to the
+        # running loop
+        self._names_lock = None
+        self._exact_search_lock = None
+        self._log = Importer._PrefixLoggerAdapter(
+            logging.getLogger(__name__), 'Importer {!r}: '.format(self.id))
+
+    async def skip_if_unchanged(self, eid, fingerprint):
+        '''
+        Skip a package if its source record has not changed.
+
+        See :py:meth:`ckanext.importer.Importer.skip_if_unchanged`.
+        '''
+        eid = str(eid)
+        try:
+            pkg_dict = await self._find_package(eid)
+        except NotFound:
+            return False
+        stored = _get_extras(pkg_dict,
+                             'ckanext_importer_package_fingerprint')[0]
+        if stored is None or stored != str(fingerprint):
+            return False
+        self._log.debug('Skipping unchanged package with EID {!r}'.format(eid))
+        self._synced_child_eids.add(eid)
+        self.metrics.record_entity('package', 'unchanged')
+        return True
+
+    def stats(self):
+        '''
+        Get the metrics of this importer.
+
+        See :py:meth:`ckanext.importer.Importer.stats`.
+        '''
+        return self.metrics.stats()
+
+    async def delete_unsynced_packages(self):
+        '''
+        Delete packages that have not been synced.
+
+        See :py:meth:`ckanext.importer.Importer.delete_unsynced_packages`.
+        '''
+        # Collect the packages first, since deleting them while paging
+        # through the search results would shift the pages
+        pkg_dicts = [pkg_dict async for pkg_dict
+                     in self._find_packages(fl=_DELETION_FIELDS)]
+        for pkg_dict in pkg_dicts:
+            eid = _get_package_eid(pkg_dict)
+            if eid not in self._synced_child_eids:
+                pkg = AsyncPackage(eid, pkg_dict, self)
+                self._log.debug('Deleting unsynced {}'.format(pkg))
+                await pkg._delete()
+                self.metrics.record_entity('package', 'deleted')
+
+    @context_manager_method
+    class sync_package(AsyncEntitySyncManager):
+        '''
+        Sync a package.
+
+        Asynchronous context manager that returns an
+        :py:class:`AsyncPackage`, see
+        :py:meth:`ckanext.importer.Importer.sync_package`.
+        '''
+        def __init__(self, eid, on_error=OnError.reraise, fingerprint=None):
+            AsyncEntitySyncManager.__init__(self, eid, on_error)
+            if fingerprint is not None:
+                fingerprint = str(fingerprint)
+            self._fingerprint = fingerprint
+
+        async def _find_entity(self):
+            pkg_dict = await self._outer._find_package(self._eid)
+            return AsyncPackage(self._eid, pkg_dict, self._outer)
+
+        async def _create_entity(self):
+            attempt = 0
+            while True:
+                name = await self._outer._new_package_name(self._eid, attempt)
+                try:
+                    pkg_dict = await self._outer._api.action.package_create(
+                        name=name,
+                        owner_org=self._outer.default_owner_org,
+                        extras=[
+                            {'key': 'ckanext_importer_importer_id',
+                             'value': self._outer.id},
+                            {'key': 'ckanext_importer_package_eid',
+                             'value': self._eid},
+                        ],
+                    )
+                except ckanapi.ValidationError as e:
+                    if 'name' in e.error_dict:
+                        # The name has been taken in the meantime
+                        self._outer._log.debug('Package name {!r} is already taken'.format(name))
+                        attempt += 1
+                        continue
+                    raise
+                return AsyncPackage(self._eid, pkg_dict, self._outer)
+
+        async def __aexit__(self, exc_type, exc_val, exc_tb):
+            if exc_type is None and self._fingerprint is not None:
+                extras = self._entity.extras
+                key = 'ckanext_importer_package_fingerprint'
+                if extras.get(key) != self._fingerprint:
+                    extras[key] = self._fingerprint
+            return await AsyncEntitySyncManager.__aexit__(
+                self, exc_type, exc_val, exc_tb)
+
+    async def _new_package_name(self, eid, attempt):
+        '''
+        Allocate a name for a new package.
+
+        See ``ckanext.importer.Importer._new_package_name``.
+        '''
+        if self._names.needs_existing_names():
+            # Concurrent creations wait for the first one's scan
+            if self._names_lock is None:
+                self._names_lock = asyncio.Lock()
+            async with self._names_lock:
+                if self._names.needs_existing_names():
+                    names = [pkg_dict['name'] async for pkg_dict
+                             in _search_packages(
+                                 self._api, keyset=True,
+                                 fq='name:{}*'.format(_PACKAGE_NAME_PREFIX),
+                                 fl=['name'], rows=1000,
+                                 include_private=True)]
+                    self._names.add_existing_names(names)
+        return self._names.allocate(self.id, eid, attempt)
+
+    async def _find_packages(self, eid=None, fl=None):
+        '''
+        Find existing packages for this importer.
+
+        Asynchronously yields package dicts.
+
+        See ``ckanext.importer.Importer._find_packages``.
+        '''
+        kwargs = {}
+        if fl is not None:
+            kwargs['fl'] = list(fl) + ['extras_ckanext_importer_importer_id',
+                                       'extras_ckanext_importer_package_eid']
+        fq = _packages_fq(self.id, eid, exact=await self._uses_exact_search())
+        pkg_dicts = _search_packages(self._api, keyset=True, fq=fq, rows=1000,
+                                     include_private=True, **kwargs)
+        async for pkg_dict in pkg_dicts:
+            if _is_matching_package(pkg_dict, self.id, eid):
+                yield pkg_dict
+
+    async def _uses_exact_search(self):
+        '''
+        Check if the exact-match search fields should be used.
+
+        See ``ckanext.importer.Importer._uses_exact_search``.
+        '''
+        if self.exact_search is None:
+            # Concurrent searches wait for the first one's check
+            if self._exact_search_lock is None:
+                self._exact_search_lock = asyncio.Lock()
+            async with self._exact_search_lock:
+                if self.exact_search is None:
+                    self.exact_search = await _run_steps_async(
+                        _exact_search_steps(self._api, self.id))
+        return self.exact_search
+
+    async def _find_package(self, eid):
+        '''
+        Find an existing package for this importer.
+
+        See ``ckanext.importer.Importer._find_package``.
+        '''
+        pkg_dicts = []
+        async for pkg_dict in self._find_packages(eid):
+            pkg_dicts.append(pkg_dict)
+            if len(pkg_dicts) > 1:
+                raise RuntimeError('Multiple packages with EID {!r} found for {}'.format(eid, self))
+        if not pkg_dicts:
+            raise NotFound('No package with EID {!r} exists for {}'.format(eid, self))
+        return pkg_dicts[0]
+
+    def __repr__(self):
+        return '<{} id={!r}>'.format(self.__class__.__name__, self.id)
+
+
+class AsyncPackage(Package):
+    '''
+    Package wrapper for :py:class:`AsyncImporter`.
+
+    Works like :py:class:`~ckanext.importer.Package`, but
+    :py:meth:`sync_resource` has to be used via ``async with`` and
+    :py:meth:`delete_unsynced_resources` is a coroutine.
+    '''
+    # Packages of an AsyncImporter are only used from the event loop's
+    # thread, so there is no need for locking
+    _mark_as_synced = Entity._mark_as_synced
+
+    async def _upload(self):
+        await _run_steps_async(self._upload_steps())
+
+    async def _delete(self):
+        '''
+        Purge this package.
+        '''
+        await self._api.action.dataset_purge(id=self['id'])
+
+    def _new_resource(self, eid, res_dict):
+        return AsyncResource(eid, res_dict, self)
+
+    async def delete_unsynced_resources(self):
+        '''
+        Delete resources that have not been synced.
+
+        See
+        :py:meth:`ckanext.importer.Package.delete_unsynced_resources`.
+        '''
+        await _run_steps_async(self._delete_unsynced_resources_steps())
+
+    @context_manager_method
+    class sync_resource(_ResourceSyncSteps, AsyncEntitySyncManager):
+        '''
+        Sync a resource of this package.
+
+        Asynchronous context manager that returns an
+        :py:class:`AsyncResource`, see
+        :py:meth:`ckanext.importer.Package.sync_resource`.
+        '''
+        async def _create_entity(self):
+            return await _run_steps_async(self._create_entity_steps())
+
+
+class AsyncResource(Resource):
+    '''
+    Resource wrapper for :py:class:`AsyncImporter`.
+
+    Works like :py:class:`~ckanext.importer.Resource`, but
+    :py:meth:`sync_view` has to be used via ``async with`` and
+    :py:meth:`delete_unsynced_views` is a coroutine.
+    '''
+    async def _delete(self):
+        await _run_steps_async(self._delete_steps())
+
+    async def _upload(self):
+        await _run_steps_async(self._upload_steps())
+
+    def _new_view(self, eid, view_dict):
+        return AsyncView(eid, view_dict, self)
+
+    async def delete_unsynced_views(self):
+        '''
+        Delete views that have not been synced.
+
+        See :py:meth:`ckanext.importer.Resource.delete_unsynced_views`.
+        '''
+        await _run_steps_async(self._delete_unsynced_views_steps())
+
+    @context_manager_method
+    class sync_view(_ViewSyncSteps, AsyncEntitySyncManager):
+        '''
+        Sync a view of this resource.
+
+        Asynchronous context manager that returns an
+        :py:class:`AsyncView`, see
+        :py:meth:`ckanext.importer.Resource.sync_view`.
+        '''
+        async def _find_entity(self):
+            return await _run_steps_async(self._find_entity_steps())
+
+
+class AsyncView(View):
+    '''
+    View wrapper for :py:class:`AsyncImporter`.
+
+    Works like :py:class:`~ckanext.importer.View`.
+    '''
+    async def _upload(self):
+        await _run_steps_async(self._upload_steps())
+
+    async def _delete(self):
+        await _run_steps_async(self._delete_steps())
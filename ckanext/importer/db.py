@@ -0,0 +1,185 @@
+#!/usr/bin/env python
+# encoding: utf-8
+
+# Copyright (C) 2018 Stadt Karlsruhe (www.karlsruhe.de)
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published
+# by the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+'''
+Reading packages directly from CKAN's database.
+'''
+
+from __future__ import (absolute_import, division, print_function,
+                        unicode_literals)
+
+from timeit import default_timer
+
+import ckanapi
+from ckan import model
+from ckan.logic import get_action
+from sqlalchemy.orm import aliased
+
+from .metrics import _get_outcome
+from .utils import _unwrap_api
+
+
+__all__ = ['DatabaseReader']
+
+
+class DatabaseReader(object):
+    '''
+    Finds the packages of an importer using CKAN's database.
+
+    Instead of searching the packages using ``package_search`` (and
+    therefore Solr), the packages are found using a single SQL query on
+    CKAN's ``package`` and ``package_extra`` tables. The results are
+    therefore always up-to-date, even if the search index isn't.
+
+    ``api`` is the ``ckanapi.LocalCKAN`` instance of the importer (it
+    may be wrapped, for example in a
+    :py:class:`~ckanext.importer.throttle.ThrottledAPI`). The found
+    packages are retrieved using CKAN's ``package_show`` action with the
+    same user as ``api``.
+
+    ``metrics`` is an optional
+    :py:class:`~ckanext.importer.metrics.Metrics` instance in which the
+    queries are recorded as ``database_search`` calls.
+
+    Raises a ``ValueError`` if ``api`` is not a ``ckanapi.LocalCKAN``
+    instance, since the database is only available inside of CKAN.
+    '''
+    #: Number of packages that are loaded from the database at once.
+    batch_size = 500
+
+    def __init__(self, api, metrics=None):
+        local = _unwrap_api(api)
+        if not isinstance(local, ckanapi.LocalCKAN):
+            raise ValueError('Database reads require ckanapi.LocalCKAN, not {!r}'.format(
+                             local))
+        self._context = local.context
+        self.metrics = metrics
+
+    def _record(self, start, exception):
+        if self.metrics is not None:
+            self.metrics.record_call('database_search', _get_outcome(exception),
+                                     default_timer() - start)
+
+    def _query_ids(self, importer_id, eid=None):
+        '''
+        Get the IDs and EIDs of an importer's active packages.
+
+        Returns a list of ``(package ID, EID)`` tuples, sorted by
+        package ID.
+        '''
+        importer_extra = aliased(model.PackageExtra)
+        eid_extra = aliased(model.PackageExtra)
+        query = (model.Session.query(model.Package.id, eid_extra.value)
+                 .join(importer_extra,
+                       importer_extra.package_id == model.Package.id)
+                 .join(eid_extra, eid_extra.package_id == model.Package.id)
+                 .filter(model.Package.state == 'active',
+                         importer_extra.key == 'ckanext_importer_importer_id',
+                         importer_extra.value == importer_id,
+                         eid_extra.key == 'ckanext_importer_package_eid'))
+        if eid is not None:
+            query = query.filter(eid_extra.value == eid)
+        if hasattr(model.PackageExtra, 'state'):
+            # Older CKAN versions keep removed extras as deleted rows
+            query = query.filter(importer_extra.state == 'active',
+                                 eid_extra.state == 'active')
+        return query.order_by(model.Package.id).all()
+
+    def find_packages(self, importer_id, eid=None, fl=None):
+        '''
+        Find the packages of an importer.
+
+        Yields package dicts as returned by ``package_show``.
+
+        If ``eid`` is given then only packages with that EID are
+        returned.
+
+        If ``fl`` is given then it must be a list of columns of CKAN's
+        ``package`` table (for example ``id``, ``name``, and
+        ``owner_org``). Only these fields and the importer's own extras
+        are returned, and ``package_show`` is not called.
+        '''
+        start = default_timer()
+        exception = None
+        try:
+            rows = self._query_ids(importer_id, eid)
+            if fl is not None:
+                columns = [getattr(model.Package, field) for field in fl]
+                projected = {}
+                for batch in self._batches([row[0] for row in rows]):
+                    for values in (model.Session.query(model.Package.id, *columns)
+                                   .filter(model.Package.id.in_(batch))):
+                        projected[values[0]] = dict(zip(fl, values[1:]))
+        except Exception as e:
+            exception = e
+            raise
+        finally:
+            self._record(start, exception)
+        if fl is not None:
+            for package_id, pkg_eid in rows:
+                pkg_dict = projected[package_id]
+                pkg_dict['extras'] = [
+                    {'key': 'ckanext_importer_importer_id', 'value': importer_id},
+                    {'key': 'ckanext_importer_package_eid', 'value': pkg_eid},
+                ]
+                yield pkg_dict
+            return
+        package_show = get_action('package_show')
+        for batch in self._batches([row[0] for row in rows]):
+            # Load the packages of the batch into the session using a
+            # single query, so that package_show finds them there
+            model.Session.query(model.Package).filter(
+                model.Package.id.in_(batch)).all()
+            for package_id in batch:
+                # Bypass the copy of the package dict that is cached in
+                # the search index
+                context = dict(self._context, model=model,
+                               session=model.Session, use_cache=False)
+                yield package_show(context, {'id': package_id})
+
+    def find_names(self, prefix):
+        '''
+        Find the names of packages that start with a prefix.
+
+        Unlike a search, this includes deleted packages, whose names are
+        still in use.
+
+        Yields package names.
+        '''
+        start = default_timer()
+        exception = None
+        try:
+            pattern = (prefix.replace('\\', '\\\\').replace('%', '\\%')
+                       .replace('_', '\\_')) + '%'
+            rows = (model.Session.query(model.Package.name)
+                    .filter(model.Package.name.like(pattern, escape='\\'))
+                    .all())
+        except Exception as e:
+            exception = e
+            raise
+        finally:
+            self._record(start, exception)
+        return (row[0] for row in rows)
+
+    def _batches(self, ids):
+        for i in range(0, len(ids), self.batch_size):
+            yield ids[i:i + self.batch_size]
+
+    def __repr__(self):
+        return '<{} user={!r}>'.format(self.__class__.__name__,
+                                       self._context.get('user'))
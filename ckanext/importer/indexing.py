@@ -0,0 +1,118 @@
+#!/usr/bin/env python
+# encoding: utf-8
+
+# Copyright (C) 2018 Stadt Karlsruhe (www.karlsruhe.de)
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published
+# by the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+'''
+Control of CKAN's search indexing during bulk imports.
+'''
+
+from __future__ import (absolute_import, division, print_function,
+                        unicode_literals)
+
+import logging
+import threading
+
+from ckan import model
+from ckan.common import config
+from ckan.lib import search
+from ckan.logic import NotFound, get_action
+
+
+__all__ = ['reindex_packages', 'suppress_indexing', 'restore_indexing']
+
+
+log = logging.getLogger(__name__)
+
+
+#: CKAN configuration option that controls whether packages are
+#: reindexed automatically when they are modified.
+_AUTOMATIC_INDEXING_OPTION = 'ckan.search.automatic_indexing'
+
+_lock = threading.Lock()
+
+# Number of active suppressions and the original value of the option
+_num_suppressions = 0
+_original_value = None
+
+
+def suppress_indexing():
+    '''
+    Stop CKAN from reindexing modified packages automatically.
+
+    This sets CKAN's ``ckan.search.automatic_indexing`` option to false
+    for the whole process until :py:func:`restore_indexing` is called.
+    Suppressions can be nested, the option is restored once the last
+    suppression has ended.
+    '''
+    global _num_suppressions, _original_value
+    with _lock:
+        if not _num_suppressions:
+            _original_value = config.get(_AUTOMATIC_INDEXING_OPTION)
+            config[_AUTOMATIC_INDEXING_OPTION] = False
+            log.debug('Suppressed automatic search indexing')
+        _num_suppressions += 1
+
+
+def restore_indexing():
+    '''
+    End a suppression started by :py:func:`suppress_indexing`.
+    '''
+    global _num_suppressions, _original_value
+    with _lock:
+        if not _num_suppressions:
+            raise RuntimeError('Search indexing is not suppressed')
+        _num_suppressions -= 1
+        if not _num_suppressions:
+            if _original_value is None:
+                config.pop(_AUTOMATIC_INDEXING_OPTION, None)
+            else:
+                config[_AUTOMATIC_INDEXING_OPTION] = _original_value
+            _original_value = None
+            log.debug('Restored automatic search indexing')
+
+
+def reindex_packages(package_ids, batch_size=100):
+    '''
+    Update the search index for the given packages.
+
+    Packages that still exist (including packages that are marked as
+    deleted) are reindexed, purged packages are removed from the index.
+    This is what CKAN's automatic indexing would have done.
+
+    The search index is committed after each batch of ``batch_size``
+    packages.
+
+    Returns the number of packages that have been reindexed or removed.
+    '''
+    package_ids = list(package_ids)
+    package_index = search.index_for(model.Package)
+    package_show = get_action('package_show')
+    for start in range(0, len(package_ids), batch_size):
+        for package_id in package_ids[start:start + batch_size]:
+            context = {'model': model, 'session': model.Session,
+                       'ignore_auth': True, 'validate': False,
+                       'use_cache': False}
+            try:
+                pkg_dict = package_show(context, {'id': package_id})
+            except NotFound:
+                package_index.remove_dict({'id': package_id})
+            else:
+                package_index.update_dict(pkg_dict, defer_commit=True)
+        search.commit()
+        log.debug('Reindexed {} of {} packages'.format(
+                  min(start + batch_size, len(package_ids)), len(package_ids)))
+    return len(package_ids)
@@ -0,0 +1,170 @@
+#!/usr/bin/env python
+# encoding: utf-8
+
+# Copyright (C) 2018 Stadt Karlsruhe (www.karlsruhe.de)
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published
+# by the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+'''
+Journal for resuming interrupted import runs.
+'''
+
+from __future__ import (absolute_import, division, print_function,
+                        unicode_literals)
+
+import collections
+import io
+import json
+import logging
+import os
+import threading
+
+
+__all__ = ['Journal']
+
+
+log = logging.getLogger(__name__)
+
+
+#: Events that are recorded in a journal.
+JOURNAL_EVENTS = ('synced', 'created', 'deleted')
+
+
+class Journal(object):
+    '''
+    Append-only on-disk journal of an import run.
+
+    The journal records, for each importer, the EIDs of the packages
+    that have been created, synced, and deleted during the current run.
+    If the run is interrupted (for example by a crash) then a new
+    :py:class:`~ckanext.importer.Importer` that uses the same journal
+    resumes the run: packages that have already been synced or deleted
+    are skipped by :py:meth:`~ckanext.importer.Importer.sync_many` and
+    :py:meth:`~ckanext.importer.Importer.skip_if_done`, and they count as
+    synced for :py:meth:`~ckanext.importer.Importer.delete_unsynced_packages`.
+
+    ``path`` is the path of the journal file. It is created if it doesn't
+    exist. Each event is written as a line of JSON and flushed
+    immediately. If ``fsync`` is true then each event is also synced to
+    disk, which is slower but survives a crash of the operating system.
+
+    Once the run has been finished, call :py:meth:`complete` to remove
+    the journal file, so that the next run starts from scratch.
+
+    The journal can be shared by several importers and can be used from
+    several threads.
+    '''
+    def __init__(self, path, fsync=False):
+        self.path = path
+        self.fsync = fsync
+        self._lock = threading.Lock()
+        # (importer ID, event) -> set of EIDs
+        self._eids = collections.defaultdict(set)
+        self._load()
+        self._file = io.open(path, 'a', encoding='utf-8')
+
+    def _load(self):
+        '''
+        Load the events of an interrupted run.
+        '''
+        if not os.path.exists(self.path):
+            return
+        with io.open(self.path, encoding='utf-8') as f:
+            content = f.read()
+        if not content:
+            # The previous run didn't record any events
+            return
+        lines = content.split('\n')
+        if not content.endswith('\n'):
+            # The last event was only partially written. It is ignored
+            # and overwritten by the next event.
+            log.warning('Ignoring incomplete last line of journal {!r}'.format(self.path))
+            with io.open(self.path, 'r+b') as f:
+                f.truncate(len(content.encode('utf-8'))
+                           - len(lines[-1].encode('utf-8')))
+        num_events = 0
+        for line in lines[:-1]:
+            event = json.loads(line)
+            self._eids[event['importer'], event['event']].add(event['eid'])
+            num_events += 1
+        if num_events:
+            log.info('Resuming from journal {!r} with {} events'.format(
+                     self.path, num_events))
+
+    def record(self, importer_id, event, eid):
+        '''
+        Record an event.
+
+        ``event`` is one of ``JOURNAL_EVENTS``.
+        '''
+        if event not in JOURNAL_EVENTS:
+            raise ValueError('Unknown journal event {!r}'.format(event))
+        line = json.dumps({'importer': importer_id, 'event': event,
+                           'eid': eid}, sort_keys=True)
+        with self._lock:
+            self._eids[importer_id, event].add(eid)
+            self._file.write(line + '\n')
+            self._file.flush()
+            if self.fsync:
+                os.fsync(self._file.fileno())
+
+    def eids(self, importer_id, event):
+        '''
+        Get the EIDs for which an event has been recorded.
+
+        Returns a set of EIDs.
+        '''
+        with self._lock:
+            return set(self._eids.get((importer_id, event), ()))
+
+    def done_eids(self, importer_id):
+        '''
+        Get the EIDs of the packages that have been synced or deleted.
+
+        Returns a set of EIDs.
+        '''
+        with self._lock:
+            return (self._eids.get((importer_id, 'synced'), set())
+                    | self._eids.get((importer_id, 'deleted'), set()))
+
+    def is_done(self, importer_id, eid):
+        '''
+        Check if a package has been synced or deleted.
+        '''
+        with self._lock:
+            return (eid in self._eids.get((importer_id, 'synced'), ())
+                    or eid in self._eids.get((importer_id, 'deleted'), ()))
+
+    def close(self):
+        '''
+        Close the journal file.
+
+        The journal is kept, so that an interrupted run can be resumed.
+        '''
+        with self._lock:
+            self._file.close()
+
+    def complete(self):
+        '''
+        Mark the run as completed.
+
+        Closes and removes the journal file.
+        '''
+        with self._lock:
+            self._file.close()
+            os.remove(self.path)
+            self._eids.clear()
+
+    def __repr__(self):
+        return '<{} {!r}>'.format(self.__class__.__name__, self.path)
@@ -0,0 +1,237 @@
+#!/usr/bin/env python
+# encoding: utf-8
+
+# Copyright (C) 2018 Stadt Karlsruhe (www.karlsruhe.de)
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published
+# by the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+'''
+Metrics for import runs.
+'''
+
+from __future__ import (absolute_import, division, print_function,
+                        unicode_literals)
+
+import collections
+import threading
+from timeit import default_timer
+
+import ckanapi
+from ckan.logic import NotFound
+
+
+__all__ = ['Metrics', 'InstrumentedAPI']
+
+
+#: Possible outcomes of API calls.
+CALL_OUTCOMES = ('ok', 'not_found', 'validation_error', 'other')
+
+#: Possible results of entity syncs.
+ENTITY_RESULTS = ('created', 'updated', 'unchanged', 'deleted', 'failed')
+
+
+def _get_outcome(exception):
+    '''
+    Get the outcome of an API call from the exception it raised.
+    '''
+    if exception is None:
+        return 'ok'
+    if isinstance(exception, NotFound):
+        return 'not_found'
+    if isinstance(exception, ckanapi.ValidationError):
+        return 'validation_error'
+    return 'other'
+
+
+class Metrics(object):
+    '''
+    Collects metrics about an import run.
+
+    The number and the duration of CKAN API calls are recorded per
+    action and outcome (see ``CALL_OUTCOMES``), and the results of
+    entity syncs are recorded per entity type (see ``ENTITY_RESULTS``).
+
+    ``labels`` is an optional dict of labels that are added to all
+    metrics exported via :py:meth:`to_prometheus`.
+
+    Instances can be used from several threads.
+    '''
+    def __init__(self, labels=None):
+        self.labels = dict(labels or {})
+        self._lock = threading.Lock()
+        self._start = default_timer()
+        # (action, outcome) -> [count, seconds]
+        self._calls = collections.defaultdict(lambda: [0, 0.0])
+        # (entity_type, result) -> count
+        self._entities = collections.Counter()
+
+    def record_call(self, action, outcome, seconds):
+        '''
+        Record a CKAN API call.
+        '''
+        with self._lock:
+            call = self._calls[action, outcome]
+            call[0] += 1
+            call[1] += seconds
+
+    def record_entity(self, entity_type, result):
+        '''
+        Record the result of syncing or deleting an entity.
+        '''
+        with self._lock:
+            self._entities[entity_type, result] += 1
+
+    def stats(self):
+        '''
+        Get the collected metrics.
+
+        Returns a dict with the following keys:
+
+        ``elapsed``
+            Seconds since the metrics were created.
+
+        ``actions``
+            A dict that maps action names to dicts which map call
+            outcomes to dicts with the keys ``count`` and ``seconds``.
+
+        ``entities``
+            A dict that maps entity types to dicts which map entity
+            results to counts.
+        '''
+        with self._lock:
+            actions = {}
+            for (action, outcome), (count, seconds) in self._calls.items():
+                actions.setdefault(action, {})[outcome] = {
+                    'count': count,
+                    'seconds': seconds,
+                }
+            entities = {}
+            for (entity_type, result), count in self._entities.items():
+                entities.setdefault(entity_type, {})[result] = count
+        return {
+            'elapsed': default_timer() - self._start,
+            'actions': actions,
+            'entities': entities,
+        }
+
+    def summary(self):
+        '''
+        Get a human-readable summary of the collected metrics.
+
+        API actions are sorted by the total time spent in them. The
+        share of the wall time can exceed 100% if calls were made
+        concurrently.
+        '''
+        stats = self.stats()
+        elapsed = stats['elapsed']
+        lines = ['Elapsed time: {:.1f}s'.format(elapsed)]
+        totals = []
+        for action, outcomes in stats['actions'].items():
+            count = sum(o['count'] for o in outcomes.values())
+            seconds = sum(o['seconds'] for o in outcomes.values())
+            failed = count - outcomes.get('ok', {}).get('count', 0)
+            totals.append((seconds, count, failed, action))
+        for seconds, count, failed, action in sorted(totals, reverse=True):
+            share = 100 * seconds / elapsed if elapsed else 0
+            lines.append('{}: {} calls ({} failed), {:.1f}s ({:.0f}% of wall time)'.format(
+                         action, count, failed, seconds, share))
+        for entity_type, results in sorted(stats['entities'].items()):
+            lines.append('{}s: {}'.format(entity_type, ', '.join(
+                         '{} {}'.format(results[r], r) for r in ENTITY_RESULTS
+                         if r in results)))
+        return '\n'.join(lines)
+
+    def to_prometheus(self, prefix='ckanext_importer'):
+        '''
+        Export the collected metrics in Prometheus' text format.
+        '''
+        stats = self.stats()
+        lines = []
+
+        def metric(name, type, help, samples):
+            name = prefix + '_' + name
+            lines.append('# HELP {} {}'.format(name, help))
+            lines.append('# TYPE {} {}'.format(name, type))
+            for labels, value in samples:
+                labels = dict(self.labels, **labels)
+                label_str = ','.join('{}="{}"'.format(k, _escape_label_value(v))
+                                     for k, v in sorted(labels.items()))
+                lines.append('{}{{{}}} {}'.format(name, label_str, value))
+
+        calls = [({'action': action, 'outcome': outcome}, values)
+                 for action, outcomes in sorted(stats['actions'].items())
+                 for outcome, values in sorted(outcomes.items())]
+        metric('api_calls_total', 'counter', 'Number of CKAN API calls.',
+               [(labels, values['count']) for labels, values in calls])
+        metric('api_call_seconds_total', 'counter',
+               'Time spent in CKAN API calls.',
+               [(labels, repr(values['seconds'])) for labels, values in calls])
+        metric('entities_total', 'counter', 'Number of synced entities.',
+               [({'type': entity_type, 'result': result}, count)
+                for entity_type, results in sorted(stats['entities'].items())
+                for result, count in sorted(results.items())])
+        metric('elapsed_seconds', 'gauge',
+               'Time since the start of the import run.',
+               [({}, repr(stats['elapsed']))])
+        return '\n'.join(lines) + '\n'
+
+
+def _escape_label_value(value):
+    '''
+    Escape a label value for Prometheus' text format.
+    '''
+    return (str(value).replace('\\', '\\\\').replace('"', '\\"')
+            .replace('\n', '\\n'))
+
+
+class InstrumentedAPI(object):
+    '''
+    Wrapper around a CKAN API client that records metrics.
+
+    ``api`` is an instance of ``ckanapi.LocalCKAN`` or
+    ``ckanapi.RemoteCKAN`` (or any other object with a compatible
+    ``action`` attribute). Each call of an action via the wrapper's
+    ``action`` attribute is recorded in ``metrics``, an instance of
+    :py:class:`Metrics`.
+    '''
+    def __init__(self, api, metrics):
+        #: The wrapped API client
+        self.api = api
+        self.metrics = metrics
+        self.action = InstrumentedAPI._Action(self)
+
+    class _Action(object):
+        def __init__(self, instrumented):
+            self._instrumented = instrumented
+
+        def __getattr__(self, name):
+            func = getattr(self._instrumented.api.action, name)
+            metrics = self._instrumented.metrics
+
+            def call(**kwargs):
+                start = default_timer()
+                exception = None
+                try:
+                    return func(**kwargs)
+                except Exception as e:
+                    exception = e
+                    raise
+                finally:
+                    metrics.record_call(name, _get_outcome(exception),
+                                        default_timer() - start)
+
+            return call
+
+    def __repr__(self):
+        return '<{} for {!r}>'.format(self.__class__.__name__, self.api)
@@ -0,0 +1,405 @@
+#!/usr/bin/env python
+# encoding: utf-8
+
+# Copyright (C) 2018 Stadt Karlsruhe (www.karlsruhe.de)
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published
+# by the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+'''
+Plan mode: computing changes first and applying them later.
+'''
+
+from __future__ import (absolute_import, division, print_function,
+                        unicode_literals)
+
+from concurrent.futures import ThreadPoolExecutor
+import collections
+from copy import deepcopy
+import json
+import logging
+import threading
+
+from . import _BULK_DELETE_BATCH_SIZE
+
+
+__all__ = ['Plan', 'ApplyReport']
+
+
+log = logging.getLogger(__name__)
+
+
+#: Version of the serialization format of :py:class:`Plan`.
+_FORMAT_VERSION = 1
+
+
+#: Result of :py:meth:`Plan.apply`.
+#:
+#: ``applied`` is a list of the indices of the operations that have been
+#: applied and ``failed`` is a dict that maps the indices of the
+#: operations that could not be applied to the corresponding exceptions.
+ApplyReport = collections.namedtuple('ApplyReport', ['applied', 'failed'])
+
+
+class Plan(object):
+    '''
+    Changes computed by an importer in plan mode.
+
+    If a plan is passed as the ``plan`` argument of
+    :py:class:`~ckanext.importer.Importer` then the importer still reads
+    from CKAN as usual, but instead of creating, updating, and deleting
+    packages and views it records these operations in the plan. The
+    plan can then be inspected, serialized using :py:meth:`to_json`, and
+    applied later using :py:meth:`apply`.
+
+    ``operations`` is the list of recorded operations. Each operation is
+    a dict with the following keys:
+
+    ``entity``
+        The type of the entity, ``package`` or ``view``. Changes of
+        resources are part of the operations of their packages.
+
+    ``kind``
+        ``create``, ``update``, or ``delete``.
+
+    ``action`` and ``data``
+        The name of the CKAN action and its data dict.
+
+    ``importer_id`` and ``package_eid``
+        The ID of the importer and the EID of the package.
+
+    ``resource_eid``, ``resource_id``, and ``view_eid``
+        Only for views. ``resource_id`` is ``None`` if the resource is
+        created by an operation of the plan.
+
+    ``diff``
+        Only for updates. A dict that maps the keys of the modified
+        fields to dicts containing the ``old`` and the ``new`` value. One
+        of these is missing if the field has been added or removed.
+
+    Instances can be used from several threads.
+    '''
+    def __init__(self, operations=None):
+        self.operations = list(operations or [])
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self.operations)
+
+    def __repr__(self):
+        return '<{} with {} operations>'.format(self.__class__.__name__,
+                                                 len(self))
+
+    def summary(self):
+        '''
+        Get a human-readable summary of the operations.
+        '''
+        counts = collections.Counter((op['entity'], op['kind'])
+                                     for op in self.operations)
+        lines = []
+        for entity in ('package', 'view'):
+            parts = ['{} {}'.format(counts[entity, kind], kind)
+                     for kind in ('create', 'update', 'delete')
+                     if counts[entity, kind]]
+            if parts:
+                lines.append('{}s: {}'.format(entity, ', '.join(parts)))
+        return '\n'.join(lines) or 'No changes'
+
+    def to_json(self):
+        '''
+        Serialize the plan to a JSON string.
+        '''
+        with self._lock:
+            return json.dumps({'version': _FORMAT_VERSION,
+                               'operations': self.operations})
+
+    @classmethod
+    def from_json(cls, s):
+        '''
+        Deserialize a plan from a JSON string created by
+        :py:meth:`to_json`.
+        '''
+        data = json.loads(s)
+        if data.get('version') != _FORMAT_VERSION:
+            raise ValueError('Unsupported plan format version {!r}'.format(
+                             data.get('version')))
+        return cls(data['operations'])
+
+    def _add(self, op):
+        with self._lock:
+            self.operations.append(deepcopy(op))
+
+    def _record_package_upload(self, pkg):
+        '''
+        Record the creation or update of a package.
+        '''
+        op = {
+            'entity': 'package',
+            'importer_id': pkg._imp.id,
+            'package_eid': pkg._eid,
+        }
+        if 'id' not in pkg._dict:
+            op.update(kind='create', action='package_create', data=pkg._dict)
+        else:
+            action, data_dict = pkg._get_upload_action()
+            op.update(kind='update', action=action, data=data_dict,
+                      diff=_get_diff(pkg))
+        self._add(op)
+
+    def _record_package_deletion(self, pkg, purge=True):
+        '''
+        Record the deletion of a package.
+
+        If ``purge`` is false then the package is only marked as deleted
+        when the plan is applied.
+        '''
+        data = {'id': pkg._dict['id']}
+        if not purge:
+            data['owner_org'] = pkg._dict.get('owner_org')
+        self._add({
+            'entity': 'package',
+            'kind': 'delete',
+            'action': 'dataset_purge' if purge else 'package_delete',
+            'data': data,
+            'importer_id': pkg._imp.id,
+            'package_eid': pkg._eid,
+        })
+
+    def _view_op(self, view, **kwargs):
+        res = view._parent
+        kwargs.update(
+            entity='view',
+            importer_id=view._imp.id,
+            package_eid=res._parent._eid,
+            resource_eid=res._eid,
+            resource_id=res._dict.get('id'),
+            view_eid=view._eid,
+        )
+        return kwargs
+
+    def _record_view_upload(self, view):
+        '''
+        Record the creation or update of a view.
+        '''
+        if 'id' not in view._dict:
+            op = self._view_op(view, kind='create',
+                               action='resource_view_create', data=view._dict)
+        else:
+            op = self._view_op(view, kind='update',
+                               action='resource_view_update', data=view._dict,
+                               diff=_get_diff(view))
+        self._add(op)
+
+    def _record_view_deletion(self, view):
+        '''
+        Record the deletion of a view.
+        '''
+        self._add(self._view_op(view, kind='delete',
+                                action='resource_view_delete',
+                                data={'id': view._dict['id']}))
+
+    def apply(self, api, workers=1):
+        '''
+        Apply the plan.
+
+        ``api`` is an instance of ``ckanapi.LocalCKAN`` or
+        ``ckanapi.RemoteCKAN``.
+
+        The operations are applied in three phases:
+
+        1. Packages are deleted. Packages that are only marked as deleted
+           are deleted in batches per organization using
+           ``bulk_update_delete``.
+
+        2. Packages are created and updated.
+
+        3. Views are created, updated, and deleted. The operations of
+           each resource are applied together, and newly created views
+           are registered in their resource using a single
+           ``resource_patch`` call per resource.
+
+        Within each phase, up to ``workers`` batches of operations are
+        applied concurrently using a pool of threads.
+
+        Errors are logged, but do not stop the application of the
+        remaining operations. Operations on views of packages whose
+        creation failed fail as well.
+
+        Returns an :py:class:`ApplyReport`.
+        '''
+        report = ApplyReport([], {})
+        deletions = []
+        uploads = []
+        views = collections.OrderedDict()
+        for index, op in enumerate(self.operations):
+            if op['entity'] == 'view':
+                key = op['resource_id'] or (op['importer_id'], op['package_eid'],
+                                            op['resource_eid'])
+                views.setdefault(key, []).append((index, op))
+            elif op['kind'] == 'delete':
+                deletions.append((index, op))
+            else:
+                uploads.append((index, op))
+
+        # Resource IDs of uploaded packages by importer ID, package EID,
+        # and resource EID
+        resource_ids = {}
+
+        def upload(batch):
+            [(index, op)] = batch
+            result = getattr(api.action, op['action'])(**op['data'])
+            if op['action'] == 'package_revise':
+                result = result['package']
+            for res_dict in result.get('resources', []):
+                eid = res_dict.get('ckanext_importer_resource_eid')
+                if eid is not None:
+                    key = (op['importer_id'], op['package_eid'], eid)
+                    resource_ids[key] = res_dict['id']
+            return [(index, None)]
+
+        def apply_views(batch):
+            return _apply_view_batch(api, batch, resource_ids)
+
+        _run_batches(_deletion_batches(api, deletions), workers, report)
+        _run_batches([(upload, [item]) for item in uploads], workers, report)
+        _run_batches([(apply_views, batch) for batch in views.values()],
+                     workers, report)
+        report.applied.sort()
+        log.info('Applied {} operations ({} failures)'.format(
+                 len(report.applied), len(report.failed)))
+        return report
+
+
+def _get_diff(entity):
+    '''
+    Get the diff of the changes that have been made to an entity.
+    '''
+    original = entity._get_original()
+    diff = {}
+    for key in entity._changed_keys():
+        change = {}
+        if key in original:
+            change['old'] = original[key]
+        if key in entity._dict:
+            change['new'] = entity._dict[key]
+        diff[key] = change
+    return diff
+
+
+def _deletion_batches(api, deletions):
+    '''
+    Split package deletions into batches.
+
+    Returns a list of ``(func, batch)`` pairs for :py:func:`_run_batches`.
+    '''
+    def purge(batch):
+        [(index, op)] = batch
+        api.action.dataset_purge(**op['data'])
+        return [(index, None)]
+
+    def bulk_delete(batch):
+        org_id = batch[0][1]['data']['owner_org']
+        api.action.bulk_update_delete(
+            datasets=[op['data']['id'] for _, op in batch], org_id=org_id)
+        return [(index, None) for index, _ in batch]
+
+    def delete(batch):
+        [(index, op)] = batch
+        api.action.package_delete(id=op['data']['id'])
+        return [(index, None)]
+
+    batches = []
+    by_org = collections.OrderedDict()
+    for index, op in deletions:
+        if op['action'] == 'dataset_purge':
+            batches.append((purge, [(index, op)]))
+        elif op['data'].get('owner_org'):
+            by_org.setdefault(op['data']['owner_org'], []).append((index, op))
+        else:
+            batches.append((delete, [(index, op)]))
+    for org_ops in by_org.values():
+        for i in range(0, len(org_ops), _BULK_DELETE_BATCH_SIZE):
+            batches.append((bulk_delete, org_ops[i:i + _BULK_DELETE_BATCH_SIZE]))
+    return batches
+
+
+def _apply_view_batch(api, batch, resource_ids):
+    '''
+    Apply the view operations of a single resource.
+
+    Returns a list of ``(index, exception)`` pairs, where ``exception``
+    is ``None`` for successful operations.
+    '''
+    results = []
+    op = batch[0][1]
+    resource_id = op['resource_id'] or resource_ids.get(
+        (op['importer_id'], op['package_eid'], op['resource_eid']))
+    if resource_id is None:
+        e = RuntimeError('Resource with EID {!r} of package with EID {!r} does not exist'.format(
+                         op['resource_eid'], op['package_eid']))
+        return [(index, e) for index, _ in batch]
+    created = []
+    for index, op in batch:
+        try:
+            if op['kind'] == 'create':
+                view_dict = api.action.resource_view_create(
+                    **dict(op['data'], resource_id=resource_id))
+                created.append((index, op['view_eid'], view_dict['id']))
+            else:
+                getattr(api.action, op['action'])(**op['data'])
+                results.append((index, None))
+        except Exception as e:
+            log.error('Error while applying operation {}: {}'.format(index, e))
+            results.append((index, e))
+    if created:
+        try:
+            res_dict = api.action.resource_show(id=resource_id)
+            views = json.loads(res_dict.get('ckanext_importer_views', '{}'))
+            for _, eid, id in created:
+                views[eid] = id
+            api.action.resource_patch(
+                id=resource_id,
+                ckanext_importer_views=json.dumps(views, separators=(',', ':')))
+            results.extend((index, None) for index, _, _ in created)
+        except Exception as e:
+            log.error('Error while registering views in resource {!r}: {}'.format(
+                      resource_id, e))
+            results.extend((index, e) for index, _, _ in created)
+    return results
+
+
+def _run_batches(batches, workers, report):
+    '''
+    Run batches of operations using a pool of threads.
+
+    ``batches`` is a list of ``(func, batch)`` pairs, where ``batch`` is
+    a list of ``(index, op)`` pairs and ``func(batch)`` returns a list of
+    ``(index, exception)`` pairs. If ``func`` raises an exception then
+    all operations of the batch are considered to have failed.
+    '''
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        futures = [(executor.submit(func, batch), batch)
+                   for func, batch in batches]
+        for future, batch in futures:
+            exception = future.exception()
+            if exception is None:
+                results = future.result()
+            else:
+                log.error('Error while applying operations {}: {}'.format(
+                          [index for index, _ in batch], exception))
+                results = [(index, exception) for index, _ in batch]
+            for index, e in results:
+                if e is None:
+                    report.applied.append(index)
+                else:
+                    report.failed[index] = e
@@ -0,0 +1,67 @@
+#!/usr/bin/env python
+# encoding: utf-8
+
+# Copyright (C) 2018 Stadt Karlsruhe (www.karlsruhe.de)
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published
+# by the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+'''
+CKAN plugin for *ckanext.importer*.
+
+The plugin is optional. If it is enabled then the importer ID and the
+EID of each package are additionally indexed as exact-match string
+fields, which allows :py:class:`~ckanext.importer.Importer` to find its
+packages without retrieving packages of other importers.
+'''
+
+from __future__ import (absolute_import, division, print_function,
+                        unicode_literals)
+
+import ckan.plugins as plugins
+
+from . import _EXACT_FIELDS
+
+
+__all__ = ['ImporterPlugin']
+
+
+class ImporterPlugin(plugins.SingletonPlugin):
+    '''
+    Plugin that adds exact-match search fields for imported packages.
+    '''
+    plugins.implements(plugins.IPackageController, inherit=True)
+
+    def before_index(self, pkg_dict):
+        # CKAN < 2.10
+        return _add_exact_fields(pkg_dict)
+
+    def before_dataset_index(self, pkg_dict):
+        # CKAN >= 2.10
+        return _add_exact_fields(pkg_dict)
+
+
+def _add_exact_fields(pkg_dict):
+    '''
+    Add the exact-match fields to a package dict that is being indexed.
+
+    At this point CKAN has already stored each extra ``<key>`` in an
+    ``extras_<key>`` field. These fields are tokenized by Solr, so their
+    values are copied into fields without a suffix, which CKAN's Solr
+    schema indexes as plain strings.
+    '''
+    for key, field in _EXACT_FIELDS.items():
+        value = pkg_dict.get('extras_' + key)
+        if value is not None:
+            pkg_dict[field] = value
+    return pkg_dict
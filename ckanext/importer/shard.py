@@ -0,0 +1,276 @@
+#!/usr/bin/env python
+# encoding: utf-8
+
+# Copyright (C) 2018 Stadt Karlsruhe (www.karlsruhe.de)
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published
+# by the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+'''
+Coordination of importers that are split into shards.
+'''
+
+from __future__ import (absolute_import, division, print_function,
+                        unicode_literals)
+
+import hashlib
+import logging
+import sqlite3
+import threading
+import time
+import uuid
+
+
+__all__ = ['ShardCoordinator', 'get_shard']
+
+
+log = logging.getLogger(__name__)
+
+
+def get_shard(eid, num_shards):
+    '''
+    Get the shard of an EID.
+
+    Returns the index of the shard (between 0 and ``num_shards - 1``) to
+    which the given EID belongs. The result does not depend on the
+    process or the machine.
+    '''
+    digest = hashlib.sha1(str(eid).encode('utf-8')).hexdigest()
+    return int(digest, 16) % num_shards
+
+
+class ShardCoordinator(object):
+    '''
+    Coordinates the shards of an importer.
+
+    An importer can be split into shards that are synced by different
+    processes or machines (see the ``shard`` argument of
+    :py:class:`~ckanext.importer.Importer`). Since no shard sees all
+    EIDs, the shards cannot delete unsynced packages themselves.
+    Instead, each shard reports its synced EIDs to the coordinator via
+    :py:meth:`report` once it is finished, and the unsynced packages are
+    then deleted exactly once using :py:meth:`delete_unsynced_packages`.
+
+    ``path`` is the path of an SQLite database file that all shards can
+    access. It is created if it doesn't exist. ``timeout`` is the number
+    of seconds to wait for other processes that access the database.
+
+    ``claim_timeout`` is the number of seconds after which a running
+    deletion of unsynced packages is assumed to have crashed, see
+    :py:meth:`delete_unsynced_packages`. It must be longer than any
+    deletion takes.
+    '''
+    def __init__(self, path, timeout=60, claim_timeout=24 * 60 * 60):
+        self.path = path
+        self.claim_timeout = claim_timeout
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(path, timeout=timeout,
+                                   check_same_thread=False)
+        with self._db:
+            self._db.execute('''
+                CREATE TABLE IF NOT EXISTS shards (
+                    importer_id TEXT NOT NULL,
+                    shard INTEGER NOT NULL,
+                    num_shards INTEGER NOT NULL,
+                    report_id TEXT NOT NULL,
+                    PRIMARY KEY (importer_id, shard)
+                )
+            ''')
+            self._db.execute('''
+                CREATE TABLE IF NOT EXISTS synced (
+                    importer_id TEXT NOT NULL,
+                    shard INTEGER NOT NULL,
+                    report_id TEXT NOT NULL,
+                    eid TEXT NOT NULL
+                )
+            ''')
+            self._db.execute('''
+                CREATE INDEX IF NOT EXISTS synced_importer_shard
+                ON synced (importer_id, shard)
+            ''')
+            # Importers whose unsynced packages are currently being
+            # deleted, with the deletion's ID and start time
+            self._db.execute('''
+                CREATE TABLE IF NOT EXISTS claims (
+                    importer_id TEXT PRIMARY KEY,
+                    owner TEXT NOT NULL,
+                    claimed_at REAL NOT NULL
+                )
+            ''')
+
+    def _release_stale_claim(self, importer_id):
+        '''
+        Release the claim of a deletion that has exceeded
+        ``claim_timeout``.
+
+        Must be called inside of a transaction.
+        '''
+        cursor = self._db.execute(
+            'DELETE FROM claims WHERE importer_id = ? AND claimed_at < ?',
+            (importer_id, time.time() - self.claim_timeout))
+        if cursor.rowcount:
+            log.warning('Released stale claim for importer {!r}'.format(
+                        importer_id))
+
+    def report(self, imp):
+        '''
+        Report that a shard has been synced.
+
+        ``imp`` is the :py:class:`~ckanext.importer.Importer` of the
+        shard. Its synced EIDs are stored, replacing an earlier report of
+        the same shard.
+
+        A shard may report while the unsynced packages are being deleted.
+        The deletion uses the reports that existed when it started, and
+        the new report is kept for the next deletion. A deletion that has
+        exceeded ``claim_timeout`` (see :py:meth:`delete_unsynced_packages`)
+        is released, so that the new reports can be used.
+        '''
+        if imp.shard is None:
+            raise ValueError('{} is not sharded'.format(imp))
+        shard, num_shards = imp.shard
+        with imp._lock:
+            eids = [eid for eid in imp._synced_child_eids if imp.owns(eid)]
+        report_id = uuid.uuid4().hex
+        with self._lock, self._db:
+            self._db.execute('DELETE FROM synced WHERE importer_id = ? AND shard = ?',
+                             (imp.id, shard))
+            self._db.executemany(
+                'INSERT INTO synced (importer_id, shard, report_id, eid) '
+                'VALUES (?, ?, ?, ?)',
+                ((imp.id, shard, report_id, eid) for eid in eids))
+            self._db.execute(
+                'INSERT OR REPLACE INTO shards '
+                '(importer_id, shard, num_shards, report_id) VALUES (?, ?, ?, ?)',
+                (imp.id, shard, num_shards, report_id))
+            self._release_stale_claim(imp.id)
+        log.info('Shard {} of {} for importer {!r} reported {} synced packages'.format(
+                 shard, num_shards, imp.id, len(eids)))
+
+    def missing_shards(self, importer_id, num_shards):
+        '''
+        Get the shards of an importer that have not been reported yet.
+
+        Returns a sorted list of shard indices.
+        '''
+        with self._lock:
+            rows = self._db.execute(
+                'SELECT shard FROM shards WHERE importer_id = ? AND num_shards = ?',
+                (importer_id, num_shards)).fetchall()
+        reported = set(row[0] for row in rows)
+        return [shard for shard in range(num_shards) if shard not in reported]
+
+    def delete_unsynced_packages(self, imp, num_shards, **kwargs):
+        '''
+        Delete the packages that have not been synced by any shard.
+
+        ``imp`` is an :py:class:`~ckanext.importer.Importer` without
+        ``shard`` for the same importer ID as the shards. The EIDs that
+        have been reported by the shards are marked as synced in ``imp``,
+        and then :py:meth:`~ckanext.importer.Importer.delete_unsynced_packages`
+        is called with the remaining keyword arguments.
+
+        All ``num_shards`` shards must have been reported, otherwise a
+        ``RuntimeError`` is raised. The reports are claimed in a
+        transaction, so that the deletion happens exactly once per run
+        even if several processes call this method: while the deletion
+        is running, other calls raise a ``RuntimeError``. Once the
+        deletion has succeeded the reports are consumed, and a
+        ``RuntimeError`` is raised until the shards report again. Reports
+        made during the deletion are kept. If the deletion fails (for
+        example because ``max_deletions`` is exceeded) then the claim is
+        released and the reports are kept, so that the deletion can be
+        retried. If the process crashes during the deletion then its
+        claim is released once it is older than ``claim_timeout``.
+
+        Returns the :py:class:`~ckanext.importer.DeletionReport`.
+        '''
+        if imp.shard is not None:
+            raise ValueError('{} must not be sharded'.format(imp))
+        with self._lock:
+            try:
+                # Lock the database for other processes
+                self._db.execute('BEGIN IMMEDIATE')
+                reports = self._db.execute(
+                    'SELECT shard, report_id FROM shards '
+                    'WHERE importer_id = ? AND num_shards = ?',
+                    (imp.id, num_shards)).fetchall()
+                missing = set(range(num_shards)) - set(row[0] for row in reports)
+                if missing:
+                    raise RuntimeError('Shards {} of importer {!r} have not been reported'.format(
+                                       sorted(missing), imp.id))
+                self._release_stale_claim(imp.id)
+                claimed = self._db.execute(
+                    'SELECT 1 FROM claims WHERE importer_id = ?',
+                    (imp.id,)).fetchone()
+                if claimed:
+                    raise RuntimeError('Unsynced packages of importer {!r} are already being deleted'.format(
+                                       imp.id))
+                eids = [row[0] for row in self._db.execute(
+                        'SELECT eid FROM synced WHERE importer_id = ?', (imp.id,))]
+                owner = uuid.uuid4().hex
+                self._db.execute(
+                    'INSERT INTO claims (importer_id, owner, claimed_at) '
+                    'VALUES (?, ?, ?)', (imp.id, owner, time.time()))
+                self._db.commit()
+            except Exception:
+                self._db.rollback()
+                raise
+        with imp._lock:
+            imp._synced_child_eids.update(eids)
+        try:
+            report = imp.delete_unsynced_packages(**kwargs)
+        except Exception:
+            with self._lock, self._db:
+                self._release_claim(imp.id, owner)
+            raise
+        with self._lock, self._db:
+            # Only consume the reports that the deletion has used
+            for shard, report_id in reports:
+                self._db.execute(
+                    'DELETE FROM synced '
+                    'WHERE importer_id = ? AND shard = ? AND report_id = ?',
+                    (imp.id, shard, report_id))
+                self._db.execute(
+                    'DELETE FROM shards '
+                    'WHERE importer_id = ? AND shard = ? AND report_id = ?',
+                    (imp.id, shard, report_id))
+            self._release_claim(imp.id, owner)
+        return report
+
+    def _release_claim(self, importer_id, owner):
+        '''
+        Release the claim of a deletion.
+
+        Does nothing if the claim has already been released as stale.
+
+        Must be called inside of a transaction.
+        '''
+        self._db.execute('DELETE FROM claims WHERE importer_id = ? AND owner = ?',
+                         (importer_id, owner))
+
+    def close(self):
+        '''
+        Close the database.
+        '''
+        with self._lock:
+            self._db.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def __repr__(self):
+        return '<{} path={!r}>'.format(self.__class__.__name__, self.path)
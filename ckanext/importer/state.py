@@ -0,0 +1,165 @@
+#!/usr/bin/env python
+# encoding: utf-8
+
+# Copyright (C) 2018 Stadt Karlsruhe (www.karlsruhe.de)
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published
+# by the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+from __future__ import (absolute_import, division, print_function,
+                        unicode_literals)
+
+import collections
+import sqlite3
+import threading
+
+
+__all__ = ['StateStore']
+
+
+#: A stored package entry.
+StateEntry = collections.namedtuple(
+    'StateEntry', ['package_id', 'metadata_modified', 'fingerprint'])
+
+
+class StateStore(object):
+    '''
+    Persistent local store for the state of imported packages.
+
+    The store remembers, for each importer and package EID, the ID of
+    the corresponding CKAN package, the package's ``metadata_modified``
+    timestamp, and the fingerprint of its source record (see
+    :py:meth:`ckanext.importer.Importer.skip_if_unchanged`). This allows
+    a new :py:class:`~ckanext.importer.Importer` instance to find
+    existing packages without searching for them.
+
+    ``path`` is the path of the SQLite database file. It is created if
+    it doesn't exist.
+
+    The store can be shared by several importers and can be used from
+    several threads. Changes are written to disk in batches of
+    ``commit_interval`` changes and when :py:meth:`close` is called.
+    '''
+    def __init__(self, path, commit_interval=100):
+        self.path = path
+        self.commit_interval = commit_interval
+        self._lock = threading.Lock()
+        self._num_uncommitted = 0
+        self._db = sqlite3.connect(path, check_same_thread=False)
+        with self._db:
+            self._db.execute('''
+                CREATE TABLE IF NOT EXISTS packages (
+                    importer_id TEXT NOT NULL,
+                    eid TEXT NOT NULL,
+                    package_id TEXT NOT NULL,
+                    metadata_modified TEXT,
+                    fingerprint TEXT,
+                    PRIMARY KEY (importer_id, eid)
+                )
+            ''')
+
+    def get(self, importer_id, eid):
+        '''
+        Get the stored entry for a package.
+
+        Returns an instance of ``StateEntry`` or ``None`` if no entry
+        exists for the given importer ID and EID.
+        '''
+        with self._lock:
+            row = self._db.execute(
+                'SELECT package_id, metadata_modified, fingerprint '
+                'FROM packages WHERE importer_id = ? AND eid = ?',
+                (importer_id, eid)).fetchone()
+        if row is None:
+            return None
+        return StateEntry(*row)
+
+    def entries(self, importer_id):
+        '''
+        Get all stored entries for an importer.
+
+        Returns a dict mapping EIDs to instances of ``StateEntry``.
+        '''
+        with self._lock:
+            rows = self._db.execute(
+                'SELECT eid, package_id, metadata_modified, fingerprint '
+                'FROM packages WHERE importer_id = ?',
+                (importer_id,)).fetchall()
+        return {row[0]: StateEntry(*row[1:]) for row in rows}
+
+    def put(self, importer_id, eid, package_id, metadata_modified=None,
+            fingerprint=None):
+        '''
+        Store the entry for a package.
+
+        An existing entry for the same importer ID and EID is replaced.
+
+        ``metadata_modified`` should be ``None`` if the package's current
+        ``metadata_modified`` value is not known.
+        '''
+        self._write(
+            'INSERT OR REPLACE INTO packages (importer_id, eid, package_id, '
+            'metadata_modified, fingerprint) VALUES (?, ?, ?, ?, ?)',
+            (importer_id, eid, package_id, metadata_modified, fingerprint))
+
+    def remove(self, importer_id, eid):
+        '''
+        Remove the entry for a package.
+
+        Does nothing if no such entry exists.
+        '''
+        self._write('DELETE FROM packages WHERE importer_id = ? AND eid = ?',
+                    (importer_id, eid))
+
+    def clear(self, importer_id):
+        '''
+        Remove all entries for an importer.
+        '''
+        self._write('DELETE FROM packages WHERE importer_id = ?',
+                    (importer_id,))
+
+    def _write(self, sql, parameters):
+        with self._lock:
+            self._db.execute(sql, parameters)
+            self._num_uncommitted += 1
+            if self._num_uncommitted >= self.commit_interval:
+                self._commit()
+
+    def _commit(self):
+        self._db.commit()
+        self._num_uncommitted = 0
+
+    def commit(self):
+        '''
+        Write all pending changes to disk.
+        '''
+        with self._lock:
+            self._commit()
+
+    def close(self):
+        '''
+        Write all pending changes to disk and close the store.
+        '''
+        with self._lock:
+            self._commit()
+            self._db.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def __repr__(self):
+        return '<{} path={!r}>'.format(self.__class__.__name__, self.path)
@@ -0,0 +1,401 @@
+#!/usr/bin/env python
+# encoding: utf-8
+
+# Copyright (C) 2018 Stadt Karlsruhe (www.karlsruhe.de)
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published
+# by the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+'''
+In-memory stand-in for the parts of CKAN's action API that are used by
+*ckanext.importer*.
+
+The fake keeps all packages in memory and answers package searches using
+indexes for the importer ID, the package EID, and the package ID, so that
+it stays fast for large numbers of packages. Search filters are matched
+exactly, i.e. the fake behaves like CKAN with the ``importer`` plugin
+enabled, regardless of which fields are queried. Only packages that have
+been stored while the plugin was disabled lack the exact-match fields,
+until :py:meth:`FakeCKAN.rebuild_search_index` is called.
+'''
+
+from __future__ import (absolute_import, division, print_function,
+                        unicode_literals)
+
+import bisect
+import collections
+import datetime
+import json
+import re
+import threading
+import time
+import uuid
+
+import ckanapi
+
+
+__all__ = ['FakeCKAN', 'FakeLocalCKAN']
+
+
+_IMPORTER_ID_RE = re.compile(
+    r'(?:extras_ckanext_importer_importer_id|ckanext_importer_exact_importer_id)'
+    r':"((?:[^"\\]|\\.)*)"')
+_EID_RE = re.compile(
+    r'(?:extras_ckanext_importer_package_eid|ckanext_importer_exact_package_eid)'
+    r':"((?:[^"\\]|\\.)*)"')
+_NAME_PREFIX_RE = re.compile(r'name:(\S+?)\*')
+_EXACT_FIELD_RE = re.compile(r'(?<!-)ckanext_importer_exact_\w+:"')
+_MISSING_EXACT_FIELD_RE = re.compile(
+    r'-ckanext_importer_exact_importer_id:\[\* TO \*\]')
+_ID_RANGE_RE = re.compile(
+    r'id:([\[{])("(?:[^"\\]|\\.)*"|\*) TO ("(?:[^"\\]|\\.)*"|\*)([\]}])')
+
+#: Maximum number of rows per search, like CKAN's ``ckan.search.rows_max``
+_ROWS_MAX = 1000
+
+
+def _unescape(s):
+    return re.sub(r'\\(.)', r'\1', s)
+
+
+def _copy(data):
+    # Faster than ``copy.deepcopy`` for JSON-like data
+    return json.loads(json.dumps(data))
+
+
+def _merge(old, new):
+    '''
+    Merge ``new`` into ``old`` like CKAN's ``package_revise``.
+
+    Dicts are merged key by key and lists item by item, so items of
+    ``old`` that are not in ``new`` are kept.
+    '''
+    if isinstance(old, dict) and isinstance(new, dict):
+        for key, value in new.items():
+            old[key] = _merge(old[key], value) if key in old else value
+        return old
+    if isinstance(old, list) and isinstance(new, list):
+        for i, value in enumerate(new):
+            if i < len(old):
+                old[i] = _merge(old[i], value)
+            else:
+                old.append(value)
+        return old
+    return new
+
+
+def _get_extra(pkg_dict, key):
+    for extra in pkg_dict.get('extras', []):
+        if extra['key'] == key:
+            return extra['value']
+    return None
+
+
+class FakeCKAN(object):
+    '''
+    In-memory fake of a CKAN API client.
+
+    Can be passed as ``api`` to :py:class:`ckanext.importer.Importer`.
+
+    ``latency`` is the time in seconds that each read action takes, and
+    ``write_latency`` is the time that each write action takes (it
+    defaults to ``latency``). The latency is simulated outside of the
+    fake's lock, so concurrent calls overlap like with a real server.
+
+    ``extensions`` is the list of plugin names reported by
+    ``status_show``.
+
+    The number of calls per action is counted in ``calls``.
+    '''
+    _READ_ACTIONS = {'status_show', 'package_search', 'package_show',
+                     'resource_show', 'resource_view_show',
+                     'resource_view_list'}
+
+    def __init__(self, latency=0, write_latency=None, extensions=('importer',)):
+        self.latency = latency
+        self.write_latency = latency if write_latency is None else write_latency
+        self.extensions = list(extensions)
+        self.calls = collections.Counter()
+        self.action = FakeCKAN._Action(self)
+        self._lock = threading.RLock()
+        self._packages = {}
+        self._names = {}
+        self._importer_ids = collections.defaultdict(list)  # Sorted IDs
+        self._eids = collections.defaultdict(set)
+        self._resources = {}  # resource ID -> package ID
+        self._views = {}
+        self._without_exact_fields = set()  # Package IDs
+
+    class _Action(object):
+        def __init__(self, ckan):
+            self._ckan = ckan
+
+        def __getattr__(self, name):
+            ckan = self._ckan
+            func = getattr(ckan, '_' + name, None)
+            if func is None:
+                raise AttributeError(name)
+            if name in FakeCKAN._READ_ACTIONS:
+                latency = ckan.latency
+            else:
+                latency = ckan.write_latency
+
+            def call(**kwargs):
+                if latency:
+                    time.sleep(latency)
+                with ckan._lock:
+                    ckan.calls[name] += 1
+                    return _copy(func(**_copy(kwargs)))
+
+            return call
+
+    def reset_calls(self):
+        '''
+        Reset the call counters.
+        '''
+        self.calls.clear()
+
+    def count_packages(self):
+        '''
+        Return the number of stored packages.
+        '''
+        return len(self._packages)
+
+    def rebuild_search_index(self):
+        '''
+        Reindex all packages, like CKAN's ``search-index rebuild``.
+        '''
+        if 'importer' in self.extensions:
+            self._without_exact_fields.clear()
+
+    #
+    # Indexing
+    #
+
+    def _index(self, pkg_dict):
+        importer_id = _get_extra(pkg_dict, 'ckanext_importer_importer_id')
+        eid = _get_extra(pkg_dict, 'ckanext_importer_package_eid')
+        bisect.insort(self._importer_ids[importer_id], pkg_dict['id'])
+        self._eids[importer_id, eid].add(pkg_dict['id'])
+        self._names[pkg_dict['name']] = pkg_dict['id']
+        for res_dict in pkg_dict['resources']:
+            self._resources[res_dict['id']] = pkg_dict['id']
+        if 'importer' in self.extensions:
+            self._without_exact_fields.discard(pkg_dict['id'])
+        else:
+            self._without_exact_fields.add(pkg_dict['id'])
+
+    def _unindex(self, pkg_dict):
+        importer_id = _get_extra(pkg_dict, 'ckanext_importer_importer_id')
+        eid = _get_extra(pkg_dict, 'ckanext_importer_package_eid')
+        ids = self._importer_ids[importer_id]
+        del ids[bisect.bisect_left(ids, pkg_dict['id'])]
+        self._eids[importer_id, eid].discard(pkg_dict['id'])
+        del self._names[pkg_dict['name']]
+        for res_dict in pkg_dict['resources']:
+            self._resources.pop(res_dict['id'], None)
+        self._without_exact_fields.discard(pkg_dict['id'])
+
+    def _store(self, pkg_dict, old=None):
+        if old is not None:
+            self._unindex(old)
+        pkg_dict['metadata_modified'] = datetime.datetime.utcnow().isoformat()
+        for res_dict in pkg_dict['resources']:
+            res_dict.setdefault('id', str(uuid.uuid4()))
+            res_dict['package_id'] = pkg_dict['id']
+        self._packages[pkg_dict['id']] = pkg_dict
+        self._index(pkg_dict)
+        return pkg_dict
+
+    def _get_package(self, id):
+        id = self._names.get(id, id)
+        try:
+            return self._packages[id]
+        except KeyError:
+            raise ckanapi.NotFound('Package {!r} not found'.format(id))
+
+    def _get_resource(self, id):
+        try:
+            pkg_dict = self._packages[self._resources[id]]
+        except KeyError:
+            raise ckanapi.NotFound('Resource {!r} not found'.format(id))
+        for res_dict in pkg_dict['resources']:
+            if res_dict['id'] == id:
+                return pkg_dict, res_dict
+
+    #
+    # Actions
+    #
+
+    def _status_show(self):
+        return {'ckan_version': '2.8.0', 'extensions': self.extensions}
+
+    def _package_search(self, fq='', q='', rows=10, start=0, sort=None,
+                        fl=None, include_private=False, **kwargs):
+        fq = ' '.join(filter(None, [fq, q]))
+        importer_id = _IMPORTER_ID_RE.search(fq)
+        eid = _EID_RE.search(fq)
+        name_prefix = _NAME_PREFIX_RE.search(fq)
+        if importer_id and eid:
+            ids = sorted(self._eids[_unescape(importer_id.group(1)),
+                                    _unescape(eid.group(1))])
+        elif importer_id:
+            ids = self._importer_ids[_unescape(importer_id.group(1))]
+        elif name_prefix:
+            prefix = name_prefix.group(1)
+            ids = sorted(id for name, id in self._names.items()
+                         if name.startswith(prefix))
+        else:
+            ids = sorted(self._packages)
+        if _MISSING_EXACT_FIELD_RE.search(fq):
+            ids = [id for id in ids if id in self._without_exact_fields]
+        elif self._without_exact_fields and _EXACT_FIELD_RE.search(fq):
+            ids = [id for id in ids if id not in self._without_exact_fields]
+        id_range = _ID_RANGE_RE.search(fq)
+        if id_range:
+            lower_type, lower, upper, upper_type = id_range.groups()
+            lo, hi = 0, len(ids)
+            if lower != '*':
+                lower = _unescape(lower[1:-1])
+                bisect_func = bisect.bisect_left if lower_type == '[' else bisect.bisect_right
+                lo = bisect_func(ids, lower)
+            if upper != '*':
+                upper = _unescape(upper[1:-1])
+                bisect_func = bisect.bisect_right if upper_type == ']' else bisect.bisect_left
+                hi = bisect_func(ids, upper)
+            ids = ids[lo:hi]
+        rows = min(rows, _ROWS_MAX)
+        page = [self._packages[id] for id in ids[start:start + rows]]
+        if fl:
+            results = []
+            for pkg_dict in page:
+                result = {}
+                for field in fl:
+                    if field.startswith('extras_'):
+                        value = _get_extra(pkg_dict, field[len('extras_'):])
+                    else:
+                        value = pkg_dict.get(field)
+                    if value is not None:
+                        result[field] = value
+                results.append(result)
+            page = results
+        return {'count': len(ids), 'results': page}
+
+    def _package_show(self, id, **kwargs):
+        return self._get_package(id)
+
+    def _package_create(self, name, **kwargs):
+        if name in self._names:
+            raise ckanapi.ValidationError({'name': ['That URL is already in use.']})
+        pkg_dict = dict(kwargs, id=str(uuid.uuid4()), name=name, state='active')
+        pkg_dict.setdefault('extras', [])
+        pkg_dict.setdefault('resources', [])
+        return self._store(pkg_dict)
+
+    def _package_update(self, id, **kwargs):
+        old = self._get_package(id)
+        pkg_dict = dict(kwargs, id=old['id'])
+        pkg_dict.setdefault('name', old['name'])
+        pkg_dict.setdefault('extras', [])
+        pkg_dict.setdefault('resources', [])
+        return self._store(pkg_dict, old)
+
+    def _package_patch(self, id, **kwargs):
+        pkg_dict = _copy(self._get_package(id))
+        pkg_dict.update(kwargs)
+        return self._package_update(**pkg_dict)
+
+    def _package_revise(self, match, update=None, filter=None, **kwargs):
+        pkg_dict = _copy(self._get_package(match['id']))
+        for field in filter or []:
+            if field.startswith('-'):
+                pkg_dict.pop(field[1:], None)
+        _merge(pkg_dict, update or {})
+        return {'package': self._package_update(**pkg_dict)}
+
+    def _dataset_purge(self, id):
+        pkg_dict = self._get_package(id)
+        self._unindex(pkg_dict)
+        del self._packages[pkg_dict['id']]
+
+    def _package_delete(self, id):
+        # Deleted packages are not returned by package_search
+        self._dataset_purge(id)
+
+    def _bulk_update_delete(self, datasets, org_id):
+        for id in datasets:
+            self._package_delete(id)
+
+    def _resource_create(self, package_id, **kwargs):
+        pkg_dict = self._get_package(package_id)
+        res_dict = dict(kwargs, id=str(uuid.uuid4()))
+        pkg_dict['resources'].append(res_dict)
+        self._store(pkg_dict, pkg_dict)
+        return res_dict
+
+    def _resource_show(self, id):
+        return self._get_resource(id)[1]
+
+    def _resource_update(self, id, **kwargs):
+        pkg_dict, res_dict = self._get_resource(id)
+        res_dict.clear()
+        res_dict.update(kwargs, id=id)
+        self._store(pkg_dict, pkg_dict)
+        return res_dict
+
+    def _resource_patch(self, id, **kwargs):
+        pkg_dict, res_dict = self._get_resource(id)
+        res_dict.update(kwargs)
+        self._store(pkg_dict, pkg_dict)
+        return res_dict
+
+    def _resource_delete(self, id):
+        pkg_dict, res_dict = self._get_resource(id)
+        pkg_dict['resources'].remove(res_dict)
+        self._store(pkg_dict, pkg_dict)
+
+    def _resource_view_create(self, resource_id, **kwargs):
+        self._get_resource(resource_id)
+        view_dict = dict(kwargs, id=str(uuid.uuid4()), resource_id=resource_id)
+        self._views[view_dict['id']] = view_dict
+        return view_dict
+
+    def _resource_view_show(self, id):
+        try:
+            return self._views[id]
+        except KeyError:
+            raise ckanapi.NotFound('View {!r} not found'.format(id))
+
+    def _resource_view_update(self, id, **kwargs):
+        view_dict = self._resource_view_show(id)
+        view_dict.update(kwargs)
+        return view_dict
+
+    def _resource_view_delete(self, id):
+        self._resource_view_show(id)
+        del self._views[id]
+
+    def _resource_view_list(self, id):
+        return [view_dict for view_dict in self._views.values()
+                if view_dict['resource_id'] == id]
+
+
+class FakeLocalCKAN(FakeCKAN, ckanapi.LocalCKAN):
+    '''
+    In-memory fake that passes for a ``ckanapi.LocalCKAN``.
+
+    Only the actions are faked, CKAN itself is not used.
+    '''
+    def __init__(self, **kwargs):
+        FakeCKAN.__init__(self, **kwargs)
+        self.context = {'user': 'importer'}
@@ -0,0 +1,145 @@
+#!/usr/bin/env python
+# encoding: utf-8
+
+# Copyright (C) 2018 Stadt Karlsruhe (www.karlsruhe.de)
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published
+# by the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+from __future__ import (absolute_import, division, print_function,
+                        unicode_literals)
+
+import asyncio
+
+import pytest
+
+from .. import Importer, OnError
+from ..aio import AsyncImporter, ThreadedAPI
+from ..transport import TransientError
+
+
+@pytest.fixture
+def async_api(api):
+    threaded = ThreadedAPI(api, max_workers=4)
+    yield threaded
+    threaded.close()
+
+
+async def _sync(imp, eid, title='Title', resources=(), views=()):
+    async with imp.sync_package(eid) as pkg:
+        pkg['title'] = title
+        for res_eid in resources:
+            async with pkg.sync_resource(res_eid) as res:
+                res['name'] = res_eid
+                for view_eid in views:
+                    async with res.sync_view(view_eid) as view:
+                        view['title'] = view_eid
+                        view['view_type'] = 'text_view'
+                await res.delete_unsynced_views()
+        await pkg.delete_unsynced_resources()
+    return pkg
+
+
+@pytest.mark.parametrize('defer', [False, True])
+def test_sync(api, async_api, defer):
+    async def run():
+        imp = AsyncImporter('imp', async_api, defer_resource_writes=defer)
+        await asyncio.gather(*(_sync(imp, str(i), resources=['r1', 'r2'],
+                                     views=['v'])
+                               for i in range(5)))
+        imp = AsyncImporter('imp', async_api, defer_resource_writes=defer)
+        await _sync(imp, '0', title='New', resources=['r2'], views=['v'])
+        await imp.delete_unsynced_packages()
+        return imp
+
+    imp = asyncio.run(run())
+    assert imp.stats()['entities']['package'] == {'updated': 1, 'deleted': 4}
+    pkg_dict = Importer('imp', api=api)._find_package('0')
+    assert pkg_dict['title'] == 'New'
+    [res_dict] = pkg_dict['resources']
+    assert res_dict['name'] == 'r2'
+    assert len(api.action.resource_view_list(id=res_dict['id'])) == 1
+
+
+def test_concurrent_creations_scan_names_once(api, async_api):
+    async def run():
+        imp = AsyncImporter('imp', async_api, exact_search=False)
+        await asyncio.gather(*(_sync(imp, str(i)) for i in range(50)))
+
+    asyncio.run(run())
+    # One search per package to find it, and one for the existing names
+    assert api.calls['package_search'] == 51
+
+
+def test_concurrent_searches_check_plugin_once(api, async_api):
+    async def run():
+        imp = AsyncImporter('imp', async_api, hash_names=True)
+        await asyncio.gather(*(_sync(imp, str(i)) for i in range(20)))
+        return imp
+
+    imp = asyncio.run(run())
+    assert api.calls['status_show'] == 1
+    assert imp.exact_search
+
+
+def test_resource_changes_outdate_package(async_api):
+    async def run():
+        await _sync(AsyncImporter('imp', async_api), 'a', resources=['r'])
+        imp = AsyncImporter('imp', async_api)
+        async with imp.sync_package('a') as pkg:
+            async with pkg.sync_resource('r') as res:
+                res['url'] = 'https://example.com'
+        return pkg
+
+    pkg = asyncio.run(run())
+    assert pkg._metadata_modified_is_outdated
+
+
+def test_failed_resource_is_rolled_back(api, async_api):
+    async def run():
+        await _sync(AsyncImporter('imp', async_api), 'a', resources=['r'])
+        imp = AsyncImporter('imp', async_api, defer_resource_writes=True)
+        async with imp.sync_package('a') as pkg:
+            async with pkg.sync_resource('r', on_error=OnError.delete) as res:
+                res['name'] = 'half-written'
+                raise TransientError('https://ckan.example.com', 503)
+            pkg['title'] = 'New'
+
+    asyncio.run(run())
+    pkg_dict = Importer('imp', api=api)._find_package('a')
+    assert pkg_dict['title'] == 'New'
+    assert [r['name'] for r in pkg_dict['resources']] == ['r']
+
+
+def test_errors_are_reraised(api, async_api):
+    async def run():
+        imp = AsyncImporter('imp', async_api)
+        async with imp.sync_package('a'):
+            raise ValueError('boom')
+
+    with pytest.raises(ValueError):
+        asyncio.run(run())
+    # Newly created packages are not kept after an error
+    assert api.count_packages() == 0
+
+
+def test_threaded_api_context_manager(api):
+    async def run():
+        async with ThreadedAPI(api) as threaded:
+            status = await threaded.action.status_show()
+        return threaded, status
+
+    threaded, status = asyncio.run(run())
+    assert status['extensions'] == ['importer']
+    with pytest.raises(RuntimeError):
+        threaded._executor.submit(lambda: None)
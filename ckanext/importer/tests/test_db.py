@@ -0,0 +1,124 @@
+#!/usr/bin/env python
+# encoding: utf-8
+
+# Copyright (C) 2018 Stadt Karlsruhe (www.karlsruhe.de)
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published
+# by the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+from __future__ import (absolute_import, division, print_function,
+                        unicode_literals)
+
+import uuid
+
+from ckan import model
+import pytest
+from sqlalchemy.exc import SQLAlchemyError
+
+from .. import db
+from ..metrics import Metrics
+from .fakeckan import FakeLocalCKAN
+
+
+def _package(name, importer_id, eid, state='active'):
+    id = str(uuid.uuid4())
+    pkg = model.Package(id=id, name=name, state=state)
+    extras = [
+        model.PackageExtra(id=str(uuid.uuid4()), package_id=id, key=key,
+                           value=value, state='active')
+        for key, value in (('ckanext_importer_importer_id', importer_id),
+                           ('ckanext_importer_package_eid', eid))
+    ]
+    return [pkg] + extras
+
+
+@pytest.fixture
+def packages():
+    '''
+    Packages in CKAN's database, mapped by name.
+
+    The changes are rolled back after the test.
+    '''
+    rows = (_package('ckanext_importer_0', 'imp', 'a')
+            + _package('ckanext_importer_1', 'imp', 'b')
+            + _package('ckanext_importer_2', 'imp', 'c', state='deleted')
+            + _package('ckanext-importer-3', 'other', 'a'))
+    try:
+        model.Session.add_all(rows)
+        model.Session.flush()
+    except SQLAlchemyError as e:
+        model.Session.rollback()
+        pytest.skip('CKAN database is not available: {}'.format(e))
+    yield {row.name: row for row in rows if isinstance(row, model.Package)}
+    model.Session.rollback()
+
+
+@pytest.fixture
+def contexts(monkeypatch):
+    '''
+    Contexts of the calls of ``package_show``.
+    '''
+    contexts = []
+
+    def package_show(context, data_dict):
+        contexts.append(context)
+        return {'id': data_dict['id']}
+
+    monkeypatch.setattr(db, 'get_action', lambda name: package_show)
+    return contexts
+
+
+def test_requires_local_api(api):
+    with pytest.raises(ValueError):
+        db.DatabaseReader(api)
+
+
+def test_find_packages(packages, contexts):
+    reader = db.DatabaseReader(FakeLocalCKAN())
+    ids = sorted(packages[name].id for name in ('ckanext_importer_0',
+                                                'ckanext_importer_1'))
+    assert [pkg_dict['id'] for pkg_dict in reader.find_packages('imp')] == ids
+    assert all(context['user'] == 'importer' and not context['use_cache']
+               for context in contexts)
+    assert list(reader.find_packages('imp', 'b')) == [
+        {'id': packages['ckanext_importer_1'].id}]
+    assert list(reader.find_packages('imp', 'c')) == []
+
+
+def test_find_packages_with_fields(packages, contexts):
+    reader = db.DatabaseReader(FakeLocalCKAN())
+    assert list(reader.find_packages('other', fl=['id', 'name'])) == [{
+        'id': packages['ckanext-importer-3'].id,
+        'name': 'ckanext-importer-3',
+        'extras': [
+            {'key': 'ckanext_importer_importer_id', 'value': 'other'},
+            {'key': 'ckanext_importer_package_eid', 'value': 'a'},
+        ],
+    }]
+    assert contexts == []
+
+
+def test_find_names(packages):
+    reader = db.DatabaseReader(FakeLocalCKAN())
+    # Deleted packages are included and "_" is not a wildcard
+    assert sorted(reader.find_names('ckanext_importer_')) == [
+        'ckanext_importer_0', 'ckanext_importer_1', 'ckanext_importer_2']
+
+
+def test_metrics(packages, contexts):
+    metrics = Metrics()
+    reader = db.DatabaseReader(FakeLocalCKAN(), metrics)
+    list(reader.find_packages('imp'))
+    list(reader.find_names('ckanext_importer_'))
+    calls = metrics.stats()['actions']['database_search']
+    assert calls['ok']['count'] == 2
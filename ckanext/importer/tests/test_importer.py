@@ -0,0 +1,431 @@
+#!/usr/bin/env python
+# encoding: utf-8
+
+# Copyright (C) 2018 Stadt Karlsruhe (www.karlsruhe.de)
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published
+# by the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+from __future__ import (absolute_import, division, print_function,
+                        unicode_literals)
+
+import pytest
+
+from .. import ExtrasDictView, Importer, OnError, UploadMode, _packages_fq
+from .. import utils
+from ..transport import TransientError
+
+
+def _writes(api):
+    '''
+    Return the names of the write actions that have been called.
+    '''
+    return {action for action in api.calls
+            if not action.endswith(('_show', '_search', '_list'))}
+
+
+def _sync(imp, eid, title='Title', resources=(), views=()):
+    with imp.sync_package(eid) as pkg:
+        pkg['title'] = title
+        for res_eid in resources:
+            with pkg.sync_resource(res_eid) as res:
+                res['name'] = res_eid
+                for view_eid in views:
+                    with res.sync_view(view_eid) as view:
+                        view['title'] = view_eid
+                        view['view_type'] = 'text_view'
+                res.delete_unsynced_views()
+        pkg.delete_unsynced_resources()
+    return pkg
+
+
+def test_sync_creates_and_updates_packages(api):
+    _sync(Importer('imp', api=api), 'a', resources=['r1', 'r2'],
+          views=['v'])
+    pkg_dict = Importer('imp', api=api)._find_package('a')
+    assert pkg_dict['title'] == 'Title'
+    assert [r['name'] for r in pkg_dict['resources']] == ['r1', 'r2']
+    assert len(api._views) == 2
+
+    _sync(Importer('imp', api=api), 'a', title='New', resources=['r2'])
+    pkg_dict = Importer('imp', api=api)._find_package('a')
+    assert pkg_dict['title'] == 'New'
+    [res_dict] = pkg_dict['resources']
+    assert res_dict['name'] == 'r2'
+    assert api.action.resource_view_list(id=res_dict['id']) == []
+
+
+def test_unchanged_package_is_not_uploaded(api):
+    _sync(Importer('imp', api=api), 'a', resources=['r'], views=['v'])
+    api.reset_calls()
+    imp = Importer('imp', api=api)
+    _sync(imp, 'a', resources=['r'], views=['v'])
+    assert not _writes(api)
+    assert imp.stats()['entities']['package'] == {'unchanged': 1}
+
+
+class TestChangeTracking(object):
+
+    def test_extras(self, api):
+        imp = Importer('imp', api=api)
+        with imp.sync_package('a') as pkg:
+            pkg.extras['key'] = 'value'
+        api.reset_calls()
+        with Importer('imp', api=api).sync_package('a') as pkg:
+            pkg.extras['key'] = 'value'
+            assert not pkg._is_modified()
+        assert not _writes(api)
+        with Importer('imp', api=api).sync_package('a') as pkg:
+            pkg.extras['key'] = 'other'
+            assert pkg._is_modified()
+        pkg_dict = Importer('imp', api=api)._find_package('a')
+        assert {'key': 'key', 'value': 'other'} in pkg_dict['extras']
+
+    def test_nested_values(self, api):
+        with Importer('imp', api=api).sync_package('a') as pkg:
+            pkg['tags'] = [{'name': 'a'}]
+        with Importer('imp', api=api).sync_package('a') as pkg:
+            tags = pkg['tags']
+            tags[0]['name'] = 'a'
+            assert not pkg._is_modified()
+            tags.append({'name': 'b'})
+            assert pkg._is_modified()
+
+    def test_resource_upload_does_not_modify_package(self, api):
+        _sync(Importer('imp', api=api), 'a')
+        api.reset_calls()
+        with Importer('imp', api=api).sync_package('a') as pkg:
+            with pkg.sync_resource('r') as res:
+                res['name'] = 'r'
+            assert not pkg._is_modified()
+        assert _writes(api) == {'resource_create', 'resource_update'}
+
+    def test_resources_are_copied_once(self, api, monkeypatch):
+        num_resources = 50
+        _sync(Importer('imp', api=api), 'a',
+              resources=[str(i) for i in range(num_resources)])
+        copies = []
+        deepcopy = utils.deepcopy
+
+        def counting_deepcopy(value, *args):
+            if isinstance(value, list) and len(value) == num_resources:
+                copies.append(value)
+            return deepcopy(value, *args)
+
+        monkeypatch.setattr(utils, 'deepcopy', counting_deepcopy)
+        with Importer('imp', api=api).sync_package('a') as pkg:
+            pkg['resources']
+            for i in range(num_resources):
+                with pkg.sync_resource(str(i)) as res:
+                    res['name'] = 'changed'
+        assert len(copies) <= 1
+
+
+class TestExtrasDictView(object):
+
+    def test_dict_interface(self):
+        extras = [{'key': 'a', 'value': 1}]
+        view = ExtrasDictView(extras)
+        view['b'] = 2
+        view['a'] = 3
+        assert dict(view) == {'a': 3, 'b': 2}
+        del view['a']
+        assert extras == [{'key': 'b', 'value': 2}]
+        with pytest.raises(KeyError):
+            view['a']
+
+    def test_direct_insertion(self):
+        extras = [{'key': 'a', 'value': 1}]
+        view = ExtrasDictView(extras)
+        assert 'b' not in view
+        extras.append({'key': 'b', 'value': 2})
+        assert view['b'] == 2
+
+    def test_direct_replacement(self):
+        extras = [{'key': 'a', 'value': 1}]
+        view = ExtrasDictView(extras)
+        assert 'b' not in view
+        extras[0] = {'key': 'b', 'value': 2}
+        # The outdated position of "a" is detected
+        assert 'a' not in view
+        assert view['b'] == 2
+
+    def test_reset(self):
+        extras = [{'key': 'a', 'value': 1}]
+        view = ExtrasDictView(extras)
+        assert 'b' not in view
+        extras[0] = {'key': 'b', 'value': 2}
+        view.reset()
+        assert view['b'] == 2
+        assert 'a' not in view
+
+    def test_new_keys_do_not_rebuild_index(self, monkeypatch):
+        builds = []
+        build_index = ExtrasDictView._build_index
+        monkeypatch.setattr(ExtrasDictView, '_build_index',
+                            lambda self: builds.append(1) or build_index(self))
+        extras = [{'key': str(i), 'value': i} for i in range(100)]
+        view = ExtrasDictView(extras)
+        for i in range(100, 200):
+            assert str(i) not in view
+            view[str(i)] = i
+        assert len(builds) == 1
+        assert view['150'] == 150
+
+    def test_direct_removal(self):
+        extras = [{'key': 'a', 'value': 1}, {'key': 'b', 'value': 2}]
+        view = ExtrasDictView(extras)
+        assert view['b'] == 2
+        extras.pop(0)
+        assert view['b'] == 2
+        assert 'a' not in view
+
+
+class TestDeferredResourceWrites(object):
+
+    def test_single_package_write(self, api):
+        _sync(Importer('imp', api=api), 'a')
+        api.reset_calls()
+        imp = Importer('imp', api=api, defer_resource_writes=True)
+        _sync(imp, 'a', resources=['r1', 'r2', 'r3'])
+        assert _writes(api) == {'package_update'}
+        assert api.calls['package_update'] == 1
+
+    def test_views_of_new_resources(self, api):
+        imp = Importer('imp', api=api, defer_resource_writes=True)
+        _sync(imp, 'a', resources=['r'], views=['v1', 'v2'])
+        pkg_dict = Importer('imp', api=api)._find_package('a')
+        [res_dict] = pkg_dict['resources']
+        assert len(api.action.resource_view_list(id=res_dict['id'])) == 2
+
+    def test_failed_resource_is_rolled_back(self, api):
+        _sync(Importer('imp', api=api), 'a', resources=['r'])
+        imp = Importer('imp', api=api, defer_resource_writes=True)
+        with imp.sync_package('a') as pkg:
+            with pkg.sync_resource('r', on_error=OnError.delete) as res:
+                res['name'] = 'half-written'
+                # Transient errors never cause deletions
+                raise TransientError('https://ckan.example.com', 503)
+            pkg['title'] = 'New'
+        pkg_dict = Importer('imp', api=api)._find_package('a')
+        assert pkg_dict['title'] == 'New'
+        assert [r['name'] for r in pkg_dict['resources']] == ['r']
+
+
+def test_upload_modes(api):
+    _sync(Importer('imp', api=api), 'a', resources=['r'])
+    for mode, action in [(UploadMode.patch, 'package_patch'),
+                         (UploadMode.revise, 'package_revise')]:
+        api.reset_calls()
+        imp = Importer('imp', api=api, upload_mode=mode)
+        _sync(imp, 'a', title=action, resources=['r'])
+        assert _writes(api) == {action}
+        assert Importer('imp', api=api)._find_package('a')['title'] == action
+
+
+@pytest.mark.parametrize('upload_mode', list(UploadMode))
+def test_removals_are_uploaded(api, upload_mode):
+    imp = Importer('imp', api=api, defer_resource_writes=True)
+    with imp.sync_package('a') as pkg:
+        pkg.extras['x'] = '1'
+        pkg.extras['y'] = '2'
+        for res_eid in ('r1', 'r2'):
+            with pkg.sync_resource(res_eid) as res:
+                res['name'] = res_eid
+    imp = Importer('imp', api=api, defer_resource_writes=True,
+                   upload_mode=upload_mode)
+    with imp.sync_package('a') as pkg:
+        del pkg.extras['y']
+        with pkg.sync_resource('r1'):
+            pass
+        pkg.delete_unsynced_resources()
+    pkg_dict = Importer('imp', api=api)._find_package('a')
+    extras = {e['key']: e['value'] for e in pkg_dict['extras']
+              if not e['key'].startswith('ckanext_importer_')}
+    assert extras == {'x': '1'}
+    assert [r['name'] for r in pkg_dict['resources']] == ['r1']
+
+
+def test_package_names(api):
+    imp = Importer('imp', api=api)
+    for eid in 'abc':
+        _sync(imp, eid)
+    names = sorted(pkg_dict['name'] for pkg_dict in api._packages.values())
+    assert names == ['ckanext_importer_0', 'ckanext_importer_1',
+                     'ckanext_importer_2']
+    assert api.calls['package_create'] == 3
+
+    imp = Importer('imp', api=api, hash_names=True)
+    _sync(imp, 'd')
+    assert Importer('imp', api=api)._find_package('d')['name'] not in names
+
+
+def test_prefetch(api):
+    imp = Importer('imp', api=api, hash_names=True)
+    imp.sync_many(((str(i), i) for i in range(20)),
+                  lambda pkg, i: pkg.update(title='Title'))
+    api.reset_calls()
+    imp = Importer('imp', api=api, prefetch=True, hash_names=True,
+                   exact_search=True)
+    imp.sync_many(((str(i), i) for i in range(25)),
+                  lambda pkg, i: pkg.update(title='Title'))
+    assert api.calls['package_search'] == 1
+    assert api.calls['package_create'] == 5
+    assert api.count_packages() == 25
+
+
+class TestExactSearch(object):
+
+    def test_packages_fq(self):
+        assert _packages_fq('a"b', 'c') == (
+            'extras_ckanext_importer_importer_id:"a\\"b" AND '
+            'extras_ckanext_importer_package_eid:"c"')
+        assert _packages_fq('a"b', exact=True) == \
+            'ckanext_importer_exact_importer_id:"a\\"b"'
+
+    def test_plugin_is_detected(self, api):
+        assert Importer('imp', api=api)._uses_exact_search()
+        api.extensions = []
+        api.reset_calls()
+        assert not Importer('imp', api=api)._uses_exact_search()
+        assert api.calls['package_search'] == 0
+
+    def test_index_is_checked(self, api):
+        api.extensions = []
+        _sync(Importer('imp', api=api), 'a')
+        api.extensions = ['importer']
+        # The package has not been reindexed with the exact-match fields
+        imp = Importer('imp', api=api)
+        assert not imp._uses_exact_search()
+        _sync(imp, 'a', title='New')
+        assert api.count_packages() == 1
+        assert Importer('other', api=api)._uses_exact_search()
+        api.rebuild_search_index()
+        assert Importer('imp', api=api)._uses_exact_search()
+
+
+def test_sync_many(api):
+    imp = Importer('imp', api=api)
+    imp.sync_many(((str(i), i) for i in range(30)),
+                  lambda pkg, i: pkg.update(title=str(i)), workers=4)
+    assert sorted(int(p['title']) for p in api._packages.values()) == list(range(30))
+    assert len(set(p['name'] for p in api._packages.values())) == 30
+
+
+def test_sync_many_reraises_errors(api):
+    def sync(pkg, i):
+        if i == 3:
+            raise ValueError('boom')
+        pkg['title'] = str(i)
+
+    imp = Importer('imp', api=api)
+    with pytest.raises(ValueError):
+        imp.sync_many(((str(i), i) for i in range(10)), sync, workers=2)
+    assert Importer('imp', api=api).stats()['entities'] == {}
+    assert imp.stats()['entities']['package']['failed'] == 1
+
+
+def test_fingerprints(api):
+    imp = Importer('imp', api=api)
+    with imp.sync_package('a', fingerprint='v1') as pkg:
+        pkg['title'] = 'Title'
+    imp = Importer('imp', api=api)
+    assert imp.skip_if_unchanged('a', 'v1')
+    assert not imp.skip_if_unchanged('a', 'v2')
+    assert not imp.skip_if_unchanged('b', 'v1')
+    # Skipped packages count as synced
+    assert imp.delete_unsynced_packages().deleted == []
+
+
+class TestDeletion(object):
+
+    def test_delete_unsynced_packages(self, api):
+        imp = Importer('imp', api=api)
+        for eid in 'abcd':
+            _sync(imp, eid)
+        imp = Importer('imp', api=api)
+        _sync(imp, 'a')
+        report = imp.delete_unsynced_packages(workers=2)
+        assert sorted(report.deleted) == ['b', 'c', 'd']
+        assert report.failed == {}
+        assert api.count_packages() == 1
+
+    def test_max_deletions(self, api):
+        imp = Importer('imp', api=api)
+        for eid in 'abc':
+            _sync(imp, eid)
+        with pytest.raises(RuntimeError):
+            Importer('imp', api=api).delete_unsynced_packages(max_deletions=2)
+        assert api.count_packages() == 3
+
+    def test_other_importers_are_kept(self, api):
+        _sync(Importer('imp', api=api), 'a')
+        _sync(Importer('imp-2', api=api), 'a')
+        Importer('imp', api=api).delete_unsynced_packages()
+        assert api.count_packages() == 1
+
+    def test_many_packages(self, api):
+        # More packages than CKAN returns per search
+        num_packages = 1100
+        imp = Importer('imp', api=api, hash_names=True)
+        imp.sync_many(((str(i), i) for i in range(num_packages)),
+                      lambda pkg, i: pkg.update(title=str(i)))
+        imp = Importer('imp', api=api, search_workers=3)
+        _sync(imp, '0')
+        report = imp.delete_unsynced_packages()
+        assert len(report.deleted) == num_packages - 1
+        assert api.count_packages() == 1
+
+    def test_sync_delta(self, api):
+        imp = Importer('imp', api=api)
+        for eid in 'abc':
+            _sync(imp, eid)
+        api.reset_calls()
+        imp = Importer('imp', api=api)
+        report = imp.sync_delta([('a', 'New')], ['b', 'x'],
+                                lambda pkg, title: pkg.update(title=title))
+        assert report.deleted == ['b']
+        assert sorted(p['title'] for p in api._packages.values()) == ['New', 'Title']
+        with pytest.raises(RuntimeError):
+            imp.delete_unsynced_packages()
+
+
+def test_on_error_delete(api):
+    _sync(Importer('imp', api=api), 'a')
+    imp = Importer('imp', api=api)
+    with imp.sync_package('a', on_error=OnError.delete):
+        raise TransientError('https://ckan.example.com', 503)
+    assert api.count_packages() == 1
+    with imp.sync_package('a', on_error=OnError.delete):
+        raise ValueError('boom')
+    assert api.count_packages() == 0
+
+
+def test_views_are_listed_once_per_resource(api):
+    _sync(Importer('imp', api=api), 'a', resources=['r'],
+          views=['v1', 'v2', 'v3'])
+    api.reset_calls()
+    _sync(Importer('imp', api=api), 'a', resources=['r'],
+          views=['v1', 'v2', 'v3'])
+    assert api.calls['resource_view_list'] == 1
+    assert 'resource_view_show' not in api.calls
+
+
+def test_metrics(api):
+    imp = Importer('imp', api=api)
+    _sync(imp, 'a', resources=['r'])
+    stats = imp.stats()
+    assert stats['entities']['package'] == {'created': 1}
+    assert stats['entities']['resource'] == {'created': 1}
+    assert stats['actions']['package_create']['ok']['count'] == 1
+    assert 'package_create' in imp.metrics.summary()
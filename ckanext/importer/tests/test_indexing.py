@@ -0,0 +1,155 @@
+#!/usr/bin/env python
+# encoding: utf-8
+
+# Copyright (C) 2018 Stadt Karlsruhe (www.karlsruhe.de)
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published
+# by the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+from __future__ import (absolute_import, division, print_function,
+                        unicode_literals)
+
+import ckanapi
+from ckan.logic import NotFound
+import pytest
+
+from .. import Importer, indexing
+from .fakeckan import FakeLocalCKAN
+
+
+class FakeSearchIndex(object):
+    '''
+    Records the operations on CKAN's search index.
+    '''
+    def __init__(self):
+        self.updated = []
+        self.removed = []
+        self.commits = 0
+
+    def index_for(self, type):
+        return self
+
+    def update_dict(self, pkg_dict, defer_commit=False):
+        self.updated.append(pkg_dict['id'])
+
+    def remove_dict(self, pkg_dict):
+        self.removed.append(pkg_dict['id'])
+
+    def commit(self):
+        self.commits += 1
+
+
+@pytest.fixture
+def config(monkeypatch):
+    config = {indexing._AUTOMATIC_INDEXING_OPTION: True}
+    monkeypatch.setattr(indexing, 'config', config)
+    return config
+
+
+@pytest.fixture
+def search_index(monkeypatch):
+    search_index = FakeSearchIndex()
+    monkeypatch.setattr(indexing, 'search', search_index)
+    return search_index
+
+
+@pytest.fixture
+def local_api(monkeypatch):
+    api = FakeLocalCKAN()
+
+    def package_show(context, data_dict):
+        try:
+            return api.action.package_show(**data_dict)
+        except ckanapi.NotFound:
+            raise NotFound(data_dict['id'])
+
+    monkeypatch.setattr(indexing, 'get_action', lambda name: package_show)
+    return api
+
+
+class TestSuppressIndexing(object):
+
+    def test_nesting(self, config):
+        indexing.suppress_indexing()
+        indexing.suppress_indexing()
+        assert config[indexing._AUTOMATIC_INDEXING_OPTION] is False
+        indexing.restore_indexing()
+        assert config[indexing._AUTOMATIC_INDEXING_OPTION] is False
+        indexing.restore_indexing()
+        assert config[indexing._AUTOMATIC_INDEXING_OPTION] is True
+        with pytest.raises(RuntimeError):
+            indexing.restore_indexing()
+
+    def test_unset_option(self, config):
+        config.clear()
+        indexing.suppress_indexing()
+        assert config[indexing._AUTOMATIC_INDEXING_OPTION] is False
+        indexing.restore_indexing()
+        assert config == {}
+
+
+def test_reindex_packages(local_api, search_index):
+    ids = [local_api.action.package_create(name=name)['id']
+           for name in ('a', 'b')]
+    local_api.action.dataset_purge(id=ids[0])
+    assert indexing.reindex_packages(ids + ['c'], batch_size=2) == 3
+    assert search_index.updated == [ids[1]]
+    assert search_index.removed == [ids[0], 'c']
+    assert search_index.commits == 2
+
+
+class TestBulkSession(object):
+
+    def test_packages_are_reindexed(self, config, search_index, local_api):
+        imp = Importer('imp', api=local_api)
+        with imp.bulk_session():
+            assert config[indexing._AUTOMATIC_INDEXING_OPTION] is False
+            with imp.sync_package('a') as pkg:
+                pkg['title'] = 'Title'
+            assert imp.prefetch
+        assert config[indexing._AUTOMATIC_INDEXING_OPTION] is True
+        assert not imp.prefetch
+        assert search_index.updated == [pkg['id']]
+
+    def test_requires_local_api(self, api):
+        with pytest.raises(ValueError):
+            with Importer('imp', api=api).bulk_session():
+                pass
+
+    def test_sessions_cannot_be_nested(self, config, search_index, local_api):
+        imp = Importer('imp', api=local_api)
+        with imp.bulk_session():
+            with pytest.raises(RuntimeError):
+                with imp.bulk_session():
+                    pass
+        assert config[indexing._AUTOMATIC_INDEXING_OPTION] is True
+
+    def test_failed_start(self, config, search_index, local_api,
+                          monkeypatch):
+        def fail(**kwargs):
+            raise ckanapi.CKANAPIError('Solr is down')
+
+        imp = Importer('imp', api=local_api)
+        with monkeypatch.context() as m:
+            m.setattr(local_api, '_package_search', fail)
+            with pytest.raises(ckanapi.CKANAPIError):
+                with imp.bulk_session():
+                    pass
+        assert imp._bulk_ids is None
+        assert not imp.prefetch
+        assert config[indexing._AUTOMATIC_INDEXING_OPTION] is True
+        # The importer can still be used
+        with imp.bulk_session():
+            with imp.sync_package('a') as pkg:
+                pkg['title'] = 'Title'
+        assert search_index.updated == [pkg['id']]
@@ -0,0 +1,107 @@
+#!/usr/bin/env python
+# encoding: utf-8
+
+# Copyright (C) 2018 Stadt Karlsruhe (www.karlsruhe.de)
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published
+# by the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+from __future__ import (absolute_import, division, print_function,
+                        unicode_literals)
+
+import io
+import os
+
+import pytest
+
+from .. import Importer
+from ..journal import Journal
+
+
+def _set_title(pkg, title):
+    pkg['title'] = title
+
+
+def test_record_and_resume(tmpdir):
+    path = str(tmpdir.join('journal.jsonl'))
+    journal = Journal(path)
+    journal.record('imp', 'synced', 'a')
+    journal.record('imp', 'deleted', 'b')
+    journal.record('other', 'synced', 'c')
+    journal.close()
+
+    journal = Journal(path)
+    assert journal.done_eids('imp') == {'a', 'b'}
+    assert journal.is_done('other', 'c')
+    assert not journal.is_done('imp', 'c')
+    with pytest.raises(ValueError):
+        journal.record('imp', 'unknown', 'a')
+    journal.complete()
+    assert not os.path.exists(path)
+
+
+def test_truncated_last_line(tmpdir):
+    path = str(tmpdir.join('journal.jsonl'))
+    journal = Journal(path)
+    journal.record('imp', 'synced', 'a')
+    journal.close()
+    with io.open(path, 'a', encoding='utf-8') as f:
+        f.write('{"eid": "b", "ev')
+
+    journal = Journal(path)
+    assert journal.eids('imp', 'synced') == {'a'}
+    # The incomplete line is overwritten by the next event
+    journal.record('imp', 'synced', 'c')
+    journal.close()
+    assert Journal(path).eids('imp', 'synced') == {'a', 'c'}
+
+
+def test_empty_file(tmpdir):
+    path = str(tmpdir.join('journal.jsonl'))
+    io.open(path, 'w').close()
+    journal = Journal(path)
+    assert journal.done_eids('imp') == set()
+    journal.record('imp', 'synced', 'a')
+    journal.close()
+    assert Journal(path).eids('imp', 'synced') == {'a'}
+
+
+def test_interrupted_run(api, tmpdir):
+    path = str(tmpdir.join('journal.jsonl'))
+    imp = Importer('imp', api=api, hash_names=True)
+    imp.sync_many([(eid, 'Old') for eid in 'abcd'], _set_title)
+
+    def sync(pkg, title):
+        if pkg._eid == 'c':
+            raise KeyboardInterrupt()
+        pkg['title'] = title
+
+    journal = Journal(path)
+    imp = Importer('imp', api=api, hash_names=True, journal=journal)
+    with pytest.raises(KeyboardInterrupt):
+        imp.sync_many([(eid, 'New') for eid in 'abc'], sync)
+    journal.close()
+
+    synced = []
+
+    def resume(pkg, title):
+        synced.append(pkg._eid)
+        pkg['title'] = title
+
+    journal = Journal(path)
+    imp = Importer('imp', api=api, hash_names=True, journal=journal)
+    imp.sync_many([(eid, 'New') for eid in 'abc'], resume)
+    assert synced == ['c']
+    assert imp.delete_unsynced_packages().deleted == ['d']
+    journal.complete()
+    assert sorted(p['title'] for p in api._packages.values()) == ['New'] * 3
@@ -0,0 +1,97 @@
+#!/usr/bin/env python
+# encoding: utf-8
+
+# Copyright (C) 2018 Stadt Karlsruhe (www.karlsruhe.de)
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published
+# by the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+from __future__ import (absolute_import, division, print_function,
+                        unicode_literals)
+
+import pytest
+
+from .. import Importer, UploadMode
+from ..plan import Plan
+
+
+def _run(api, packages, plan=None, upload_mode=UploadMode.update,
+         purge=True):
+    imp = Importer('imp', api=api, plan=plan, upload_mode=upload_mode,
+                   default_owner_org='org')
+    for eid, (title, resources) in sorted(packages.items()):
+        with imp.sync_package(eid) as pkg:
+            pkg['title'] = title
+            for res_eid, views in sorted(resources.items()):
+                with pkg.sync_resource(res_eid) as res:
+                    res['name'] = res_eid
+                    for view_eid in views:
+                        with res.sync_view(view_eid) as view:
+                            view['title'] = view_eid
+                            view['view_type'] = 'text_view'
+                    res.delete_unsynced_views()
+            pkg.delete_unsynced_resources()
+    imp.delete_unsynced_packages(purge=purge)
+
+
+OLD = {
+    'a': ('A', {'r1': ['v1', 'v2'], 'r2': []}),
+    'b': ('B', {'r1': []}),
+    'c': ('C', {}),
+}
+
+NEW = {
+    'a': ('A2', {'r1': ['v1', 'v3'], 'r3': ['v4']}),
+    'b': ('B', {'r1': []}),
+    'd': ('D', {'r': ['v5']}),
+}
+
+
+@pytest.mark.parametrize('upload_mode', list(UploadMode))
+@pytest.mark.parametrize('purge', [True, False])
+def test_round_trip(api, upload_mode, purge):
+    _run(api, OLD)
+    api.reset_calls()
+    plan = Plan()
+    _run(api, NEW, plan, upload_mode, purge)
+    writes = [action for action in api.calls
+              if not action.endswith(('_show', '_search', '_list'))]
+    assert writes == []
+    assert plan.summary() == ('packages: 1 create, 1 update, 1 delete\n'
+                              'views: 3 create, 1 delete')
+
+    plan = Plan.from_json(plan.to_json())
+    report = plan.apply(api, workers=4)
+    assert report.failed == {}
+    assert sorted(p['title'] for p in api._packages.values()) == ['A2', 'B', 'D']
+    assert sorted(v['title'] for v in api._views.values()) == ['v1', 'v3', 'v4', 'v5']
+
+    # The applied plan leaves nothing to do
+    plan = Plan()
+    _run(api, NEW, plan, upload_mode, purge)
+    assert len(plan) == 0
+    assert plan.summary() == 'No changes'
+
+
+def test_diff(api):
+    _run(api, {'a': ('A', {})})
+    plan = Plan()
+    _run(api, {'a': ('A2', {})}, plan)
+    [op] = plan.operations
+    assert op['kind'] == 'update'
+    assert op['diff'] == {'title': {'old': 'A', 'new': 'A2'}}
+
+
+def test_unsupported_version():
+    with pytest.raises(ValueError):
+        Plan.from_json('{"version": -1, "operations": []}')
@@ -0,0 +1,47 @@
+#!/usr/bin/env python
+# encoding: utf-8
+
+# Copyright (C) 2018 Stadt Karlsruhe (www.karlsruhe.de)
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published
+# by the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+from __future__ import (absolute_import, division, print_function,
+                        unicode_literals)
+
+from ..plugin import ImporterPlugin, _add_exact_fields
+
+
+def test_add_exact_fields():
+    pkg_dict = {
+        'extras_ckanext_importer_importer_id': 'imp',
+        'extras_ckanext_importer_package_eid': 'a b',
+        'extras_other': 'x',
+    }
+    assert _add_exact_fields(dict(pkg_dict)) == dict(
+        pkg_dict,
+        ckanext_importer_exact_importer_id='imp',
+        ckanext_importer_exact_package_eid='a b',
+    )
+
+
+def test_other_packages_are_unchanged():
+    assert _add_exact_fields({'extras_other': 'x'}) == {'extras_other': 'x'}
+
+
+def test_index_hooks():
+    plugin = ImporterPlugin()
+    pkg_dict = {'extras_ckanext_importer_importer_id': 'imp'}
+    for hook in (plugin.before_index, plugin.before_dataset_index):
+        assert hook(dict(pkg_dict))['ckanext_importer_exact_importer_id'] \
+            == 'imp'
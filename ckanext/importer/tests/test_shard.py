@@ -0,0 +1,146 @@
+#!/usr/bin/env python
+# encoding: utf-8
+
+# Copyright (C) 2018 Stadt Karlsruhe (www.karlsruhe.de)
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published
+# by the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+from __future__ import (absolute_import, division, print_function,
+                        unicode_literals)
+
+import pytest
+
+from .. import Importer
+from ..shard import ShardCoordinator, get_shard
+
+
+NUM_SHARDS = 2
+
+
+def _set_title(pkg, title):
+    pkg['title'] = title
+
+
+@pytest.fixture
+def coordinator(tmpdir):
+    with ShardCoordinator(str(tmpdir.join('coordinator.db'))) as coordinator:
+        yield coordinator
+
+
+def _sync_shards(api, coordinator, eids):
+    for shard in range(NUM_SHARDS):
+        imp = Importer('imp', api=api, shard=(shard, NUM_SHARDS),
+                       hash_names=True)
+        imp.sync_many(((eid, 'Title') for eid in eids), _set_title)
+        coordinator.report(imp)
+
+
+def test_get_shard():
+    shards = [get_shard(str(i), 4) for i in range(1000)]
+    assert set(shards) == {0, 1, 2, 3}
+    assert shards == [get_shard(str(i), 4) for i in range(1000)]
+
+
+def test_shards_only_sync_their_eids(api):
+    for shard in range(NUM_SHARDS):
+        imp = Importer('imp', api=api, shard=(shard, NUM_SHARDS),
+                       hash_names=True)
+        imp.sync_many(((str(i), 'Title') for i in range(20)), _set_title)
+    assert api.count_packages() == 20
+
+
+def test_delete_unsynced_packages(api, coordinator):
+    _sync_shards(api, coordinator, [str(i) for i in range(20)])
+    _sync_shards(api, coordinator, [str(i) for i in range(10)])
+    report = coordinator.delete_unsynced_packages(Importer('imp', api=api),
+                                                  NUM_SHARDS)
+    assert sorted(report.deleted, key=int) == [str(i) for i in range(10, 20)]
+    assert api.count_packages() == 10
+    # The reports have been consumed
+    with pytest.raises(RuntimeError):
+        coordinator.delete_unsynced_packages(Importer('imp', api=api),
+                                             NUM_SHARDS)
+
+
+def test_missing_shards(api, coordinator):
+    imp = Importer('imp', api=api, shard=(1, NUM_SHARDS), hash_names=True)
+    coordinator.report(imp)
+    assert coordinator.missing_shards('imp', NUM_SHARDS) == [0]
+    with pytest.raises(RuntimeError):
+        coordinator.delete_unsynced_packages(Importer('imp', api=api),
+                                             NUM_SHARDS)
+
+
+def test_failed_deletion_keeps_reports(api, coordinator):
+    _sync_shards(api, coordinator, [str(i) for i in range(20)])
+    _sync_shards(api, coordinator, [str(i) for i in range(10)])
+    with pytest.raises(RuntimeError):
+        coordinator.delete_unsynced_packages(Importer('imp', api=api),
+                                             NUM_SHARDS, max_deletions=5)
+    assert api.count_packages() == 20
+    # The deletion can be retried
+    report = coordinator.delete_unsynced_packages(Importer('imp', api=api),
+                                                  NUM_SHARDS)
+    assert len(report.deleted) == 10
+
+
+def test_sharded_importer_is_rejected(api, coordinator):
+    imp = Importer('imp', api=api, shard=(0, NUM_SHARDS))
+    with pytest.raises(ValueError):
+        coordinator.delete_unsynced_packages(imp, NUM_SHARDS)
+    with pytest.raises(ValueError):
+        coordinator.report(Importer('imp', api=api))
+
+
+def test_report_during_deletion(api, coordinator):
+    _sync_shards(api, coordinator, [str(i) for i in range(20)])
+    imp = Importer('imp', api=api)
+    delete_unsynced_packages = imp.delete_unsynced_packages
+
+    def report_and_delete(**kwargs):
+        shard = Importer('imp', api=api, shard=(0, NUM_SHARDS),
+                         hash_names=True)
+        coordinator.report(shard)
+        # The running deletion keeps its claim
+        with pytest.raises(RuntimeError):
+            coordinator.delete_unsynced_packages(Importer('imp', api=api),
+                                                 NUM_SHARDS)
+        return delete_unsynced_packages(**kwargs)
+
+    imp.delete_unsynced_packages = report_and_delete
+    report = coordinator.delete_unsynced_packages(imp, NUM_SHARDS)
+    assert report.deleted == []
+    # The report made during the deletion has not been consumed
+    assert coordinator.missing_shards('imp', NUM_SHARDS) == [1]
+
+
+def test_stale_claim(api, coordinator):
+    _sync_shards(api, coordinator, [str(i) for i in range(20)])
+    _sync_shards(api, coordinator, [str(i) for i in range(10)])
+    imp = Importer('imp', api=api)
+
+    def crash(**kwargs):
+        raise SystemExit()
+
+    imp.delete_unsynced_packages = crash
+    with pytest.raises(SystemExit):
+        coordinator.delete_unsynced_packages(imp, NUM_SHARDS)
+    _sync_shards(api, coordinator, [str(i) for i in range(10)])
+    with pytest.raises(RuntimeError):
+        coordinator.delete_unsynced_packages(Importer('imp', api=api),
+                                             NUM_SHARDS)
+    with ShardCoordinator(coordinator.path, claim_timeout=0) as other:
+        report = other.delete_unsynced_packages(Importer('imp', api=api),
+                                                NUM_SHARDS)
+    assert len(report.deleted) == 10
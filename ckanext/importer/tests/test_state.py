@@ -0,0 +1,68 @@
+#!/usr/bin/env python
+# encoding: utf-8
+
+# Copyright (C) 2018 Stadt Karlsruhe (www.karlsruhe.de)
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published
+# by the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+from __future__ import (absolute_import, division, print_function,
+                        unicode_literals)
+
+from .. import Importer
+from ..state import StateStore
+
+
+def test_store(tmpdir):
+    path = str(tmpdir.join('state.db'))
+    with StateStore(path) as state:
+        state.put('imp', 'a', 'id-a', '2018-01-01', 'v1')
+        state.put('imp', 'b', 'id-b')
+        state.put('other', 'a', 'id-c')
+        state.remove('imp', 'b')
+    with StateStore(path) as state:
+        entry = state.get('imp', 'a')
+        assert entry.package_id == 'id-a'
+        assert entry.fingerprint == 'v1'
+        assert state.get('imp', 'b') is None
+        assert list(state.entries('imp')) == ['a']
+        state.clear('imp')
+        assert state.entries('imp') == {}
+        assert state.get('other', 'a').package_id == 'id-c'
+
+
+def test_importer_uses_stored_ids(api, tmpdir):
+    path = str(tmpdir.join('state.db'))
+    with StateStore(path) as state:
+        imp = Importer('imp', api=api, state=state)
+        with imp.sync_package('a', fingerprint='v1') as pkg:
+            pkg['title'] = 'Title'
+    api.reset_calls()
+    with StateStore(path) as state:
+        imp = Importer('imp', api=api, state=state)
+        assert imp.skip_if_unchanged('a', 'v1')
+        with imp.sync_package('a') as pkg:
+            pkg['title'] = 'New'
+    assert 'package_search' not in api.calls
+    assert Importer('imp', api=api)._find_package('a')['title'] == 'New'
+
+
+def test_verify_state(api, tmpdir):
+    with StateStore(str(tmpdir.join('state.db'))) as state:
+        imp = Importer('imp', api=api, state=state)
+        for eid in 'ab':
+            with imp.sync_package(eid, fingerprint='v1') as pkg:
+                pkg['title'] = 'Title'
+        api.action.dataset_purge(id=state.get('imp', 'b').package_id)
+        imp.verify_state()
+        assert list(state.entries('imp')) == ['a']
@@ -0,0 +1,75 @@
+#!/usr/bin/env python
+# encoding: utf-8
+
+# Copyright (C) 2018 Stadt Karlsruhe (www.karlsruhe.de)
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published
+# by the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+from __future__ import (absolute_import, division, print_function,
+                        unicode_literals)
+
+import pytest
+
+from .. import Importer
+from ..throttle import Throttle, _AIMDLimit, _is_read_action
+
+
+def test_is_read_action():
+    assert _is_read_action('package_search')
+    assert _is_read_action('package_show')
+    assert _is_read_action('resource_view_list')
+    assert not _is_read_action('package_update')
+
+
+class TestAIMDLimit(object):
+
+    def test_increase(self):
+        limit = _AIMDLimit(1, 3, target_latency=60)
+        for _ in range(10):
+            limit.release(limit.acquire(), failed=False)
+        assert limit.limit == 3
+
+    def test_decrease(self):
+        limit = _AIMDLimit(1, 8, target_latency=60)
+        limit.limit = 8
+        limit.release(limit.acquire(), failed=True)
+        assert limit.limit == 4
+        assert limit.in_flight() == 0
+
+    def test_single_decrease_per_overload(self):
+        limit = _AIMDLimit(1, 8, target_latency=60)
+        limit.limit = 8
+        starts = [limit.acquire() for _ in range(4)]
+        for start in starts:
+            limit.release(start, failed=True)
+        assert limit.limit == 4
+
+
+def test_throttled_importer(api):
+    throttle = Throttle(write_concurrency=2, target_latency=60)
+    imp = Importer('imp', api=api, throttle=throttle)
+    imp.sync_many(((str(i), i) for i in range(10)),
+                  lambda pkg, i: pkg.update(title=str(i)), workers=4)
+    assert api.count_packages() == 10
+    stats = throttle.stats()
+    assert stats['write']['concurrency_limit'] == 2
+    assert stats['write']['in_flight'] == 0
+
+
+def test_errors_are_passed_on(api):
+    throttle = Throttle()
+    imp = Importer('imp', api=api, throttle=throttle)
+    with pytest.raises(Exception):
+        imp._api.action.package_update(id='missing')
+    assert throttle.stats()['write']['in_flight'] == 0
@@ -0,0 +1,172 @@
+#!/usr/bin/env python
+# encoding: utf-8
+
+# Copyright (C) 2018 Stadt Karlsruhe (www.karlsruhe.de)
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published
+# by the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+from __future__ import (absolute_import, division, print_function,
+                        unicode_literals)
+
+import pytest
+import requests
+
+from ..transport import (CircuitBreaker, CircuitOpenError, PooledRemoteCKAN,
+                         RetryingAPI, TransientError, _is_transient_error)
+
+
+class FlakyAPI(object):
+    '''
+    API client whose first num_failures calls fail.
+    '''
+    def __init__(self, num_failures):
+        self.num_failures = num_failures
+        self.calls = []
+        self.action = self
+
+    def __getattr__(self, name):
+        def call(**kwargs):
+            self.calls.append(name)
+            if len(self.calls) <= self.num_failures:
+                raise requests.ConnectionError('CKAN is down')
+            return 'ok'
+        return call
+
+
+def test_is_transient_error():
+    assert _is_transient_error(requests.ConnectionError())
+    assert _is_transient_error(TransientError('https://ckan.example.com', 503))
+    assert not _is_transient_error(ValueError())
+
+
+class FakeSession(object):
+    '''
+    Records the keyword arguments of the requests made by the session.
+    '''
+    def __init__(self):
+        self.requests_kwargs = []
+        self.status_code = 200
+
+    def request(self, url, **kwargs):
+        self.requests_kwargs.append(kwargs)
+        response = requests.Response()
+        response.status_code = self.status_code
+        response._content = b'{"success": true, "result": "ok"}'
+        return response
+
+
+class TestPooledRemoteCKAN(object):
+
+    @pytest.fixture
+    def session(self, monkeypatch):
+        session = FakeSession()
+        for method in ('get', 'post'):
+            monkeypatch.setattr(requests.Session, method,
+                                lambda self, url, **kwargs:
+                                session.request(url, **kwargs))
+        return session
+
+    @pytest.mark.parametrize('get_only', [False, True])
+    def test_default_timeout(self, session, get_only):
+        api = PooledRemoteCKAN('https://ckan.example.com', timeout=5)
+        api.get_only = get_only
+        api.call_action('status_show')
+        # Some versions of ckanapi pass an explicit None
+        api.call_action('status_show', requests_kwargs={'timeout': None})
+        assert [kwargs['timeout'] for kwargs in session.requests_kwargs] \
+            == [5, 5]
+
+    def test_explicit_timeout(self, session):
+        api = PooledRemoteCKAN('https://ckan.example.com', timeout=5)
+        api.call_action('status_show', requests_kwargs={'timeout': 1})
+        assert session.requests_kwargs[0]['timeout'] == 1
+
+    def test_transient_status(self, session):
+        session.status_code = 503
+        api = PooledRemoteCKAN('https://ckan.example.com')
+        with pytest.raises(TransientError):
+            api.action.status_show()
+
+
+class TestCircuitBreaker(object):
+
+    def test_opens_after_threshold(self):
+        breaker = CircuitBreaker(threshold=2, pause=60)
+        breaker.record_failure()
+        assert breaker._state == CircuitBreaker._CLOSED
+        breaker.record_failure()
+        assert breaker._state == CircuitBreaker._OPEN
+
+    def test_success_resets_failures(self):
+        breaker = CircuitBreaker(threshold=2, pause=60)
+        breaker.record_failure()
+        breaker.record_success()
+        breaker.record_failure()
+        assert breaker._state == CircuitBreaker._CLOSED
+
+    def test_trial_call(self):
+        breaker = CircuitBreaker(threshold=1, pause=0)
+        breaker.record_failure()
+        assert breaker._state == CircuitBreaker._OPEN
+        breaker.before_call()
+        assert breaker._state == CircuitBreaker._HALF_OPEN
+        assert breaker._trial_running
+        # A failed trial opens the breaker again
+        breaker.record_failure()
+        assert breaker._state == CircuitBreaker._OPEN
+        breaker.before_call()
+        breaker.record_success()
+        assert breaker._state == CircuitBreaker._CLOSED
+
+    def test_max_pause(self):
+        breaker = CircuitBreaker(threshold=1, pause=0.01, max_pause=0.01)
+        breaker.record_failure()
+        assert breaker._state == CircuitBreaker._OPEN
+        breaker.before_call()
+        breaker.record_failure()
+        assert breaker._state == CircuitBreaker._BROKEN
+        with pytest.raises(CircuitOpenError):
+            breaker.before_call()
+
+
+class TestRetryingAPI(object):
+
+    def test_retries_idempotent_actions(self):
+        flaky = FlakyAPI(2)
+        api = RetryingAPI(flaky, retries=3, backoff=0)
+        assert api.action.package_show(id='x') == 'ok'
+        assert flaky.calls == ['package_show'] * 3
+
+    def test_does_not_retry_other_actions(self):
+        flaky = FlakyAPI(1)
+        api = RetryingAPI(flaky, retries=3, backoff=0)
+        with pytest.raises(requests.ConnectionError):
+            api.action.package_create(name='x')
+        assert flaky.calls == ['package_create']
+
+    def test_gives_up(self):
+        flaky = FlakyAPI(10)
+        api = RetryingAPI(flaky, retries=2, backoff=0)
+        with pytest.raises(requests.ConnectionError):
+            api.action.package_show(id='x')
+        assert len(flaky.calls) == 3
+
+    def test_circuit_breaker(self):
+        flaky = FlakyAPI(100)
+        breaker = CircuitBreaker(threshold=1, pause=0.01, max_pause=0.01)
+        api = RetryingAPI(flaky, retries=100, backoff=0,
+                          circuit_breaker=breaker)
+        with pytest.raises(CircuitOpenError):
+            api.action.package_show(id='x')
+        assert len(flaky.calls) == 2
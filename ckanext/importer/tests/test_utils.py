@@ -0,0 +1,117 @@
+#!/usr/bin/env python
+# encoding: utf-8
+
+# Copyright (C) 2018 Stadt Karlsruhe (www.karlsruhe.de)
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published
+# by the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+from __future__ import (absolute_import, division, print_function,
+                        unicode_literals)
+
+import pytest
+
+from ..utils import DictWrapper, _run_steps, replace_dict, solr_escape
+
+
+class TestDictWrapper(object):
+
+    def test_unmodified(self):
+        w = DictWrapper({'a': 1, 'b': [1, 2]})
+        w['a'] = 1
+        w['b']
+        assert w._changed_keys() == []
+
+    def test_set_and_delete(self):
+        d = {'a': 1, 'b': 2}
+        w = DictWrapper(d)
+        w['a'] = 3
+        del w['b']
+        w['c'] = 4
+        assert sorted(w._changed_keys()) == ['a', 'b', 'c']
+        assert w._get_original() == {'a': 1, 'b': 2}
+        assert d == {'a': 3, 'c': 4}
+
+    def test_in_place_modification(self):
+        w = DictWrapper({'tags': [{'name': 'a'}]})
+        w['tags'][0]['name'] = 'b'
+        assert w._changed_keys() == ['tags']
+        assert w._get_original() == {'tags': [{'name': 'a'}]}
+
+    def test_only_touched_values_are_copied(self):
+        tags = [{'name': 'a'}]
+        w = DictWrapper({'tags': tags, 'title': 'x'})
+        w['title'] = 'y'
+        assert w._get_original()['tags'] is tags
+
+    def test_reset_changes(self):
+        w = DictWrapper({'a': 1, 'tags': []})
+        w['a'] = 2
+        tags = w['tags']
+        w._reset_changes()
+        assert w._changed_keys() == []
+        # Retrieved containers are still tracked after a reset
+        tags.append('x')
+        assert w._changed_keys() == ['tags']
+
+    def test_forget(self):
+        w = DictWrapper({'tags': []})
+        w['tags'].append('x')
+        w._forget('tags')
+        assert w._changed_keys() == []
+        w['tags'].append('y')
+        assert w._changed_keys() == ['tags']
+
+
+class TestRunSteps(object):
+
+    def test_results_are_sent(self):
+        def steps():
+            a = yield lambda: 1
+            b = yield lambda: a + 1
+            return a + b
+        assert _run_steps(steps()) == 3
+
+    def test_exceptions_are_thrown(self):
+        def fail():
+            raise ValueError('boom')
+
+        def steps():
+            try:
+                yield fail
+            except ValueError:
+                return 'handled'
+        assert _run_steps(steps()) == 'handled'
+
+    def test_unhandled_exceptions_propagate(self):
+        def fail():
+            raise ValueError('boom')
+
+        def steps():
+            yield fail
+        with pytest.raises(ValueError):
+            _run_steps(steps())
+
+
+def test_replace_dict():
+    old = {'a': 1}
+    new = {'b': 2}
+    replace_dict(old, new)
+    assert old == {'b': 2}
+    with pytest.raises(ValueError):
+        replace_dict(old, old)
+
+
+def test_solr_escape():
+    assert solr_escape('a:b (c)') == r'a\:b \(c\)'
+    assert solr_escape(r'a\:b') == r'a\:b'
@@ -0,0 +1,248 @@
+#!/usr/bin/env python
+# encoding: utf-8
+
+# Copyright (C) 2018 Stadt Karlsruhe (www.karlsruhe.de)
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published
+# by the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+'''
+Rate limiting and adaptive concurrency for CKAN API calls.
+'''
+
+from __future__ import (absolute_import, division, print_function,
+                        unicode_literals)
+
+import logging
+import threading
+import time
+from timeit import default_timer
+
+from .metrics import _get_outcome
+
+
+__all__ = ['Throttle', 'ThrottledAPI']
+
+
+log = logging.getLogger(__name__)
+
+
+def _is_read_action(action):
+    '''
+    Check if a CKAN action only reads data.
+    '''
+    return (action == 'package_search'
+            or action.endswith(('_show', '_list', '_search')))
+
+
+class _TokenBucket(object):
+    '''
+    Token bucket rate limiter.
+
+    Tokens are added at a rate of ``rate`` per second, up to a maximum
+    of ``burst`` tokens.
+    '''
+    def __init__(self, rate, burst=None):
+        self.rate = rate
+        self.burst = max(1, rate if burst is None else burst)
+        self._tokens = self.burst
+        self._last = default_timer()
+        self._lock = threading.Lock()
+
+    def acquire(self):
+        '''
+        Take a token, waiting until one is available.
+        '''
+        while True:
+            with self._lock:
+                now = default_timer()
+                self._tokens = min(self.burst,
+                                   self._tokens + (now - self._last) * self.rate)
+                self._last = now
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return
+                delay = (1 - self._tokens) / self.rate
+            time.sleep(delay)
+
+
+class _AIMDLimit(object):
+    '''
+    Concurrency limit with additive increase and multiplicative decrease.
+
+    The limit starts at ``minimum``. Each time as many calls as allowed
+    by the current limit have completed successfully and faster than
+    ``target_latency`` seconds, the limit is increased by one, up to
+    ``maximum``. If a call fails or is slower than ``target_latency`` then
+    the limit is multiplied by ``decrease``, but not below ``minimum``.
+    Calls that started before the last decrease do not cause another
+    decrease, so that a single overload does not collapse the limit.
+    '''
+    def __init__(self, minimum, maximum, target_latency, decrease=0.5):
+        self.minimum = minimum
+        self.maximum = maximum
+        self.target_latency = target_latency
+        self.decrease = decrease
+        self.limit = float(minimum)
+        self._in_flight = 0
+        self._successes = 0
+        self._last_decrease = default_timer()
+        self._cond = threading.Condition()
+
+    def acquire(self):
+        '''
+        Wait until another call may start.
+
+        Returns the start time of the call, which must be passed to
+        :py:meth:`release`.
+        '''
+        with self._cond:
+            while self._in_flight >= int(self.limit):
+                self._cond.wait()
+            self._in_flight += 1
+            return default_timer()
+
+    def release(self, start, failed):
+        '''
+        Record the end of a call.
+        '''
+        latency = default_timer() - start
+        with self._cond:
+            self._in_flight -= 1
+            if failed or latency > self.target_latency:
+                if start > self._last_decrease:
+                    self.limit = max(self.minimum, self.limit * self.decrease)
+                    self._last_decrease = default_timer()
+                    self._successes = 0
+                    log.debug('Decreased concurrency limit to {} ({})'.format(
+                              int(self.limit),
+                              'error' if failed else 'latency {:.2f}s'.format(latency)))
+            else:
+                self._successes += 1
+                if self._successes >= int(self.limit) and self.limit < self.maximum:
+                    self.limit = min(self.maximum, self.limit + 1)
+                    self._successes = 0
+            self._cond.notify_all()
+
+    def in_flight(self):
+        with self._cond:
+            return self._in_flight
+
+
+class _Budget(object):
+    '''
+    Rate limit and concurrency limit for one kind of calls.
+    '''
+    def __init__(self, rate, min_concurrency, max_concurrency,
+                 target_latency):
+        self.bucket = _TokenBucket(rate) if rate else None
+        self.limit = _AIMDLimit(min_concurrency, max_concurrency,
+                                target_latency)
+
+    def call(self, func, kwargs):
+        if self.bucket is not None:
+            self.bucket.acquire()
+        start = self.limit.acquire()
+        failed = False
+        try:
+            return func(**kwargs)
+        except Exception as e:
+            # Errors like NotFound are regular answers and do not
+            # indicate an overloaded server
+            failed = _get_outcome(e) == 'other'
+            raise
+        finally:
+            self.limit.release(start, failed)
+
+    def stats(self):
+        return {
+            'concurrency_limit': int(self.limit.limit),
+            'in_flight': self.limit.in_flight(),
+        }
+
+
+class Throttle(object):
+    '''
+    Controls the rate and the concurrency of CKAN API calls.
+
+    Reads (``package_search`` and actions ending in ``_show``, ``_list``,
+    or ``_search``) and writes (all other actions) have separate budgets.
+
+    ``read_rate`` and ``write_rate`` are the maximum numbers of calls per
+    second. ``None`` means unlimited.
+
+    The number of concurrent calls is adjusted automatically between
+    ``min_concurrency`` and ``read_concurrency`` or ``write_concurrency``,
+    respectively: it is increased slowly while calls are answered within
+    ``target_latency`` seconds, and halved if a call takes longer or
+    fails with an error that indicates a problem of the server (errors
+    like ``NotFound`` or ``ValidationError`` don't count).
+
+    A throttle can be shared between several importers that use the same
+    CKAN instance. Instances can be used from several threads.
+    '''
+    def __init__(self, read_rate=None, write_rate=None, read_concurrency=16,
+                 write_concurrency=4, min_concurrency=1, target_latency=1):
+        self.read = _Budget(read_rate, min_concurrency, read_concurrency,
+                            target_latency)
+        self.write = _Budget(write_rate, min_concurrency, write_concurrency,
+                             target_latency)
+
+    def call(self, action, func, kwargs):
+        '''
+        Call ``func(**kwargs)`` for the CKAN action ``action`` within the
+        corresponding budget.
+        '''
+        budget = self.read if _is_read_action(action) else self.write
+        return budget.call(func, kwargs)
+
+    def stats(self):
+        '''
+        Get the current state of the throttle.
+
+        Returns a dict with the keys ``read`` and ``write``, each of
+        which maps to a dict with the current ``concurrency_limit`` and
+        the number of calls that are ``in_flight``.
+        '''
+        return {'read': self.read.stats(), 'write': self.write.stats()}
+
+
+class ThrottledAPI(object):
+    '''
+    Wrapper around a CKAN API client that applies a :py:class:`Throttle`.
+
+    ``api`` is an instance of ``ckanapi.LocalCKAN`` or
+    ``ckanapi.RemoteCKAN`` (or any other object with a compatible
+    ``action`` attribute).
+    '''
+    def __init__(self, api, throttle):
+        #: The wrapped API client
+        self.api = api
+        self.throttle = throttle
+        self.action = ThrottledAPI._Action(self)
+
+    class _Action(object):
+        def __init__(self, throttled):
+            self._throttled = throttled
+
+        def __getattr__(self, name):
+            func = getattr(self._throttled.api.action, name)
+            throttle = self._throttled.throttle
+
+            def call(**kwargs):
+                return throttle.call(name, func, kwargs)
+
+            return call
+
+    def __repr__(self):
+        return '<{} for {!r}>'.format(self.__class__.__name__, self.api)
@@ -0,0 +1,344 @@
+#!/usr/bin/env python
+# encoding: utf-8
+
+# Copyright (C) 2018 Stadt Karlsruhe (www.karlsruhe.de)
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published
+# by the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+'''
+Transport layer for using a remote CKAN instance.
+
+Provides a ``RemoteCKAN`` client with a pool of keep-alive connections
+and timeouts, and a wrapper that retries idempotent actions after
+transient errors and pauses all calls while the CKAN instance is
+unavailable.
+'''
+
+from __future__ import (absolute_import, division, print_function,
+                        unicode_literals)
+
+import logging
+import random
+import threading
+import time
+from timeit import default_timer
+
+import ckanapi
+import requests
+from requests.adapters import HTTPAdapter
+
+
+__all__ = ['CircuitBreaker', 'CircuitOpenError', 'PooledRemoteCKAN',
+           'RetryingAPI', 'TransientError', 'create_remote_api']
+
+
+log = logging.getLogger(__name__)
+
+
+#: HTTP status codes that indicate a transient error.
+TRANSIENT_STATUS_CODES = frozenset([429, 502, 503, 504])
+
+
+class TransientError(Exception):
+    '''
+    Raised for HTTP responses that indicate a transient error.
+    '''
+    def __init__(self, url, status):
+        super(TransientError, self).__init__(
+            'HTTP status {} for {}'.format(status, url))
+        self.url = url
+        self.status = status
+
+
+class CircuitOpenError(Exception):
+    '''
+    Raised by :py:class:`CircuitBreaker` when CKAN has been unavailable
+    for longer than the breaker's ``max_pause``.
+    '''
+
+
+def _is_transient_error(exception):
+    '''
+    Check if an exception indicates a transient transport error.
+    '''
+    return isinstance(exception, (TransientError, CircuitOpenError,
+                                  requests.ConnectionError,
+                                  requests.Timeout))
+
+
+def _is_idempotent(action):
+    '''
+    Check if calling a CKAN action repeatedly has the same effect as
+    calling it once.
+    '''
+    return (action == 'package_search'
+            or action.endswith(('_show', '_list', '_update')))
+
+
+class PooledRemoteCKAN(ckanapi.RemoteCKAN):
+    '''
+    A ``ckanapi.RemoteCKAN`` client that uses a pool of keep-alive
+    connections.
+
+    ``pool_size`` is the maximum number of connections and should be at
+    least the number of threads that use the client concurrently. If all
+    connections are in use then further requests wait for a free
+    connection.
+
+    ``timeout`` is the timeout for connecting and for reading responses
+    in seconds.
+
+    Responses with one of the HTTP status codes in
+    ``TRANSIENT_STATUS_CODES`` raise a :py:class:`TransientError`.
+
+    The remaining arguments are passed on to ``ckanapi.RemoteCKAN``.
+    '''
+    def __init__(self, address, apikey=None, user_agent=None, pool_size=10,
+                 timeout=60):
+        session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size,
+                              pool_block=True)
+        session.mount('http://', adapter)
+        session.mount('https://', adapter)
+        super(PooledRemoteCKAN, self).__init__(address, apikey=apikey,
+                                               user_agent=user_agent,
+                                               session=session)
+        self.timeout = timeout
+
+    def _with_timeout(self, requests_kwargs):
+        '''
+        Add the default timeout to the keyword arguments for ``requests``.
+
+        Some versions of ``ckanapi`` pass ``timeout=None`` if no timeout
+        was given, so ``None`` is replaced, too.
+        '''
+        requests_kwargs = dict(requests_kwargs)
+        if requests_kwargs.get('timeout') is None:
+            requests_kwargs['timeout'] = self.timeout
+        return requests_kwargs
+
+    def _request_fn(self, url, data, headers, files, requests_kwargs):
+        requests_kwargs = self._with_timeout(requests_kwargs)
+        status, text = super(PooledRemoteCKAN, self)._request_fn(
+            url, data, headers, files, requests_kwargs)
+        if status in TRANSIENT_STATUS_CODES:
+            raise TransientError(url, status)
+        return status, text
+
+    def _request_fn_get(self, url, data_dict, headers, requests_kwargs):
+        requests_kwargs = self._with_timeout(requests_kwargs)
+        status, text = super(PooledRemoteCKAN, self)._request_fn_get(
+            url, data_dict, headers, requests_kwargs)
+        if status in TRANSIENT_STATUS_CODES:
+            raise TransientError(url, status)
+        return status, text
+
+
+class CircuitBreaker(object):
+    '''
+    Pauses API calls while CKAN is unavailable.
+
+    After ``threshold`` consecutive calls have failed with transient
+    errors the breaker opens: all calls wait for ``pause`` seconds.
+    Afterwards a single call is let through to check whether CKAN is
+    available again. If that call succeeds then the breaker closes and
+    the waiting calls continue. Otherwise the breaker opens again.
+
+    ``max_pause`` is the maximum total time in seconds that the breaker
+    stays open without a successful call in between. Once it has been
+    exceeded, waiting and further calls raise a
+    :py:class:`CircuitOpenError`. If ``max_pause`` is ``None`` (the
+    default) then calls wait until CKAN is available again.
+
+    Instances can be used from several threads.
+    '''
+    _CLOSED = 'closed'
+    _OPEN = 'open'
+    _HALF_OPEN = 'half-open'
+    _BROKEN = 'broken'
+
+    def __init__(self, threshold=5, pause=30, max_pause=None):
+        self.threshold = threshold
+        self.pause = pause
+        self.max_pause = max_pause
+        self._cond = threading.Condition()
+        self._state = CircuitBreaker._CLOSED
+        self._failures = 0
+        self._open_until = None
+        self._paused = 0
+        self._trial_running = False
+
+    def before_call(self):
+        '''
+        Wait until a call may be made.
+
+        Raises :py:class:`CircuitOpenError` if the breaker has been open
+        for longer than ``max_pause``.
+        '''
+        with self._cond:
+            while True:
+                if self._state == CircuitBreaker._CLOSED:
+                    return
+                if self._state == CircuitBreaker._BROKEN:
+                    raise CircuitOpenError('CKAN has been unavailable for {} seconds'.format(
+                                           self._paused))
+                if self._state == CircuitBreaker._OPEN:
+                    remaining = self._open_until - default_timer()
+                    if remaining > 0:
+                        self._cond.wait(remaining)
+                        continue
+                    self._state = CircuitBreaker._HALF_OPEN
+                    self._trial_running = False
+                if not self._trial_running:
+                    self._trial_running = True
+                    return
+                self._cond.wait()
+
+    def record_success(self):
+        '''
+        Record that a call reached CKAN.
+        '''
+        with self._cond:
+            if self._state != CircuitBreaker._CLOSED:
+                log.info('CKAN is available again, resuming')
+            self._state = CircuitBreaker._CLOSED
+            self._failures = 0
+            self._paused = 0
+            self._trial_running = False
+            self._cond.notify_all()
+
+    def record_failure(self):
+        '''
+        Record that a call failed with a transient error.
+        '''
+        with self._cond:
+            self._failures += 1
+            if (self._state == CircuitBreaker._HALF_OPEN
+                    or (self._state == CircuitBreaker._CLOSED
+                        and self._failures >= self.threshold)):
+                if self.max_pause is not None and self._paused >= self.max_pause:
+                    log.error('CKAN has been unavailable for {} seconds, giving up'.format(
+                              self._paused))
+                    self._state = CircuitBreaker._BROKEN
+                else:
+                    log.warning('CKAN seems to be unavailable, pausing for {} seconds'.format(
+                                self.pause))
+                    self._state = CircuitBreaker._OPEN
+                    self._open_until = default_timer() + self.pause
+                    self._paused += self.pause
+                self._trial_running = False
+                self._cond.notify_all()
+
+
+class RetryingAPI(object):
+    '''
+    Wrapper around a CKAN API client that retries transient errors.
+
+    ``api`` is an instance of ``ckanapi.RemoteCKAN`` (usually a
+    :py:class:`PooledRemoteCKAN`) or any other object with a compatible
+    ``action`` attribute.
+
+    Calls of idempotent actions (``package_search`` and actions ending
+    in ``_show``, ``_list``, or ``_update``) that fail with a transient
+    error (a :py:class:`TransientError`, a connection error, or a
+    timeout) are retried up to ``retries`` times. The delay before the
+    ``n``-th retry is chosen randomly between 0 and
+    ``min(max_backoff, backoff * 2 ** n)`` seconds. Other actions are not
+    retried.
+
+    ``circuit_breaker`` is an optional :py:class:`CircuitBreaker` that
+    is informed about the outcome of all calls and that pauses the calls
+    while CKAN is unavailable.
+    '''
+    def __init__(self, api, retries=4, backoff=1, max_backoff=60,
+                 circuit_breaker=None):
+        #: The wrapped API client
+        self.api = api
+        self.retries = retries
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.circuit_breaker = circuit_breaker
+        self.action = RetryingAPI._Action(self)
+
+    class _Action(object):
+        def __init__(self, retrying):
+            self._retrying = retrying
+
+        def __getattr__(self, name):
+            func = getattr(self._retrying.api.action, name)
+            retrying = self._retrying
+
+            def call(**kwargs):
+                return retrying._call(name, func, kwargs)
+
+            return call
+
+    def _call(self, name, func, kwargs):
+        breaker = self.circuit_breaker
+        retries = self.retries if _is_idempotent(name) else 0
+        attempt = 0
+        while True:
+            if breaker is not None:
+                breaker.before_call()
+            try:
+                result = func(**kwargs)
+            except Exception as e:
+                if not _is_transient_error(e):
+                    if breaker is not None:
+                        breaker.record_success()
+                    raise
+                if breaker is not None:
+                    breaker.record_failure()
+                if attempt >= retries:
+                    raise
+                delay = random.uniform(0, min(self.max_backoff,
+                                              self.backoff * 2 ** attempt))
+                log.warning('Retrying {} in {:.1f}s after transient error: {}'.format(
+                            name, delay, e))
+                time.sleep(delay)
+                attempt += 1
+            else:
+                if breaker is not None:
+                    breaker.record_success()
+                return result
+
+    def __repr__(self):
+        return '<{} for {!r}>'.format(self.__class__.__name__, self.api)
+
+
+def create_remote_api(address, apikey=None, workers=10, timeout=60,
+                      retries=4, circuit_breaker=True, user_agent=None):
+    '''
+    Create a client for a remote CKAN instance.
+
+    Returns a :py:class:`RetryingAPI` for a :py:class:`PooledRemoteCKAN`
+    which can be passed as ``api`` to
+    :py:class:`~ckanext.importer.Importer`.
+
+    ``workers`` is the number of threads that will use the client
+    concurrently and determines the size of the connection pool.
+
+    ``timeout`` and ``retries`` are as for :py:class:`PooledRemoteCKAN`
+    and :py:class:`RetryingAPI`.
+
+    If ``circuit_breaker`` is true then a :py:class:`CircuitBreaker`
+    with the default settings is used. It can also be an instance of
+    :py:class:`CircuitBreaker`.
+    '''
+    api = PooledRemoteCKAN(address, apikey=apikey, user_agent=user_agent,
+                           pool_size=workers, timeout=timeout)
+    if circuit_breaker is True:
+        circuit_breaker = CircuitBreaker()
+    return RetryingAPI(api, retries=retries,
+                       circuit_breaker=circuit_breaker or None)
@@ -21,6 +21,7 @@ from __future__ import (absolute_import, division, print_function,
                         unicode_literals)
 
 import collections
+from copy import deepcopy
 import logging
 import re
 
@@ -89,6 +90,40 @@ class context_manager_method(object):
         return NestedCM()
 
 
+def _run_steps(steps):
+    '''
+    Run a generator that describes an operation in steps.
+
+    Logic that is shared between :py:class:`~ckanext.importer.Importer`
+    and its asynchronous counterpart in :py:mod:`ckanext.importer.aio`
+    is written as generators that yield the I/O calls they need as
+    callables without arguments. The result of each call is sent back
+    into the generator and exceptions raised by a call are thrown into
+    it, so the generator handles them like a direct call.
+
+    This function performs the calls synchronously. See
+    ``ckanext.importer.aio._run_steps_async`` for the asynchronous
+    version.
+
+    Returns the return value of the generator.
+    '''
+    try:
+        call = next(steps)
+        while True:
+            try:
+                result = call()
+            except Exception as e:
+                call = steps.throw(e)
+            else:
+                call = steps.send(result)
+    except StopIteration as e:
+        return e.value
+
+
+# Marker for keys that did not exist originally
+_MISSING = object()
+
+
 class DictWrapper(collections.abc.MutableMapping):
     '''
     Wrapper for an existing dict.
@@ -96,6 +131,13 @@ class DictWrapper(collections.abc.MutableMapping):
     Helper class for providing a customized ``dict``-interface against
     an existing dict. Subclasses can override that part of the interface
     that they're interested in.
+
+    Changes that are made via the wrapper are tracked, see
+    :py:meth:`_changed_keys`. Only the values that are actually touched
+    are copied: values that are replaced or deleted are remembered by
+    reference, and containers (``dict`` and ``list`` values) are copied
+    when they are first retrieved, since they may then be modified
+    in-place. Changes made directly to the wrapped dict are not tracked.
     '''
     def __init__(self, d):
         '''
@@ -105,14 +147,20 @@ class DictWrapper(collections.abc.MutableMapping):
         instance will delegate all access to ``d``.
         '''
         self._dict = d
+        self._originals = {}
 
     def __getitem__(self, key):
-        return self._dict[key]
+        value = self._dict[key]
+        if isinstance(value, (dict, list)):
+            self._snapshot(key)
+        return value
 
     def __setitem__(self, key, value):
+        self._remember(key)
         self._dict[key] = value
 
     def __delitem__(self, key):
+        self._remember(key)
         del self._dict[key]
 
     def __iter__(self):
@@ -124,6 +172,81 @@ class DictWrapper(collections.abc.MutableMapping):
     def __contains__(self, key):
         return key in self._dict
 
+    def _remember(self, key):
+        '''
+        Remember the original value of a key before it is replaced.
+        '''
+        if key not in self._originals:
+            self._originals[key] = self._dict.get(key, _MISSING)
+
+    def _snapshot(self, key):
+        '''
+        Remember the original value of a key before it is modified.
+
+        Must be called before a value is modified in-place.
+        '''
+        if key not in self._originals:
+            value = self._dict.get(key, _MISSING)
+            if value is not _MISSING:
+                value = deepcopy(value)
+            self._originals[key] = value
+
+    def _changed_keys(self):
+        '''
+        Return the keys whose values have changed.
+
+        Keys that have been added or deleted are included.
+
+        Only the values that have been touched via the wrapper are
+        compared.
+        '''
+        return [key for key, value in self._originals.items()
+                if self._dict.get(key, _MISSING) != value]
+
+    def _get_original(self):
+        '''
+        Return a shallow copy of the wrapped dict in its original state.
+        '''
+        original = dict(self._dict)
+        for key, value in self._originals.items():
+            if value is _MISSING:
+                original.pop(key, None)
+            else:
+                original[key] = value
+        return original
+
+    def _forget(self, key):
+        '''
+        Use the current value of a key as its original value.
+
+        Unlike :py:meth:`_reset_changes`, nothing is copied: the key is
+        simply no longer tracked until it is retrieved or modified via
+        the wrapper again.
+        '''
+        self._originals.pop(key, None)
+
+    def _reset_changes(self):
+        '''
+        Use the current state of the wrapped dict as its original state.
+        '''
+        # Containers that have been retrieved before may still be
+        # modified in-place, so their keys keep being tracked.
+        self._originals = {key: deepcopy(self._dict[key])
+                           for key in self._originals
+                           if isinstance(self._dict.get(key), (dict, list))}
+
+
+def _unwrap_api(api):
+    '''
+    Get the CKAN API client that is wrapped by API wrappers.
+
+    Wrappers like :py:class:`~ckanext.importer.metrics.InstrumentedAPI`
+    store the wrapped client in their ``api`` attribute.
+    '''
+    while not isinstance(api, ckanapi.LocalCKAN) and hasattr(api, 'api'):
+        api = api.api
+    return api
+
 
 def replace_dict(old, new):
     '''
@@ -138,5 +138,5 @@ htmlhelp_basename = 'ckanextimporterdoc'
 
 # -- Extension configuration -------------------------------------------------
 
-autodoc_mock_imports = ['ckan']
+autodoc_mock_imports = ['ckan', 'sqlalchemy']
 
@@ -110,7 +110,10 @@ setup(
     # To provide executable scripts, use entry points in preference to the
     # "scripts" keyword. Entry points provide cross-platform support and allow
     # pip to create the appropriate form of executable for the target platform.
-    entry_points='',
+    entry_points='''
+        [ckan.plugins]
+        importer=ckanext.importer.plugin:ImporterPlugin
+    ''',
 
     # If you are changing from the default layout of your extension, you may
     # have to change the message extractors, you can read more about babel